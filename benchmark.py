@@ -0,0 +1,442 @@
+# benchmarks for the marc processing in utils and csv_converter
+
+import argparse
+import filecmp
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Optional, Union
+
+from pymarc import Subfield
+
+from cell_codec import decode_cell, decode_cells, encode_cell, encode_cells
+from csv_converter import to_csv, to_marc
+from pipeline import run_pipeline
+from synthetic import CatalogueModel, write_catalogue
+from utils import (
+    _get_records_64,
+    decode_64_str,
+    find_fields,
+    flatten_mixed_marc,
+    iter_marc_records,
+    record_bytes,
+    record_tags,
+    separate_mixed_marc,
+)
+
+HERE = Path(__file__).parent
+FIXTURES = ("PGA-Australiana.mrc", "test64.marc", "librarything_UMClassics.marc")
+FUNCTIONS = (
+    "decode_64",
+    "_get_records_64",
+    "flatten_mixed_marc",
+    "separate_mixed_marc",
+    "to_csv",
+    "to_marc",
+    "flatten_then_to_csv",
+    "pipeline",
+)
+
+
+@contextmanager
+def _in_directory(directory: Union[Path, str]):
+    """
+    flatten_mixed_marc and separate_mixed_marc
+    write their output to the working directory
+    """
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def bench_workers(
+    filename: Union[Path, str] = HERE / "librarything_UMClassics.marc",
+    workers: tuple[int, ...] = (1, 2, 4, 8),
+    repeat: int = 10,
+) -> list[dict]:
+    """
+    Times flatten_mixed_marc and separate_mixed_marc with different numbers of worker
+    processes, on `filename` concatenated `repeat` times, and checks that every run
+    writes the same bytes. Peak memory is the peak of Python allocations in the main
+    process, from a separate run.
+    """
+    results = []
+    with TemporaryDirectory() as tmp, _in_directory(tmp):
+        source = Path(filename).name
+        with open(filename, "rb") as f_in, open(source, "wb") as f_out:
+            data = f_in.read()
+            for _ in range(repeat):
+                f_out.write(data)
+        size = os.path.getsize(source)
+        for name, func, kwargs in (
+            ("flatten_mixed_marc", flatten_mixed_marc, {}),
+            ("separate_mixed_marc", separate_mixed_marc, {}),
+        ):
+            baseline = None
+            for n in workers:
+                start = time.perf_counter()
+                with redirect_stdout(None):
+                    written = func(source, workers=n, **kwargs)
+                seconds = time.perf_counter() - start
+                # tracemalloc slows things down a lot,
+                # so memory is measured in a second run
+                tracemalloc.start()
+                with redirect_stdout(None):
+                    func(source, workers=n, **kwargs)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                written = written if isinstance(written, tuple) else (written,)
+                if baseline is None:
+                    baseline = []
+                    for path in written:
+                        shutil.copy(path, f"baseline_{path}")
+                        baseline.append(Path(f"baseline_{path}"))
+                identical = all(
+                    filecmp.cmp(path, base, shallow=False)
+                    for path, base in zip(written, baseline)
+                )
+                results.append(
+                    {
+                        "function": name,
+                        "workers": n,
+                        "seconds": seconds,
+                        "MB/s": size / seconds / 1e6,
+                        "peak_MB": peak / 1e6,
+                        "identical": identical,
+                    }
+                )
+    return results
+
+
+def _inline_encode(field: tuple) -> str:
+    "how to_csv used to write a cell, with an f-string join per field, for bench_codec"
+    ind1, ind2, subfields = field
+    indicator1 = ind1 if ind1 != " " else "\\"
+    indicator2 = ind2 if ind2 != " " else "\\"
+    cells = " ".join(f"${code}{value}" for code, value in subfields)
+    return f"{indicator1}{indicator2}{cells}"
+
+
+def _inline_decode(cell: str) -> tuple:
+    """
+    how to_marc used to read a cell into indicators
+    and pymarc Subfields, for bench_codec
+    """
+    cell = cell.replace(chr(31), "$")
+    if "$" in cell[:3]:
+        indicators, field_text = cell.split("$", maxsplit=1)
+        indicators = indicators.replace(" ", "\\")
+        indicators = [char for char in indicators][:2]
+    else:
+        indicators, field_text = (["\\", "\\"], cell)
+    field_text = field_text.strip()
+    subfields = (
+        [Subfield(code=s[0], value=s[1:]) for s in field_text.split("$")]
+        if field_text
+        else []
+    )
+    return indicators, subfields
+
+
+def bench_codec(
+    filename: Union[Path, str] = HERE / "librarything_UMClassics.marc", repeat: int = 5
+) -> list[dict]:
+    """
+    Times encoding and decoding every data field of `filename` as csv cells, `repeat`
+    times over, with cell_codec a column at a time and with the inline code that to_csv
+    and to_marc used before.
+    """
+    fields = []
+    for chunk in iter_marc_records(filename):
+        record = record_bytes(chunk)
+        tags = {tag.encode("ascii") for tag in record_tags(record)}
+        for tag, data in find_fields(record, tags):
+            # the inline code can't read cells with a literal "$", so those are left out
+            if tag >= b"010" and b"$" not in data:
+                fields.append(data.decode("utf8", "replace"))
+    fields = fields * repeat
+    tuples = [decode_cell(encode_cell(field, raw=True)) for field in fields]
+    cells = encode_cells(fields, raw=True)
+    cases = (
+        ("encode", "inline", lambda: [_inline_encode(field) for field in tuples]),
+        ("encode", "cell_codec", lambda: encode_cells(tuples)),
+        ("encode", "cell_codec raw", lambda: encode_cells(fields, raw=True)),
+        ("decode", "inline", lambda: [_inline_decode(cell) for cell in cells]),
+        ("decode", "cell_codec", lambda: decode_cells(cells)),
+        ("decode", "cell_codec raw", lambda: decode_cells(cells, raw=True)),
+    )
+    results = []
+    for direction, implementation, run in cases:
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "direction": direction,
+                "implementation": implementation,
+                "seconds": seconds,
+                "cells/s": len(cells) / seconds,
+            }
+        )
+    return results
+
+
+def _run_case(function: str, paths: dict) -> dict:
+    """
+    Runs one benchmark, in a fresh process so that peak RSS belongs to this benchmark
+    alone. Loading the input happens before the clock starts.
+    """
+    os.chdir(paths["directory"])
+    records = paths["records"]
+    size = os.path.getsize(paths["marc"])
+    if function in ("decode_64", "_get_records_64"):
+        chunks = [c.data for c in iter_marc_records(paths["marc"]) if c.base64]
+        records = len(chunks)
+        size = sum(len(chunk) for chunk in chunks)
+        lines = [
+            line for chunk in chunks for line in chunk.decode("ascii").splitlines(True)
+        ]
+    elif function == "to_csv":
+        size = os.path.getsize(paths["plain"])
+    elif function == "to_marc":
+        size = os.path.getsize(paths["csv"])
+    # resident memory after loading the input, in pages
+    with open("/proc/self/statm") as f:
+        setup_rss = int(f.read().split()[1]) * resource.getpagesize()
+    start = time.perf_counter()
+    with redirect_stdout(None):
+        if function == "decode_64":
+            for chunk in chunks:
+                decode_64_str(chunk, errors="replace")
+        elif function == "_get_records_64":
+            _get_records_64(lines)
+        elif function == "flatten_mixed_marc":
+            flatten_mixed_marc(paths["marc"].name, errors="replace")
+        elif function == "separate_mixed_marc":
+            separate_mixed_marc(paths["marc"].name, errors="replace")
+        elif function == "to_csv":
+            to_csv(paths["plain"], "bench.csv")
+        elif function == "to_marc":
+            to_marc(paths["csv"], "bench.mrc")
+        elif function == "flatten_then_to_csv":
+            # the two-step flow that pipeline replaces
+            flattened = flatten_mixed_marc(paths["marc"].name, errors="replace")
+            to_csv(flattened, "bench.csv")
+        elif function == "pipeline":
+            run_pipeline(paths["marc"], {"marc": "bench.mrc", "csv": "bench.csv"})
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "records": records,
+        "MB": size / 1e6,
+        "records/s": records / seconds if seconds else 0.0,
+        "MB/s": size / seconds / 1e6 if seconds else 0.0,
+        "setup_rss_MB": setup_rss / 1e6,
+        # ru_maxrss is in KiB on linux
+        "peak_rss_MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 / 1e6,
+    }
+
+
+def _prepare(source: Path, directory: Path) -> dict:
+    """
+    Copies a marc file to directory, with the plain marc and the csv that to_csv and
+    to_marc need. The plain marc has the decoded bytes of every record, so that record
+    lengths stay valid.
+    """
+    marc = directory / source.name
+    if source != marc:
+        shutil.copy(source, marc)
+    plain = directory / f"plain_{marc.name}"
+    with open(plain, "wb") as f:
+        for chunk in iter_marc_records(marc):
+            f.write(record_bytes(chunk))
+    with redirect_stdout(None):
+        to_csv(plain, directory / f"{marc.stem}.csv")
+    return {
+        "directory": directory,
+        "marc": marc,
+        "plain": plain,
+        "csv": directory / f"{marc.stem}.csv",
+        "records": sum(1 for _ in iter_marc_records(marc)),
+    }
+
+
+def bench_suite(
+    fixtures: tuple[str, ...] = FIXTURES,
+    sizes: tuple[int, ...] = (10_000, 100_000, 1_000_000),
+    base64_fraction: float = 0.5,
+    functions: tuple[str, ...] = FUNCTIONS,
+) -> list[dict]:
+    """
+    Runs every function in `functions` on the bundled fixtures and on synthetic
+    catalogues of the given sizes, each in a fresh process, and returns one result per
+    function and input.
+    """
+    results = []
+    spawn = multiprocessing.get_context("spawn")
+    with TemporaryDirectory() as tmp:
+        inputs = [HERE / name for name in fixtures]
+        model = CatalogueModel()
+        for n in sizes:
+            dest = Path(tmp) / f"synthetic_{n}.marc"
+            write_catalogue(dest, n, base64_fraction=base64_fraction, model=model)
+            inputs.append(dest)
+        for i, source in enumerate(inputs):
+            directory = Path(tmp) / str(i)
+            directory.mkdir()
+            paths = _prepare(source, directory)
+            for function in functions:
+                if function in ("decode_64", "_get_records_64") and not any(
+                    chunk.base64 for chunk in iter_marc_records(paths["marc"])
+                ):
+                    continue
+                with ProcessPoolExecutor(1, mp_context=spawn) as pool:
+                    result = pool.submit(_run_case, function, paths).result()
+                results.append({"function": function, "input": source.name, **result})
+                print(
+                    f"{function} on {source.name}: {result['records/s']:.0f} records/s",
+                    file=sys.stderr,
+                )
+    return results
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save_results(results: list[dict], dest: Optional[Union[Path, str]] = None) -> Path:
+    """
+    Saves results as json, with the commit they
+    were run on, by default to bench_<commit>.json.
+    """
+    commit = _git_commit()
+    dest = Path(dest) if dest else Path(f"bench_{commit}.json")
+    report = {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    with open(dest, "w") as f:
+        json.dump(report, f, indent=2)
+    return dest
+
+
+def compare_results(
+    old: Union[Path, str], new: list[dict], threshold: float = 0.1
+) -> list[str]:
+    """
+    Compares results with those saved in `old`, and returns a message for each function
+    and input whose throughput (records/s) dropped by more than `threshold`.
+    """
+    with open(old) as f:
+        previous = {
+            (result["function"], result["input"]): result
+            for result in json.load(f)["results"]
+        }
+    regressions = []
+    for result in new:
+        before = previous.get((result["function"], result["input"]))
+        if not before or not before["records/s"]:
+            continue
+        ratio = result["records/s"] / before["records/s"]
+        if ratio < 1 - threshold:
+            regressions.append(
+                f"{result['function']} on {result['input']}: {before['records/s']:.0f}"
+                f" -> {result['records/s']:.0f} records/s ({ratio - 1:+.0%})"
+            )
+    return regressions
+
+
+def _print_table(results: list[dict]) -> None:
+    columns = list(results[0].keys())
+    print("\t".join(columns))
+    for row in results:
+        print(
+            "\t".join(
+                f"{value:.3f}" if isinstance(value, float) else str(value)
+                for value in row.values()
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for utils and csv_converter."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    suite_parser = subparsers.add_parser(
+        "suite", help="benchmark every function on fixtures and synthetic catalogues"
+    )
+    suite_parser.add_argument(
+        "--sizes", type=int, nargs="*", default=[10_000, 100_000, 1_000_000]
+    )
+    suite_parser.add_argument("--base64-fraction", type=float, default=0.5)
+    suite_parser.add_argument("--functions", nargs="+", default=list(FUNCTIONS))
+    suite_parser.add_argument("--output", help="where to save json results")
+    suite_parser.add_argument(
+        "--compare", help="json results from an earlier run to check for regressions"
+    )
+    suite_parser.add_argument("--threshold", type=float, default=0.1)
+    workers_parser = subparsers.add_parser(
+        "workers",
+        help="benchmark flatten_mixed_marc and separate_mixed_marc with more workers",
+    )
+    workers_parser.add_argument(
+        "filename", nargs="?", default=HERE / "librarything_UMClassics.marc"
+    )
+    workers_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    workers_parser.add_argument("--repeat", type=int, default=10)
+    codec_parser = subparsers.add_parser(
+        "codec", help="benchmark cell_codec against the old inline cell handling"
+    )
+    codec_parser.add_argument(
+        "filename", nargs="?", default=HERE / "librarything_UMClassics.marc"
+    )
+    codec_parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(f"{os.cpu_count()} cpus", file=sys.stderr)
+    if args.command == "workers":
+        _print_table(bench_workers(args.filename, tuple(args.workers), args.repeat))
+        sys.exit()
+    if args.command == "codec":
+        _print_table(bench_codec(args.filename, args.repeat))
+        sys.exit()
+    results = bench_suite(
+        sizes=tuple(args.sizes),
+        base64_fraction=args.base64_fraction,
+        functions=tuple(args.functions),
+    )
+    _print_table(results)
+    print(f"saved results to {save_results(results, args.output)}", file=sys.stderr)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,341 @@
+# an embedded store for the catalogue while it moves between marc, csv and pandas
+#
+# The store is a single SQLite file with a row per record: the record's raw marc
+# bytes, kept exactly as they were ingested, and the columns records are looked
+# up by, read from the record when it is ingested: the 001, the first ISBN (020
+# $a), title (245 $a), author (100 $a) and call number (050), each with an
+# index. The tags of the record are kept too, so that the csv columns of an
+# export are known without reading the records. Records are upserted by their
+# 001 in batches, a transaction each, and exported to marc or csv by streaming a
+# query over the indexes, so exporting a subset only reads that subset.
+
+import argparse
+import csv
+import hashlib
+import re
+import sqlite3
+import sys
+from collections.abc import Generator, Iterable
+from contextlib import nullcontext
+from itertools import islice
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import BinaryIO, Optional, TextIO, Tuple, Union
+
+from csv_converter import _csv_row_bytes, to_marc
+from utils import _directory_tags, find_fields, iter_marc_records, record_bytes
+
+# bump when the schema changes, stores with another version have to be ingested again
+_SCHEMA_VERSION = 1
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    control TEXT NOT NULL UNIQUE,
+    isbn TEXT,
+    title TEXT,
+    author TEXT,
+    call_number TEXT,
+    tags TEXT NOT NULL,
+    marc BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_isbn ON records (isbn);
+CREATE INDEX IF NOT EXISTS records_title ON records (title);
+CREATE INDEX IF NOT EXISTS records_author ON records (author);
+CREATE INDEX IF NOT EXISTS records_call_number ON records (call_number);
+"""
+# the marc blob is the last column, so that reading
+# the others doesn't touch its overflow pages
+_UPSERT = """
+INSERT INTO records (control, isbn, title, author, call_number, tags, marc)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (control) DO UPDATE SET
+    isbn = excluded.isbn, title = excluded.title, author = excluded.author,
+    call_number = excluded.call_number, tags = excluded.tags, marc = excluded.marc
+WHERE records.marc != excluded.marc
+"""
+# the columns records can be looked up by
+COLUMNS = ("control", "isbn", "title", "author", "call_number")
+_TAGS = frozenset((b"001", b"020", b"050", b"100", b"245"))
+# isbd punctuation left at the end of titles and names
+_TRAILING = " /:;,."
+_GLOB_SPECIAL = re.compile(r"([*?\[])")
+
+
+def _first_subfield(field: bytes, code: bytes) -> Optional[str]:
+    for subfield in field.split(b"\x1f")[1:]:
+        if subfield[:1] == code:
+            return subfield[1:].decode("utf8", "replace")
+    return None
+
+
+def record_columns(
+    record: bytes,
+) -> Tuple[str, Optional[str], Optional[str], Optional[str], Optional[str], str]:
+    """
+    The columns of the store for a marc record: its 001 (or "sha1:" and a
+    hash of the record, if it has none), the first ISBN in 020 $a without
+    hyphens or qualifiers, 245 $a and 100 $a without trailing punctuation,
+    the subfields of 050 joined by spaces, and the tags of its fields.
+    Raises ValueError if the record's directory can't be read.
+    """
+    try:
+        int(record[12:17])
+    except ValueError:
+        raise ValueError(f"Record has no base address: {record[:24]!r}") from None
+    control = isbn = title = author = call_number = None
+    for tag, data in find_fields(record, _TAGS):
+        if tag == b"001" and control is None:
+            control = data.decode("utf8", "replace").strip()
+        elif tag == b"020" and isbn is None:
+            isbn = _first_subfield(data, b"a")
+            isbn = isbn.split()[0].replace("-", "") if isbn and isbn.split() else None
+        elif tag == b"245" and title is None:
+            title = (_first_subfield(data, b"a") or "").rstrip(_TRAILING) or None
+        elif tag == b"100" and author is None:
+            author = (_first_subfield(data, b"a") or "").rstrip(_TRAILING) or None
+        elif tag == b"050" and call_number is None:
+            call_number = b" ".join(sub[1:] for sub in data.split(b"\x1f")[1:]).decode(
+                "utf8", "replace"
+            )
+    if not control:
+        control = "sha1:" + hashlib.sha1(record).hexdigest()
+    tags = " ".join(tag.decode("ascii", "replace") for tag in _directory_tags(record))
+    return control, isbn, title, author, call_number, tags
+
+
+class CatalogueStore:
+    """
+    SQLite store of marc records, keyed by 001 (see record_columns), at `path`
+    (":memory:" for one that isn't kept). upsert() and the ingest methods write records
+    in transactions of batch_size records; get() and records() look them up through the
+    indexes on COLUMNS, and export_marc() and export_csv() stream them out. Can be used
+    as a context manager, which closes it.
+    """
+
+    def __init__(self, path: Union[Path, str], batch_size: int = 10_000):
+        self.path = path
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(path)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, _SCHEMA_VERSION):
+            raise ValueError(
+                f"{path} is a store of version {version}, "
+                f"this is version {_SCHEMA_VERSION}."
+            )
+        # a crash can lose the last transactions, but never corrupt the store
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        with self.db:
+            self.db.executescript(_SCHEMA)
+            self.db.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def upsert(self, records: Iterable[bytes]) -> int:
+        """
+        Adds marc records, replacing those with the same 001, in transactions of
+        batch_size records; records that haven't changed are left alone, and those whose
+        directory can't be read are reported and skipped. Returns the number of records
+        added or changed.
+        """
+        changes = self.db.total_changes
+        records = iter(records)
+        while batch := list(islice(records, self.batch_size)):
+            rows = []
+            for record in batch:
+                try:
+                    rows.append((*record_columns(record), record))
+                except ValueError as e:
+                    print(f"warning: record skipped: {e}")
+            with self.db:
+                self.db.executemany(_UPSERT, rows)
+        return self.db.total_changes - changes
+
+    def ingest_marc(self, filename: Union[Path, str, BinaryIO]) -> int:
+        """
+        Upserts the records of a marc file, e.g. one written by flatten_mixed_marc;
+        base64 records are decoded, and everything else is stored as it is. Returns the
+        number added or changed.
+        """
+        return self.upsert(record_bytes(chunk) for chunk in iter_marc_records(filename))
+
+    def ingest_csv(self, filename: Union[Path, str], workers: int = 1) -> int:
+        """
+        Upserts the rows of a csv file written by to_csv, converted to marc by to_marc
+        (with `workers`) first. Returns the number of records added or changed.
+        """
+        with TemporaryDirectory() as tmp:
+            marc = Path(tmp) / "records.mrc"
+            to_marc(filename, marc, workers=workers)
+            return self.ingest_marc(marc)
+
+    def delete(self, controls: Iterable[str]) -> int:
+        "Removes the records with these 001s, returning how many there were."
+        with self.db:
+            return self.db.executemany(
+                "DELETE FROM records WHERE control = ?",
+                ((control,) for control in controls),
+            ).rowcount
+
+    def get(self, control: str) -> Optional[bytes]:
+        "The marc bytes of the record with this 001, or None."
+        row = self.db.execute(
+            "SELECT marc FROM records WHERE control = ?", (control,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _where(self, filters: dict[str, Optional[str]]) -> Tuple[str, list[str]]:
+        "the sql condition and parameters for records() filters"
+        conditions, params = [], []
+        for column, value in filters.items():
+            if column not in COLUMNS:
+                raise ValueError(
+                    f"Can't look records up by {column!r}, "
+                    f"only by {', '.join(COLUMNS)}."
+                )
+            if value is None:
+                continue
+            if value.endswith("*"):
+                # glob with a plain prefix uses the index, like a range
+                conditions.append(f"{column} GLOB ?")
+                params.append(_GLOB_SPECIAL.sub(r"[\1]", value[:-1]) + "*")
+            else:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+    def _select(
+        self, columns: str, filters: dict[str, Optional[str]]
+    ) -> Generator[tuple]:
+        where, params = self._where(filters)
+        cursor = self.db.execute(
+            f"SELECT {columns} FROM records{where} ORDER BY id", params
+        )
+        while rows := cursor.fetchmany(1000):
+            yield from rows
+
+    def records(self, **filters: Optional[str]) -> Generator[bytes]:
+        """
+        The marc bytes of the records matching all the filters, in the order they were
+        first added, read as they are needed. Filters are columns (see COLUMNS) and
+        values, which match exactly, or with a trailing *, as a prefix:
+        records(call_number="PA 6121*", author="Horace").
+        """
+        return (row[0] for row in self._select("marc", filters))
+
+    def count(self, **filters: Optional[str]) -> int:
+        "The number of records matching the filters (see records())."
+        where, params = self._where(filters)
+        return self.db.execute(
+            f"SELECT count(*) FROM records{where}", params
+        ).fetchone()[0]
+
+    def export_marc(
+        self, dest: Union[Path, str, BinaryIO], **filters: Optional[str]
+    ) -> int:
+        """
+        Writes the records matching the filters (see records()) to a marc file, or a
+        binary stream, returning the number written.
+        """
+        written = 0
+        with nullcontext(dest) if hasattr(dest, "write") else open(dest, "wb") as f:
+            for record in self.records(**filters):
+                f.write(record)
+                written += 1
+        return written
+
+    def export_csv(
+        self,
+        dest: Union[Path, str, TextIO],
+        include_indicator=True,
+        **filters: Optional[str],
+    ) -> int:
+        """
+        Writes the records matching the filters (see records()) to a csv file as to_csv
+        would, with a column for each tag they use, which the store knows without
+        reading the records. The records should be utf8, e.g. from flatten_mixed_marc.
+        Returns the number written.
+        """
+        tags = set()
+        for (record_tags,) in self._select("tags", filters):
+            tags.update(record_tags.split())
+        # every entry should have a leader, which isn't in the record directory
+        columns = sorted(tags | {"LDR"})
+        written = 0
+        with nullcontext(dest) if hasattr(dest, "write") else open(dest, "w") as f:
+            writer = csv.DictWriter(f, columns, extrasaction="ignore")
+            writer.writeheader()
+            for record in self.records(**filters):
+                writer.writerow(_csv_row_bytes(record, include_indicator))
+                written += 1
+        return written
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self) -> "CatalogueStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _parse_args(args: Optional[Iterable[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Keep a catalogue in a SQLite store, and get records out of it."
+    )
+    parser.add_argument(
+        "store", help="SQLite file of the store, created if it isn't there"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser(
+        "ingest", help="add or update the records of marc or csv files"
+    )
+    ingest.add_argument(
+        "files", nargs="+", help="marc files, or csv files written by to_csv (.csv)"
+    )
+    ingest.add_argument(
+        "--workers", type=int, default=1, help="processes for converting csv to marc"
+    )
+    get = commands.add_parser("get", help="write the record with a 001 to stdout")
+    get.add_argument("control")
+    export = commands.add_parser("export", help="write records to a marc or csv file")
+    export.add_argument(
+        "dest", help="marc file, csv file (.csv), or - for marc to stdout"
+    )
+    for column in COLUMNS:
+        export.add_argument(
+            f"--{column.replace('_', '-')}",
+            help=f"only records with this {column}, or a prefix of it ending in *",
+        )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    with CatalogueStore(args.store) as store:
+        if args.command == "ingest":
+            for filename in args.files:
+                if filename.endswith(".csv"):
+                    changed = store.ingest_csv(filename, args.workers)
+                else:
+                    changed = store.ingest_marc(filename)
+                print(
+                    f"{filename}: {changed} records added or changed", file=sys.stderr
+                )
+            print(f"{len(store)} records in {args.store}", file=sys.stderr)
+        elif args.command == "get":
+            record = store.get(args.control)
+            if record is None:
+                sys.exit(f"No record with 001 {args.control}.")
+            sys.stdout.buffer.write(record)
+        else:
+            filters = {column: getattr(args, column) for column in COLUMNS}
+            if args.dest.endswith(".csv"):
+                written = store.export_csv(args.dest, **filters)
+            else:
+                written = store.export_marc(
+                    sys.stdout.buffer if args.dest == "-" else args.dest, **filters
+                )
+            print(f"exported {written} records", file=sys.stderr)
@@ -0,0 +1,67 @@
+from pathlib import Path
+
+from catalogue_store import CatalogueStore, record_columns
+from csv_converter import to_csv
+from testing import run_tests
+from utils import iter_marc_records, record_bytes
+
+HERE = Path(__file__).parent
+
+
+def test_catalogue_store(tmp_path):
+    source = HERE / "PGA-Australiana_fromCSV.mrc"
+    # these records have no 001, so they are keyed
+    # by their hash, and repeats are stored once
+    records = list(
+        dict.fromkeys(record_bytes(chunk) for chunk in iter_marc_records(source))
+    )
+    with CatalogueStore(tmp_path / "store.db", batch_size=1000) as store:
+        assert store.ingest_marc(source) == len(store) == len(records)
+        # nothing has changed the second time
+        assert store.ingest_marc(source) == 0
+        record = next(
+            record
+            for record in records
+            if record_columns(record)[2] and record_columns(record)[3]
+        )
+        control, isbn, title, author, call_number, tags = record_columns(record)
+        assert control.startswith("sha1:") and "245" in tags.split()
+        # nor do they have an isbn or a call number
+        assert isbn is None and call_number is None
+        assert store.get(control) == record
+        assert record in store.records(title=title, author=author)
+        assert store.count(author=author, isbn="*") == 0
+        prefix = title[:6]
+        expected = [
+            record
+            for record in records
+            if (record_columns(record)[2] or "").startswith(prefix)
+        ]
+        assert list(store.records(title=prefix + "*")) == expected
+        assert store.export_marc(tmp_path / "subset.mrc", title=prefix + "*") == len(
+            expected
+        )
+        assert (tmp_path / "subset.mrc").read_bytes() == b"".join(expected)
+        to_csv(tmp_path / "subset.mrc", tmp_path / "expected.csv")
+        store.export_csv(tmp_path / "subset.csv", title=prefix + "*")
+        assert (tmp_path / "subset.csv").read_text() == (
+            tmp_path / "expected.csv"
+        ).read_text()
+        assert store.delete([control]) == 1 and store.get(control) is None
+    # the store is kept, and records are upserted by 001
+    with CatalogueStore(tmp_path / "store.db") as store:
+        assert len(store) == len(records) - 1
+    to_csv(HERE / "UTF8_librarything_UMClassics.marc", tmp_path / "lt.csv")
+    with CatalogueStore(":memory:") as lt:
+        assert lt.ingest_csv(tmp_path / "lt.csv") == len(lt) > 0
+        first = next(lt.records())
+        changed = first.replace(b"LOEB", b"BEOL")
+        assert lt.upsert([changed]) == 1 and lt.get(record_columns(first)[0]) == changed
+        assert (
+            lt.count(call_number="PA*") == 0
+            and lt.count(control=record_columns(first)[0]) == 1
+        )
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -0,0 +1,148 @@
+# codec for the csv cells that csv_converter writes
+# marc fields to, e.g. "\1$aTitle. $bSubtitle"
+#
+# A data field is written as its two indicators, with "\" for a blank one (unless
+# indicators are left out), followed by its subfields as "$<code><value>", separated by
+# single spaces. A literal "$" in a value is written as "$$", so that it can't be
+# mistaken for the start of a subfield. A control field (001-009) is written as its
+# data, as it is.
+#
+# Fields are either raw, i.e. the text of the field in the marc record, with indicators
+# and "\x1f" before each subfield but without the field terminator, or a tuple (ind1,
+# ind2, [(code, value), ...]); control fields are their data in both cases.
+
+import re
+from collections.abc import Iterable
+from typing import Optional, Tuple, Union
+
+import pandas as pd
+
+import instrumentation
+
+DataField = Tuple[str, str, list[Tuple[str, str]]]
+CellField = Union[str, DataField]
+
+BLANK = "\\"
+# a subfield: "$" or the unit separator, its code, and its value, in which "$" only
+# appears as "$$"
+_SUBFIELD = re.compile(r"[$\x1f]([^$\x1f])((?:[^$\x1f]|\$\$)*)")
+
+
+def _from_raw(raw: str) -> DataField:
+    subfields = raw[2:].split("\x1f")[1:]
+    return raw[0], raw[1], [(s[0], s[1:]) for s in subfields if s]
+
+
+def encode_cell(
+    field: CellField, control=False, include_indicator=True, raw=False
+) -> str:
+    """
+    Writes a field as a csv cell. With raw=True, `field` is the raw text of the field in
+    the record, otherwise a tuple (ind1, ind2, subfields). Empty subfields are left out,
+    as pymarc does.
+    """
+    if control:
+        return field
+    if not raw:
+        ind1, ind2, subfields = field
+        text = " ".join(
+            [
+                f"${code}{value.replace('$', '$$') if '$' in value else value}"
+                for code, value in subfields
+            ]
+        )
+        if not include_indicator:
+            return text
+        return (
+            (ind1 or BLANK).replace(" ", BLANK)
+            + (ind2 or BLANK).replace(" ", BLANK)
+            + text
+        )
+    # pymarc keeps the first two characters before the first subfield as indicators
+    start = field.find("\x1f")
+    head, body = (field, "") if start < 0 else (field[:start], field[start:])
+    if "$" in body:
+        body = body.replace("$", "$$")
+    if "\x1f\x1f" in body or body.endswith("\x1f"):
+        body = "".join(f"\x1f{s}" for s in body.split("\x1f") if s)
+    text = body.replace("\x1f", " $")[1:]
+    if not include_indicator:
+        return text
+    return (head + "  ")[:2].replace(" ", BLANK) + text
+
+
+def decode_cell(cell: Optional[str], control=False, raw=False) -> Optional[CellField]:
+    """
+    Reads a csv cell back into a field, raw (see encode_cell) with
+    raw=True, or a tuple otherwise. Empty cells are None. Cells whose
+    subfields start with the unit separator rather than "$", as some marc
+    files have them, are read as well, and so are cells without indicators.
+    """
+    if not isinstance(cell, str) or not cell:
+        return None
+    if control:
+        return cell
+    i = cell.find("$")
+    j = cell.find("\x1f")
+    if i < 0 or 0 <= j < i:
+        i = j
+    if i < 0:
+        head, body = (cell, "") if len(cell) <= 2 else ("", "$" + cell)
+    elif i > 2:
+        # no indicators, and the text before the first "$" is a subfield of its own
+        head, body = "", "$" + cell
+    else:
+        head, body = cell[:i], cell[i:]
+    indicators = (head + "  ")[:2].replace(BLANK, " ")
+    fast = None
+    if "$$" not in body and "\x1f" not in body:
+        # every "$" starts a subfield, so there's nothing to unescape, and if they all
+        # follow a separating space, replacing those gives the raw field straight away
+        fast = body[1:].replace(" $", "\x1f")
+    if not body:
+        field = indicators
+    elif fast and "$" not in fast:
+        field = indicators + "\x1f" + fast
+    else:
+        matches = _SUBFIELD.findall(body)
+        subfields = []
+        for n, (code, value) in enumerate(matches):
+            # the space that separates a subfield from
+            # the next "$" isn't part of its value
+            if n + 1 < len(matches) and value.endswith(" ") and "\x1f" not in body:
+                value = value[:-1]
+            subfields.append(f"\x1f{code}{value.replace('$$', '$')}")
+        field = indicators + "".join(subfields)
+    return field if raw else _from_raw(field)
+
+
+def encode_cells(
+    fields: Iterable[Optional[CellField]],
+    control=False,
+    include_indicator=True,
+    raw=False,
+) -> Union[list[Optional[str]], pd.Series]:
+    """
+    encode_cell for a whole column of fields, e.g. a list or a
+    pandas Series, with None for missing fields. A Series
+    gives a Series with the same index, anything else a list.
+    """
+    cells = [
+        None if field is None else encode_cell(field, control, include_indicator, raw)
+        for field in fields
+    ]
+    if isinstance(fields, pd.Series):
+        return pd.Series(cells, index=fields.index, name=fields.name, dtype=object)
+    return cells
+
+
+@instrumentation.timed("decode_cells")
+def decode_cells(
+    cells: Iterable[Optional[str]], control=False, raw=False
+) -> Union[list[Optional[CellField]], pd.Series]:
+    """decode_cell for a whole column of cells, e.g. a list or a pandas Series;
+    empty and missing cells (None or NaN) are None."""
+    fields = [decode_cell(cell, control, raw) for cell in cells]
+    if isinstance(cells, pd.Series):
+        return pd.Series(fields, index=cells.index, name=cells.name, dtype=object)
+    return fields
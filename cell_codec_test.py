@@ -0,0 +1,51 @@
+import random
+
+import pandas as pd
+
+from cell_codec import decode_cell, decode_cells, encode_cell, encode_cells
+from testing import run_tests
+
+
+def _random_field(rng) -> tuple:
+    """
+    a random data field, with values full of the
+    characters that matter to the cell format
+    """
+    alphabet = "ab $\\\x1e\nà"
+    return (
+        rng.choice(" 0123456789"),
+        rng.choice(" 0123456789"),
+        [
+            (
+                rng.choice("abcdefghijklmnopqrstuvwxyz0123456789 "),
+                "".join(rng.choice(alphabet) for _ in range(rng.randrange(8))),
+            )
+            for _ in range(rng.randrange(5))
+        ],
+    )
+
+
+def test_cell_codec_round_trip():
+    rng = random.Random(0)
+    fields = [_random_field(rng) for _ in range(5000)]
+    cells = encode_cells(fields)
+    assert decode_cells(cells) == fields
+    for field, cell in zip(fields, cells):
+        raw = decode_cell(cell, raw=True)
+        assert encode_cell(raw, raw=True) == cell
+        # without indicators, the subfields still come back exactly
+        if field[2]:
+            cell = encode_cell(field, include_indicator=False)
+            assert decode_cell(cell)[2] == field[2]
+    series = pd.Series(cells[:10] + [None], index=range(10, 21))
+    decoded = decode_cells(series)
+    assert list(decoded.index) == list(series.index)
+    assert decoded.iloc[-1] is None
+    assert decode_cells(["\\\\$aUS$$5 $bx"]) == [
+        (" ", " ", [("a", "US$5"), ("b", "x")])
+    ]
+    assert decode_cell("$a12$$", control=True) == "$a12$$"
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -1,68 +1,161 @@
 # script to convert between csv and marc formats
 
+import argparse
 import csv
+import io
+import locale
+import mmap
+import os
+import shutil
 import sys
+from collections.abc import Generator, Iterable, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, nullcontext
+from functools import partial
 from pathlib import Path
-from typing import Union
+from tempfile import TemporaryDirectory
+from typing import BinaryIO, Optional, Tuple, Union
 
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pymarc import MARCReader
 from pymarc import exceptions as exc
 from pymarc import Record, Field, Subfield, Indicators, Leader
 
+import instrumentation
+from cell_codec import decode_cells, encode_cell
+from utils import (
+    MarcIndex,
+    RecordView,
+    collect_tags,
+    detect_encoding,
+    find_fields,
+    iter_marc_records,
+    iter_record_views,
+    record_bytes,
+)
+from validation import Issue, Validator
 
-def to_csv(
-    filepath: Union[str, Path], dest: Union[str, Path], include_indicator=True
-) -> None:
-    """function to convert marc file to csv file.
-    To include indicators in format <indicators>$<field>, pass include_indicator=True,
-    this is mainly to facilitate converting back to marc format.
+
+@instrumentation.timed("csv_row")
+def _csv_row(marc_record: Union[Record, RecordView], include_indicator=True) -> dict:
+    """
+    turns a pymarc Record (or a RecordView) into a row for the csv file, keyed by tag.
+    Cells are written with cell_codec: indicators, with "\\" for blanks if
+    include_indicator=True, then "$<code><value>" for each subfield, and the data as it
+    is for control fields.
     """
+    if isinstance(marc_record, RecordView) and marc_record.utf8:
+        return _utf8_csv_row(
+            bytes(marc_record.data[:24]).decode("ascii"),
+            marc_record.raw_fields(),
+            include_indicator,
+            marc_record.utf8_handling,
+        )
+    csv_record = {}
+    leader = marc_record.leader.leader
+    csv_record["LDR"] = leader
+    for marc_field in marc_record.get_fields():
+        if marc_field.is_control_field():
+            csv_record[marc_field.tag] = marc_field.data
+            continue
+        field = (
+            marc_field.indicator1,
+            marc_field.indicator2,
+            [(s.code, s.value) for s in marc_field.subfields],
+        )
+        csv_record[marc_field.tag] = encode_cell(
+            field, include_indicator=include_indicator
+        )
+    return csv_record
+
+
+def _record_fields(
+    record: bytes, errors="replace"
+) -> Generator[Tuple[str, str, str, Optional[str], Optional[list[Tuple[str, str]]]]]:
+    """
+    reads the fields of a utf8 marc record straight from its bytes,
+    the way pymarc parses them, as (tag, ind1, ind2, data,
+    subfields): data for control fields (001-009), with empty
+    indicators, and a list of (code, value) subfields for the rest.
+    """
+    base = int(record[12:17])
+    for i in range(24, base - 12, 12):
+        tag = record[i : i + 3].decode("ascii")
+        start = base + int(record[i + 7 : i + 12])
+        data = record[start : start + int(record[i + 3 : i + 7]) - 1]
+        if tag < "010" and tag.isdigit():
+            yield tag, "", "", data.decode("utf8", errors), None
+            continue
+        subs = data.decode("utf8", errors).split("\x1f")
+        indicators = (subs[0] + "  ")[:2]
+        yield (
+            tag,
+            indicators[0],
+            indicators[1],
+            None,
+            [(s[0], s[1:]) for s in subs[1:] if s],
+        )
+
+
+def _utf8_csv_row(
+    leader: str,
+    fields: Iterable[Tuple[str, Union[bytes, memoryview]]],
+    include_indicator=True,
+    errors="replace",
+) -> dict:
+    """
+    a csv row from the leader and the (tag, data) of each field of a utf8 record. The
+    text of a utf8 field is what cell_codec reads raw, so it needn't be split into
+    subfields.
+    """
+    csv_record = {"LDR": leader}
+    for tag, data in fields:
+        csv_record[tag] = encode_cell(
+            bytes(data).decode("utf8", errors),
+            control=tag < "010" and tag.isdigit(),
+            include_indicator=include_indicator,
+            raw=True,
+        )
+    return csv_record
 
-    # create and get name of new file with all base64 converted to regular utf8
-    with open(filepath, "rb") as f:
-        reader = MARCReader(f, to_unicode=True)
 
-        csv_records = []
-        # every entry should have a leader as first line,
-        # and leader is not include in marc_record.get_fields, so handled separately
-        marc_tags = ["LDR"]
+def _raw_fields(record: bytes) -> Generator[Tuple[str, bytes]]:
+    "(tag, data) of every field of a marc record, without its terminator."
+    base = int(record[12:17])
+    for i in range(24, base - 12, 12):
+        start = base + int(record[i + 7 : i + 12])
+        yield (
+            record[i : i + 3].decode("ascii"),
+            record[start : start + int(record[i + 3 : i + 7]) - 1],
+        )
 
+
+@instrumentation.timed("csv_row")
+def _csv_row_bytes(record: bytes, include_indicator=True) -> dict:
+    "same as _csv_row, for a utf8 marc record that hasn't been parsed by pymarc."
+    return _utf8_csv_row(
+        record[:24].decode("ascii"), _raw_fields(record), include_indicator
+    )
+
+
+@instrumentation.timed_iter("pymarc")
+def iter_records(filepath: Union[str, Path], start: int = 0) -> Generator[Record]:
+    """
+    Generator of the records in a marc file, from byte `start` on (which should be the
+    start of a record), reporting records that can't be read.
+    """
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        reader = MARCReader(f, to_unicode=True)
         for i, marc_record in enumerate(reader):
-            csv_record = {}
-            if not marc_record:
-                print(f"warning: record {i} skipped")
             if marc_record:
-                leader = marc_record.leader.leader
-                csv_record["LDR"] = leader
-                for marc_field in marc_record.get_fields():
-                    if marc_field.tag not in marc_tags:
-                        marc_tags.append(marc_field.tag)
-                    # deal with indicators, if applicable
-                    if include_indicator:
-                        indicator1 = (
-                            marc_field.indicator1
-                            if marc_field.indicator1 != " "
-                            else "\\"
-                        )
-                        indicator2 = (
-                            marc_field.indicator2
-                            if marc_field.indicator2 != " "
-                            else "\\"
-                        )
-                        if not indicator1:
-                            indicator1 = "\\"
-                        if not indicator2:
-                            indicator2 = "\\"
-                        csv_record[marc_field.tag] = (
-                            f"{indicator1}{indicator2}{' '.join([f'${s.code}{s.value}' for s in marc_field.subfields])}"
-                        )
-                    else:
-                        csv_record[marc_field.tag] = " ".join(
-                            [f"${s.code}{s.value}" for s in marc_field.subfields]
-                        )
-
-                csv_records.append(csv_record)
-            elif isinstance(reader.current_exception, exc.FatalReaderError):
+                yield marc_record
+                continue
+            instrumentation.count("skipped")
+            print(f"warning: record {i} skipped")
+            if isinstance(reader.current_exception, exc.FatalReaderError):
                 # data file format error
                 # reader will raise StopIteration
                 print(reader.current_exception)
@@ -73,66 +166,662 @@ def to_csv(
                 print(reader.current_chunk)
                 # break/continue/raise
 
-    marc_tags.sort()
 
-    print(",".join(['"%s"' % tag for tag in marc_tags]))
-    writer = csv.DictWriter(sys.stdout, marc_tags)
-    writer.writerows(csv_records)
+def iter_csv_rows(
+    filepath: Union[str, Path],
+    include_indicator=True,
+    validator: Optional[Validator] = None,
+) -> Generator[dict]:
+    """
+    Generator of csv rows for the records in a marc file, read as RecordViews (and
+    checked by validator).
+    """
+    for view in iter_record_views(
+        filepath, utf8_handling="replace", validator=validator
+    ):
+        yield _csv_row(view, include_indicator)
 
-    with open(dest, "w") as f:
-        file_writer = csv.DictWriter(f, marc_tags)
-        file_writer.writeheader()
-        file_writer.writerows(csv_records)
 
+@instrumentation.timed("to_csv")
+def to_csv(
+    filepath: Union[str, Path],
+    dest: Union[str, Path],
+    include_indicator=True,
+    columns: Optional[Sequence[str]] = None,
+    index: Optional[MarcIndex] = None,
+    echo=False,
+    validator: Optional[Validator] = None,
+) -> None:
+    """
+    function to convert marc file to csv file. To include indicators in format
+    <indicators>$<field>, pass include_indicator=True, this is mainly to facilitate
+    converting back to marc format. Rows are written as records are read, so only one
+    record is held in memory at a time. The columns are either given by `columns`, in
+    which case fields with other tags are left out, or collected in a cheap first pass
+    over the record directories (using `index` if given). Pass echo=True to also write
+    the csv to stdout, and a validation.Validator to check each record as it is read;
+    its issues hold the problems found afterwards. The csv is always written as utf8,
+    with \r\n line endings whatever the platform.
+    """
+    if columns is None:
+        # every entry should have a leader, which isn't in the record directory
+        columns = sorted(collect_tags(filepath, index) | {"LDR"})
+    columns = list(columns)
 
-def to_marc(filepath: Union[str, Path], dest: Union[str, Path]) -> None:
+    with open(dest, "w", encoding="utf8", newline="") as f:
+        writers = [csv.DictWriter(f, columns, extrasaction="ignore")]
+        if echo:
+            writers.append(csv.DictWriter(sys.stdout, columns, extrasaction="ignore"))
+        for writer in writers:
+            writer.writeheader()
+        for csv_record in iter_csv_rows(filepath, include_indicator, validator):
+            for writer in writers:
+                writer.writerow(csv_record)
+
+
+# leader positions loaded by marc_to_dataframe by default:
+# record status, type of record, bibliographic level, character
+# coding scheme, encoding level and descriptive cataloguing form
+LEADER_POSITIONS = (5, 6, 7, 9, 17, 18)
+
+
+def marc_to_dataframe(
+    filepath: Union[str, Path],
+    fields: Sequence[str] = (),
+    subfields: Sequence[str] = (),
+    leader_positions: Sequence[int] = LEADER_POSITIONS,
+    indicators=True,
+    encoding="auto",
+    errors="replace",
+) -> pd.DataFrame:
     """
-    Function to convert csv file to marc file. Assumes that csv file has the format
-    output by to_csv above. Not yet tested.
-    """
-    with open(filepath, "r") as f:
-        reader = csv.DictReader(f)
-        for line in reader:
-            record = Record()
-            for tag in line.keys():
-                if tag.upper() == "LDR" or tag.lower() == "leader":
-                    record.leader = Leader(line[tag])
-                    continue
-                # some marc files use the unit separator with unicode value 31, control picture ␟,
-                # to mark beginning of a subfield, so first we replace this with $
-                line[tag] = line[tag].replace(chr(31), "$")
-                if "$" in line[tag][:3]:
-                    indicators, field_text = line[tag].split("$", maxsplit=1)
-                    indicators = indicators.replace(" ", "\\")
-                    indicators = [char for char in indicators][:2]
-                else:
-                    indicators, field_text = (["\\", "\\"], line[tag])
-                field_text = field_text.strip()
-                subfields = (
-                    [Subfield(code=s[0], value=s[1:]) for s in field_text.split("$")]
-                    if field_text
-                    else []
+    Loads a marc file (plain, or mixed with base64 records) straight into a DataFrame,
+    with one row per record and only the requested columns:
+    - LDR, and LDR/<pos> for each position in leader_positions
+    - <tag> for each tag in fields, formatted as in to_csv without indicators, i.e.
+      "$a... $b...", or the data for control fields; with indicators=True also
+      <tag>_ind1 and <tag>_ind2
+    - <tag>$<code> for each subfield in subfields, e.g. "245$a", holding its first value
+    Only the requested fields are decoded, everything else is skipped via the record
+    directory. Repeated fields are taken from their first occurrence. Leader positions
+    and indicators are categorical, since they have few distinct values. Plain records
+    are decoded with `encoding`, base64 records are always utf8; by default ("auto"),
+    the encoding of every record is found with detect_encoding, so that the latin-1
+    records in librarything exports load as they do in flatten_mixed_marc.
+    """
+    wanted = {}  # tag -> list of subfield codes, or None for the whole field
+    for tag in fields:
+        wanted[tag.encode("ascii")] = None
+    for spec in subfields:
+        tag, code = spec.split("$")
+        codes = wanted.setdefault(tag.encode("ascii"), [])
+        if codes is not None:
+            codes.append(code)
+    controls = {tag for tag in fields if tag < "010" and tag.isdigit()}
+    field_columns = {tag: [] for tag in fields}
+    indicator_columns = (
+        {f"{tag}_ind{n}": [] for tag in fields if tag not in controls for n in (1, 2)}
+        if indicators
+        else {}
+    )
+    subfield_columns = {spec: [] for spec in subfields}
+    leaders = []
+
+    for chunk in iter_marc_records(filepath):
+        record = record_bytes(chunk)
+        leaders.append(record[:24].decode("ascii", errors="replace"))
+        found = {}
+        for tag, data in find_fields(record, wanted.keys()):
+            found.setdefault(tag.decode("ascii"), data)
+        codec = (
+            detect_encoding(record)
+            if encoding == "auto"
+            else ("utf8" if chunk.base64 else encoding)
+        )
+        for tag, column in field_columns.items():
+            data = found.get(tag)
+            if data is None:
+                column.append(None)
+                if tag not in controls and indicators:
+                    indicator_columns[f"{tag}_ind1"].append(None)
+                    indicator_columns[f"{tag}_ind2"].append(None)
+                continue
+            if tag in controls:
+                column.append(data.decode(codec, errors))
+                continue
+            column.append(
+                encode_cell(
+                    data.decode(codec, errors), include_indicator=False, raw=True
                 )
-                field = Field(
+            )
+            if indicators:
+                # whatever comes before the first subfield, which may be short
+                head = data.partition(b"\x1f")[0]
+                indicator_columns[f"{tag}_ind1"].append(head[:1].decode(codec, errors))
+                indicator_columns[f"{tag}_ind2"].append(head[1:2].decode(codec, errors))
+        for spec, column in subfield_columns.items():
+            tag, code = spec.split("$")
+            data = found.get(tag)
+            value = None
+            if data is not None:
+                prefix = code.encode("ascii")
+                for s in data.split(b"\x1f")[1:]:
+                    if s[:1] == prefix:
+                        value = s[1:].decode(codec, errors)
+                        break
+            column.append(value)
+
+    df = pd.DataFrame({"LDR": leaders, **field_columns, **subfield_columns})
+    for pos in leader_positions:
+        df[f"LDR/{pos:02d}"] = pd.Categorical(df["LDR"].str[pos])
+    for name, column in indicator_columns.items():
+        df[name] = pd.Categorical(column)
+    return df
+
+
+# parquet schema: one list of fields per tag, so that repeated fields are kept, with
+# indicators and subfields for data fields, and the data of control fields (001-009)
+SUBFIELD_TYPE = pa.struct([("code", pa.string()), ("value", pa.string())])
+FIELD_TYPE = pa.struct(
+    [
+        ("ind1", pa.string()),
+        ("ind2", pa.string()),
+        ("data", pa.string()),
+        ("subfields", pa.list_(SUBFIELD_TYPE)),
+    ]
+)
+
+
+def parquet_schema(tags: Sequence[str]) -> "pa.Schema":
+    "Schema for to_parquet, with the leader and a column for each tag in tags."
+    return pa.schema(
+        [("LDR", pa.string())]
+        + [(tag, pa.list_(FIELD_TYPE)) for tag in tags if tag != "LDR"]
+    )
+
+
+@instrumentation.timed("parquet_row")
+def _parquet_row(marc_record: Union[Record, RecordView]) -> dict:
+    "turns a pymarc Record (or a RecordView) into a row for to_parquet, keyed by tag."
+    if isinstance(marc_record, RecordView) and marc_record.utf8:
+        return _parquet_row_bytes(marc_record.as_marc(), marc_record.utf8_handling)
+    row = {"LDR": marc_record.leader.leader}
+    for marc_field in marc_record.get_fields():
+        if marc_field.is_control_field():
+            value = {
+                "ind1": None,
+                "ind2": None,
+                "data": marc_field.data,
+                "subfields": None,
+            }
+        else:
+            value = {
+                "ind1": marc_field.indicator1,
+                "ind2": marc_field.indicator2,
+                "data": None,
+                "subfields": [
+                    {"code": s.code, "value": s.value} for s in marc_field.subfields
+                ],
+            }
+        row.setdefault(marc_field.tag, []).append(value)
+    return row
+
+
+@instrumentation.timed("parquet_row")
+def _parquet_row_bytes(record: bytes, errors="replace") -> dict:
+    "same as _parquet_row, for a utf8 marc record that hasn't been parsed by pymarc."
+    row = {"LDR": record[:24].decode("ascii")}
+    for tag, ind1, ind2, data, subfields in _record_fields(record, errors):
+        if subfields is None:
+            value = {"ind1": None, "ind2": None, "data": data, "subfields": None}
+        else:
+            value = {
+                "ind1": ind1,
+                "ind2": ind2,
+                "data": None,
+                "subfields": [{"code": c, "value": v} for c, v in subfields],
+            }
+        row.setdefault(tag, []).append(value)
+    return row
+
+
+@instrumentation.timed("to_parquet")
+def to_parquet(
+    filepath: Union[str, Path],
+    dest: Union[str, Path],
+    columns: Optional[Sequence[str]] = None,
+    index: Optional[MarcIndex] = None,
+    batch_size: int = 10_000,
+    validator: Optional[Validator] = None,
+) -> None:
+    """
+    function to convert marc file to a parquet file, with one row per record. The leader
+    is in column LDR, and every tag has a column holding a list of its fields, each with
+    indicators (ind1, ind2) and a list of (code, value) subfields, or the data of a
+    control field, so everything needed to convert back to marc is kept. As for to_csv,
+    the columns are either `columns` or collected from the record directories, and rows
+    are written in row groups of batch_size records, so memory use stays bounded, and
+    records are checked by `validator` as they are read.
+    """
+    if columns is None:
+        columns = sorted(collect_tags(filepath, index))
+    schema = parquet_schema(columns)
+    with pq.ParquetWriter(dest, schema) as writer:
+        rows = []
+        for view in iter_record_views(
+            filepath, utf8_handling="replace", validator=validator
+        ):
+            rows.append(_parquet_row(view))
+            if len(rows) == batch_size:
+                writer.write_table(pa.Table.from_pylist(rows, schema))
+                rows = []
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema))
+
+
+def read_catalogue(
+    filepath: Union[str, Path], columns: Optional[Sequence[str]] = None
+) -> pd.DataFrame:
+    """
+    Loads a parquet file written by to_parquet into a DataFrame. Columns stay backed by
+    arrow, which makes loading fast even for the nested tag columns.
+    """
+    return pd.read_parquet(filepath, columns=columns, dtype_backend="pyarrow")
+
+
+def _parquet_to_record(row: dict) -> Record:
+    "builds a pymarc Record from a row written by to_parquet."
+    record = Record()
+    for tag, fields in row.items():
+        if tag == "LDR":
+            record.leader = Leader(fields)
+            continue
+        for value in fields or []:
+            if value["subfields"] is None:
+                record.add_field(Field(tag=tag, data=value["data"]))
+                continue
+            record.add_field(
+                Field(
                     tag=tag,
-                    indicators=Indicators(*indicators),
-                    subfields=subfields,
+                    indicators=Indicators(value["ind1"], value["ind2"]),
+                    subfields=[
+                        Subfield(code=s["code"], value=s["value"])
+                        for s in value["subfields"]
+                    ],
                 )
-                record.add_field(field)
+            )
+    return record
 
-                print(record.__str__())
-                with open(dest, "ab") as out:
-                    out.write(record.as_marc())
 
+def parquet_to_marc(
+    filepath: Union[str, Path], dest: Union[str, Path], batch_size: int = 10_000
+) -> None:
+    "Function to convert a parquet file written by to_parquet back to a marc file."
+    with open(dest, "wb") as out:
+        for batch in pq.ParquetFile(filepath).iter_batches(batch_size):
+            out.write(
+                b"".join(_parquet_to_record(row).as_marc() for row in batch.to_pylist())
+            )
+
+
+def _marc_bytes(leader: str, fields: list[Tuple[str, str]]) -> bytes:
+    """
+    serializes a record as utf8 marc from its leader and (tag, field) pairs, with each
+    field raw as in cell_codec. Whatever the leader's position 9 (character coding
+    scheme) says, it is set to "a" and the fields are encoded as utf8, which is what
+    the pymarc Records that to_marc used to build wrote too: a Record made with
+    to_unicode=True, the default, marks itself as utf8 in as_marc. Latin-1 text is
+    already decoded in the csv, so it comes out as utf8, with its leader saying so.
+    """
+    directory = []
+    data = []
+    offset = 0
+    for tag, field in fields:
+        encoded = f"{field}\x1e".encode("utf8")
+        if len(encoded) > 9999:
+            raise ValueError(f"field {tag} is longer than 9999 bytes")
+        directory.append(f"{tag:0>3}{len(encoded):04d}{offset:05d}")
+        data.append(encoded)
+        offset += len(encoded)
+    # the directory ends with a field terminator, and the data with a record terminator
+    base = 24 + 12 * len(directory) + 1
+    leader = leader if len(leader) == 24 else " " * 24
+    if base + offset + 1 > 99999:
+        raise ValueError("record is longer than 99999 bytes")
+    leader = (
+        f"{base + offset + 1:0>5}{leader[5:9]}a{leader[10:12]}{base:0>5}{leader[17:]}"
+    )
+    return (
+        (leader + "".join(directory) + "\x1e").encode("utf8") + b"".join(data) + b"\x1d"
+    )
+
+
+@instrumentation.timed("rows_to_marc")
+def _rows_to_marc(
+    rows: list[dict], verbose=False, skipped: Optional[list[Tuple[int, str]]] = None
+) -> bytes:
+    """
+    serializes a batch of csv rows in the format output by to_csv to marc, one record
+    per row. The cells are decoded a column at a time with cell_codec, straight into raw
+    marc fields. Rows that can't be a marc record (a field or the record is too long for
+    marc's lengths) raise ValueError, or, if a `skipped` list is passed, are left out
+    and added to it as (index, reason).
+    """
+    if not rows:
+        return b""
+    leaders = [""] * len(rows)
+    columns = []
+    for tag in rows[0].keys():
+        cells = [line.get(tag) for line in rows]
+        if tag.upper() == "LDR" or tag.lower() == "leader":
+            leaders = [cell or "" for cell in cells]
+            continue
+        columns.append(
+            (tag, decode_cells(cells, control=tag < "010" and tag.isdigit(), raw=True))
+        )
+    records = []
+    for i, leader in enumerate(leaders):
+        # tags the record doesn't have are empty in the csv
+        fields = [(tag, column[i]) for tag, column in columns if column[i] is not None]
+        try:
+            record = _marc_bytes(leader, fields)
+        except ValueError as e:
+            if skipped is None:
+                raise
+            skipped.append((i, str(e)))
+            continue
+        if verbose:
+            print(Record(data=record).__str__())
+        records.append(record)
+    return b"".join(records)
+
+
+# how much of a csv is searched for quotes at once when splitting it into shards
+_QUOTE_BLOCK = 1 << 24
 
-if __name__ == "__main__":
-    if len(sys.argv) == 0:
-        msg = """
-        "Please provide the filename or path of the marc or csv file you want to convert."
-        """
-        raise ValueError(msg)
 
-    filepath = Path(sys.argv[1])
+def _quotes(data: mmap.mmap, start: int, end: int) -> int:
+    "the number of double quotes in data[start:end]"
+    return sum(
+        data[i : min(i + _QUOTE_BLOCK, end)].count(b'"')
+        for i in range(start, end, _QUOTE_BLOCK)
+    )
+
+
+def _row_end(data: mmap.mmap, pos: int, quoted: bool) -> int:
+    """
+    the end of the csv row that byte `pos` is in, just after the first newline from pos
+    on that isn't in a quoted cell, given whether pos is in one. An escaped quote ("")
+    counts twice, so a newline is between rows if and only if there's an even number of
+    quotes before it.
+    """
+    while True:
+        end = data.find(b"\n", pos)
+        if end < 0:
+            return len(data)
+        quoted ^= _quotes(data, pos, end) % 2 == 1
+        pos = end + 1
+        if not quoted:
+            return pos
+
+
+def csv_shards(
+    filepath: Union[str, Path], parts: int
+) -> Tuple[int, list[Tuple[int, int]]]:
+    """
+    Splits a csv into up to `parts` byte ranges of about the same size that start and
+    end between rows, so that newlines in quoted cells don't split a row, for converting
+    the ranges separately. Returns the end of the header row and the ranges, which cover
+    the rest of the file. Only the quotes are counted, so this is much quicker than
+    reading the csv.
+    """
+    with open(filepath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return 0, []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header_end = pos = _row_end(data, 0, False)
+            ranges = []
+            for i in range(1, parts):
+                target = header_end + (size - header_end) * i // parts
+                if target <= pos:
+                    continue
+                # pos is between rows, so target is in a quoted cell if an odd number of
+                # quotes came since
+                end = _row_end(data, target, _quotes(data, pos, target) % 2 == 1)
+                if end >= size:
+                    break
+                ranges.append((pos, end))
+                pos = end
+    if pos < size:
+        ranges.append((pos, size))
+    return header_end, ranges
+
+
+def _read_lines(f: BinaryIO, size: int, encoding: str) -> Generator[str]:
+    "the lines in the next `size` bytes of f, decoded"
+    for line in f:
+        yield line.decode(encoding)
+        size -= len(line)
+        if size <= 0:
+            return
+
+
+@instrumentation.timed("read_csv")
+def _convert_csv_range(
+    filepath: Union[str, Path],
+    start: int,
+    end: int,
+    out: Union[str, Path, BinaryIO],
+    columns: list[str],
+    flush_size: int = 1000,
+    verbose=False,
+    encoding: Optional[str] = None,
+    validator: Optional[Validator] = None,
+) -> Tuple[int, list[Tuple[int, str]], list[Issue], int]:
+    """
+    converts the csv rows in bytes start to end of filepath (which start and end between
+    rows) to marc, written to `out`, a binary file or a path. Returns the number of
+    lines read, the rows that were skipped as (line, reason), numbered from the first
+    line of the range as 1, and, if `validator` is given, the problems it finds with the
+    records written, at their offset from where the range starts in out, and the number
+    of records it checked. The validator's own issues are left as they are, so that a
+    worker can hand the problems back with the rest of its result.
+    """
+    encoding = encoding or locale.getpreferredencoding(False)
+    skipped, issues = [], []
+    checked = 0
+    with (
+        open(filepath, "rb") as f,
+        nullcontext(out) if hasattr(out, "write") else open(out, "wb") as marc,
+    ):
+        base = marc.tell()
+        f.seek(start)
+        reader = csv.reader(_read_lines(f, end - start, encoding))
+        rows, lines = [], []
+        line = 1
+        for cells in reader:
+            row_line, line = line, reader.line_num + 1
+            if not cells:
+                continue
+            if len(cells) > len(columns):
+                skipped.append(
+                    (
+                        row_line,
+                        f"{len(cells)} cells, "
+                        f"but the header has {len(columns)} columns",
+                    )
+                )
+                continue
+            # short rows just don't have the last tags
+            cells += [""] * (len(columns) - len(cells))
+            rows.append(dict(zip(columns, cells)))
+            lines.append(row_line)
+            if len(rows) == flush_size:
+                records = _rows_to_batch(rows, lines, skipped, verbose)
+                checked += _write_batch(marc, records, validator, issues, base)
+                rows, lines = [], []
+        records = _rows_to_batch(rows, lines, skipped, verbose)
+        checked += _write_batch(marc, records, validator, issues, base)
+    return line - 1, skipped, issues, checked
+
+
+def _write_batch(
+    out: BinaryIO,
+    records: bytes,
+    validator: Optional[Validator],
+    issues: list[Issue],
+    base: int = 0,
+) -> int:
+    """
+    writes a run of records to out, after checking them with validator, whose problems
+    are added to `issues` at the records' offset in out from `base`. Returns the number
+    of records checked.
+    """
+    if validator is None or not records:
+        out.write(records)
+        return 0
+    issues += validator.scan(records, out.tell() - base)
+    out.write(records)
+    return records.count(b"\x1d")
+
+
+def _rows_to_batch(
+    rows: list[dict], lines: list[int], skipped: list[Tuple[int, str]], verbose: bool
+) -> bytes:
+    "_rows_to_marc, adding the rows it skips to `skipped` by line"
+    failed = []
+    records = _rows_to_marc(rows, verbose, failed)
+    skipped.extend((lines[i], reason) for i, reason in failed)
+    skipped.sort()
+    return records
+
+
+def _append_file(out: BinaryIO, path: Union[str, Path]) -> None:
+    """
+    copies the file at path onto the end of out, in
+    the kernel where it can rather than through python
+    """
+    out.flush()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        copied = 0
+        try:
+            if hasattr(os, "copy_file_range"):
+                while copied < size:
+                    n = os.copy_file_range(f.fileno(), out.fileno(), size - copied)
+                    if not n:
+                        break
+                    copied += n
+            elif hasattr(os, "sendfile"):
+                while copied < size:
+                    n = os.sendfile(out.fileno(), f.fileno(), copied, size - copied)
+                    if not n:
+                        break
+                    copied += n
+        except OSError:
+            # e.g. copy_file_range across filesystems on old kernels, or sendfile only
+            # to sockets (macos)
+            pass
+        if copied < size:
+            f.seek(copied)
+            shutil.copyfileobj(f, out)
+
+
+@instrumentation.timed("to_marc")
+def to_marc(
+    filepath: Union[str, Path],
+    dest: Union[str, Path],
+    flush_size: int = 1000,
+    verbose=False,
+    workers: int = 1,
+    validator: Optional[Validator] = None,
+) -> list[Tuple[int, str]]:
+    """
+    Function to convert csv file to marc file. Assumes that csv file has the format
+    output by to_csv above. Each row is serialized straight from its cells, without a
+    pymarc Record, and records are written to dest in batches of flush_size rows
+    through a single handle. Records are always written as utf8, with position 9 of the
+    leader set to "a", as pymarc's Record.as_marc does by default (see _marc_bytes).
+    Rows that can't be a marc record (more cells than columns, or a field or the record
+    too long for marc's lengths) are reported with their line in the csv and left out;
+    returns them as (line, reason). Pass verbose=True to print each record. With workers
+    > 1, the csv is split into shards between rows (see csv_shards), which a pool of
+    that many processes convert to temporary files next to dest, and those are joined in
+    order with copy_file_range (or sendfile); the output is the same. With a
+    validation.Validator, the records are checked as they are built, at their offset
+    in dest; with workers, each worker checks the records of its shards, and hands back
+    the problems with the rows it skipped.
+    """
+    encoding = locale.getpreferredencoding(False)
+    header_end, shards = csv_shards(filepath, 4 * workers if workers > 1 else 1)
+    with open(filepath, "rb") as f:
+        header = f.read(header_end).decode(encoding)
+    columns = next(csv.reader(io.StringIO(header, newline="")), [])
+    for tag in columns:
+        if tag.upper() != "LDR" and tag.lower() != "leader" and not 0 < len(tag) <= 3:
+            raise ValueError(f"Column {tag!r} of {filepath} isn't a marc tag.")
+    convert = partial(
+        _convert_csv_range,
+        filepath,
+        columns=columns,
+        flush_size=flush_size,
+        verbose=verbose,
+        encoding=encoding,
+        validator=validator,
+    )
+    skipped = []
+    # where the shard being joined starts in dest
+    position = 0
+    # lines before the shard being joined
+    line = header.count("\n")
+    with open(dest, "wb") as out, ExitStack() as stack:
+        if workers <= 1:
+            results = (convert(start, end, out) for start, end in shards)
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(workers))
+            tmp = Path(stack.enter_context(TemporaryDirectory(dir=Path(dest).parent)))
+            futures = [
+                pool.submit(convert, start, end, tmp / f"{i}.mrc")
+                for i, (start, end) in enumerate(shards)
+            ]
+            results = (future.result() for future in futures)
+        for i, (lines, problems, issues, checked) in enumerate(results):
+            if workers > 1:
+                _append_file(out, tmp / f"{i}.mrc")
+                os.remove(tmp / f"{i}.mrc")
+            if validator is not None:
+                validator.add(
+                    [(position + offset, *issue) for offset, *issue in issues], checked
+                )
+            position = out.tell()
+            for n, reason in problems:
+                print(f"warning: row at line {line + n} skipped: {reason}")
+                skipped.append((line + n, reason))
+            line += lines
+    instrumentation.count("skipped", len(skipped))
+    return skipped
+
+
+def _parse_args(args: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Convert a marc file to csv, or a csv file back to marc, "
+        "next to the file."
+    )
+    parser.add_argument(
+        "filename", help="the marc (mrc, marc or dat) or csv file to convert"
+    )
+    parser.add_argument(
+        "--profile",
+        help="write a cProfile dump of the conversion here, for pstats, with the time "
+        "spent per stage on stderr",
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    filepath = Path(args.filename)
 
     if not filepath.exists():
         msg = "File does not exists."
@@ -152,16 +841,21 @@ if __name__ == "__main__":
         msg = "File must have mrc, marc, dat, or csv extension"
         raise ValueError(msg)
 
-    # first, handle marc to csv conversion
-
-    if ext == "csv":
-        dest = filepath.parent / f"{filepath.name.split('.')[0]}.{ext}"
-        print(f"dest is {dest}")
-        to_csv(filepath, dest, include_indicator=True)
-        sys.exit()
-    # this refers to the extension for the file to write, i.e. to convert to
+    instrument = (
+        instrumentation.instrumented(sys.stderr, profile=args.profile)
+        if args.profile
+        else nullcontext()
+    )
+    with instrument:
+        # first, handle marc to csv conversion
 
-    # now, handle csv to marc conversion: here, ext is marc, mrc, dat, etc.
-    dest = filepath.parent / f"{filepath.name.split('.')[0]}_fromCSV.{ext}"
-    print(f"dest is {dest}")
-    to_marc(filepath, dest)
+        if ext == "csv":
+            dest = filepath.parent / f"{filepath.name.split('.')[0]}.{ext}"
+            print(f"dest is {dest}")
+            to_csv(filepath, dest, include_indicator=True)
+        else:
+            # now, handle csv to marc conversion: here, ext is the extension of the
+            # file to write, i.e. to convert to
+            dest = filepath.parent / f"{filepath.name.split('.')[0]}_fromCSV.{ext}"
+            print(f"dest is {dest}")
+            to_marc(filepath, dest)
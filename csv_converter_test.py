@@ -0,0 +1,197 @@
+import csv
+from pathlib import Path
+
+import pandas as pd
+from pymarc import Field, Indicators, MARCReader, Record, Subfield
+
+from csv_converter import (
+    _marc_bytes,
+    _rows_to_marc,
+    csv_shards,
+    marc_to_dataframe,
+    parquet_to_marc,
+    read_catalogue,
+    to_csv,
+    to_marc,
+    to_parquet,
+)
+from testing import run_tests
+from utils import iter_marc_records, record_bytes
+
+HERE = Path(__file__).parent
+
+
+def test_csv_round_trip(tmp_path):
+    source = HERE / "PGA-Australiana.mrc"
+    to_csv(source, tmp_path / "pga.csv")
+    to_marc(tmp_path / "pga.csv", tmp_path / "pga.mrc")
+    with open(source, "rb") as f, open(tmp_path / "pga.mrc", "rb") as g:
+        for original, converted in zip(MARCReader(f), MARCReader(g), strict=True):
+            # the csv has one column per tag, so only
+            # the last of any repeated field is kept
+            fields = {field.tag: str(field) for field in original.get_fields()}
+            assert {field.tag: str(field) for field in converted.get_fields()} == fields
+
+
+def test_to_marc_writes_utf8():
+    # a leader with a blank position 9 (marc8 or latin-1) still comes out as utf8, with
+    # the leader saying so, as a pymarc Record with the default to_unicode=True writes
+    row = {
+        "LDR": "00000nam  2200000 i 4500",
+        "001": "r1",
+        "245": "10$aCaf\u00e9 Cr\u00e8me",
+    }
+    record = Record()
+    record.leader = row["LDR"]
+    record.add_field(Field(tag="001", data="r1"))
+    record.add_field(
+        Field(
+            tag="245",
+            indicators=Indicators("1", "0"),
+            subfields=[Subfield("a", "Caf\u00e9 Cr\u00e8me")],
+        )
+    )
+    written = _rows_to_marc([row])
+    assert written == record.as_marc()
+    assert written[9:10] == b"a" and "Caf\u00e9".encode("utf8") in written
+
+
+def test_to_marc_shards(tmp_path):
+    source = tmp_path / "edited.csv"
+    with open(source, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["001", "245", "500"])
+        for i in range(60):
+            # notes over several lines, with quotes, so that most shard boundaries fall
+            # in a quoted cell
+            note = "\\\\$a" + 'Line one,\nline "two"\n' * (i % 4) if i % 4 else ""
+            writer.writerow([f"r{i}", f"10$aTitle {i}", note])
+        writer.writerow(["r60", "10$aToo many cells", "", "extra"])
+        writer.writerow(["r61", "10$a" + "x" * 10_000])
+        writer.writerow(["r62", "10$aLast"])
+    header_end, shards = csv_shards(source, 12)
+    assert len(shards) > 1 and shards[0][0] == header_end
+    for start, end in shards:
+        with open(source, "rb") as f:
+            f.seek(start)
+            assert (
+                len(list(csv.reader(f.read(end - start).decode().splitlines(True)))) > 0
+            )
+    # each repeat of a note takes up two more lines
+    line = 2 + 60 + 2 * sum(i % 4 for i in range(60))
+    skipped = [
+        (line, "4 cells, but the header has 3 columns"),
+        (line + 1, "field 245 is longer than 9999 bytes"),
+    ]
+    assert to_marc(source, tmp_path / "one.mrc") == skipped
+    assert to_marc(source, tmp_path / "sharded.mrc", workers=3) == skipped
+    assert (tmp_path / "one.mrc").read_bytes() == (
+        tmp_path / "sharded.mrc"
+    ).read_bytes()
+    with open(tmp_path / "sharded.mrc", "rb") as f:
+        records = list(MARCReader(f))
+    assert [record["001"].data for record in records] == [
+        f"r{i}" for i in range(60)
+    ] + ["r62"]
+    assert records[3]["500"]["a"] == 'Line one,\nline "two"\n' * 3
+
+
+def test_parquet_round_trip(tmp_path):
+    source = HERE / "UTF8_librarything_UMClassics.marc"
+    to_parquet(source, tmp_path / "lt.parquet", batch_size=1000)
+    df = read_catalogue(tmp_path / "lt.parquet")
+    with open(source, "rb") as f:
+        originals = list(MARCReader(f))
+    assert len(df) == len(originals) and df.columns[0] == "LDR"
+    # repeated fields are all kept, with their indicators and subfields
+    first = df["245"].iloc[0][0]
+    assert (first["ind1"], first["ind2"]) == ("1", "0")
+    assert first["subfields"][0]["value"] == originals[0]["245"]["a"]
+    assert read_catalogue(tmp_path / "lt.parquet", ["LDR", "245"]).shape == (len(df), 2)
+    parquet_to_marc(tmp_path / "lt.parquet", tmp_path / "lt.mrc", batch_size=1000)
+    with open(tmp_path / "lt.mrc", "rb") as f:
+        converted = list(MARCReader(f))
+    assert len(converted) == len(originals)
+    for original, record in zip(originals, converted):
+        # pymarc marks the records it writes as utf8 in leader position 9
+        leader = str(original.leader)
+        assert str(record.leader)[5:] == leader[5:9] + "a" + leader[10:]
+        assert [str(field) for field in record.get_fields()] == [
+            str(field) for field in original.get_fields()
+        ]
+
+
+def test_marc_to_dataframe():
+    # test64.marc is all base64, which is always read as utf8
+    source = HERE / "test64.marc"
+    records = [
+        Record(data=record_bytes(chunk), force_utf8=True)
+        for chunk in iter_marc_records(source)
+    ]
+    df = marc_to_dataframe(
+        source, fields=["001", "245", "700"], subfields=["245$a", "020$a", "100$a"]
+    )
+    assert len(df) == len(records)
+    assert list(df.columns) == [
+        "LDR",
+        "001",
+        "245",
+        "700",
+        "245$a",
+        "020$a",
+        "100$a",
+        *(f"LDR/{pos:02d}" for pos in (5, 6, 7, 9, 17, 18)),
+        "245_ind1",
+        "245_ind2",
+        "700_ind1",
+        "700_ind2",
+    ]
+    for name in ["LDR/06", "LDR/18", "245_ind1", "245_ind2"]:
+        assert isinstance(df[name].dtype, pd.CategoricalDtype)
+    for row, record in zip(df.itertuples(index=False), records):
+        assert row.LDR == str(record.leader)
+        assert row[1] == record["001"].data
+        field = record["245"]
+        assert row[2] == " ".join(f"${s.code}{s.value}" for s in field.subfields)
+        assert (row[-4], row[-3]) == (field.indicator1, field.indicator2)
+        assert pd.isna(row[3]) and pd.isna(row[-2])
+        assert row[4] == field["a"]
+        for value, tag in [(row[5], "020"), (row[6], "100")]:
+            assert value == record[tag]["a"] if tag in record else pd.isna(value)
+    # only the leader, without fields, indicators or leader positions
+    df = marc_to_dataframe(HERE / "PGA-Australiana.mrc", leader_positions=())
+    assert list(df.columns) == ["LDR"] and len(df) == 278
+
+
+def test_marc_to_dataframe_fields(tmp_path):
+    # the latin-1 records of a librarything export are found and decoded as latin-1
+    source = HERE / "LATIN1_librarything_UMClassics.marc"
+    titles = marc_to_dataframe(source, fields=["245"])["245"]
+    assert not titles.str.contains("\ufffd").any()
+    utf8 = marc_to_dataframe(source, fields=["245"], encoding="utf8")["245"]
+    assert utf8.str.contains("\ufffd").any()
+    # a tag below 010 with a letter in it is a data field, and a data field without
+    # indicators still has its subfields read
+    record = _marc_bytes(
+        " " * 24, [("001", "r1"), ("00A", "12\x1faLetter"), ("245", "\x1faTitle")]
+    )
+    (tmp_path / "tags.mrc").write_bytes(record)
+    df = marc_to_dataframe(
+        tmp_path / "tags.mrc",
+        fields=["001", "00A", "245"],
+        subfields=["00A$a", "245$a"],
+        leader_positions=(),
+    )
+    row = df.iloc[0]
+    assert (row["001"], row["00A"], row["00A$a"], row["245$a"]) == (
+        "r1",
+        "$aLetter",
+        "Letter",
+        "Title",
+    )
+    assert (row["00A_ind1"], row["00A_ind2"], row["245_ind1"]) == ("1", "2", "")
+    assert "001_ind1" not in df
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -1,4 +1,23 @@
-from utils import decode_64, _eval_multibyte
+import re
+from pathlib import Path
+from typing import Optional, Union
+
+from testing import run_tests
+from utils import (
+    _get_records_64,
+    decode_64,
+    decode_64_batch,
+    decode_64_bytes,
+    decode_64_str,
+    detect_encoding,
+    iter_marc_records,
+    normalize_records,
+    record_bytes,
+    record_text,
+    transcode_record,
+)
+
+HERE = Path(__file__).parent
 
 msg = """
     MDA4MzEgICAgIDIyMDAxOTMgaSA0NTAwMDAxMDAwOTAwMDAwMDAzMDAwNzAwMDA5MDA1MDAxNzAw
@@ -17,38 +36,277 @@ msg = """
     YSAoTG9lYiBDbGFzc2ljYWwgTGlicmFyeSBOby4gMjg0KSBieSBNaW5vciBMYXRpbiBQb2V0cyAo
     MTkzNCkeICAfYUxvZWIeICAfYVlvdXIgbGlicmFyeR4d
 """
-print("Testing with chunk of base64 from librarything marc file:")
-for char in decode_64(msg):
-    print(char, end="")
-
-print("\nTesting utf8 decoding from binary. Desired string is 'hello':")
-bin_list = [
-    int(char)
-    for char in "01101000 01100101 01101100 01101100  01101111"
-    if char in {"0", "1"}
-]
-for i in range(0, 5):
-    char = _eval_multibyte(bin_list[i * 8 : (i + 1) * 8])
-    print(chr(char), end="")
-
-print(
-    "\nTesting utf8 decoding from binary with multibyte encoding. Desired string is 'αλφα'."
-)
-encodings = [
-    [1, 1, 1, 0, 1, 1, 0, 0, 0, 1],
-    [1, 1, 1, 0, 1, 1, 1, 0, 1, 1],
-    [1, 1, 1, 1, 0, 0, 0, 1, 1, 0],
-    [1, 1, 1, 0, 1, 1, 0, 0, 0, 1],
-]
-for encoding in encodings:
-    char = _eval_multibyte(encoding)
-    print(chr(char), end="")
-
-
-msg = "zrHOu8+GzrEgYWxwaGE="  # encoding for "αλφα alpha"
-print(
-    "\nTesting with a chunck of base64 known to contain utf8 multibyte encodings, should decode to 'αλφα alpha'"
-)
-for char in decode_64(msg):
-    print(char, end="")
-print("\n")
+
+
+# reference implementation: the original bit-list decoder, kept here as the oracle
+# that the byte-level decoders in utils are checked against.
+def _char_to_64(encoding_char: str) -> Optional[int]:
+    "helper function for decode_64."
+    assert len(encoding_char) == 1
+    of_64 = None
+    if encoding_char.isupper():
+        of_64 = ord(encoding_char) - 65
+    elif encoding_char.islower():
+        of_64 = ord(encoding_char) - 71
+    elif encoding_char.isnumeric():
+        of_64 = ord(encoding_char) + 4
+    elif encoding_char == "+":
+        of_64 = 62
+    elif encoding_char == "-":
+        of_64 = 62
+    elif encoding_char == "/":
+        of_64 = 63
+    elif encoding_char == "_":
+        of_64 = 63
+    return of_64
+
+
+def _to_byte(of_64: Union[int, str]) -> list:
+    if isinstance(of_64, str):
+        of_64 = int(of_64)
+    assert of_64 < 64, f"input to _to_byte contains invalid base64 character: {of_64}"
+    byte = [0, 0, 0, 0, 0, 0]
+    if of_64 % 2 == 1:
+        byte[5] = 1
+    if of_64 % 4 > 1:
+        byte[4] = 1
+    if of_64 % 8 > 3:
+        byte[3] = 1
+    if of_64 % 16 > 7:
+        byte[2] = 1
+    if of_64 % 32 > 15:
+        byte[1] = 1
+    if of_64 % 64 > 31:
+        byte[0] = 1
+    return byte
+
+
+def _eval_multibyte(encoding: list) -> int:
+    "convert a binary encoding of any length to an integer value"
+    val = 0
+    exponent = len(encoding) - 1
+    for bit in encoding:
+        if bit:
+            val += 2**exponent
+        exponent -= 1
+    return val
+
+
+def reference_decode_64(encoded: str) -> str:
+    bits = []
+    for char in encoded:
+        if char == "=" or char == "." or char.isspace():
+            continue
+        of_64 = _char_to_64(char)
+        assert of_64 is not None, f"invalid base64 character: {char}"
+        bits.extend(_to_byte(of_64))
+    if len(bits) % 8 != 0:
+        bits = bits[: len(bits) - len(bits) % 8]
+    decoded = []
+    val = 0
+    block_len = 0
+    utf8_block = []
+    in_utf8_block = False
+    for i in range(int(len(bits) / 8)):
+        binary_byte = bits[i * 8 : (i + 1) * 8]
+        if not in_utf8_block and binary_byte == [1, 0, 0, 0, 0, 0, 0, 0]:
+            continue
+        utf8_instruct_byte = False
+        if in_utf8_block:
+            utf8_block.extend(binary_byte[2:])
+            block_len -= 1
+            if block_len == 0:
+                in_utf8_block = False
+                decoded.append(chr(_eval_multibyte(utf8_block)))
+                utf8_block = []
+            continue
+        for j, bit in enumerate(binary_byte):
+            if in_utf8_block:
+                utf8_block.append(bit)
+                continue
+            if j == 0 and bit == 1:
+                utf8_instruct_byte = True
+                continue
+            if bit:
+                if not utf8_instruct_byte:
+                    val += 2 ** (7 - j)
+                else:
+                    block_len += 1
+            elif utf8_instruct_byte:
+                utf8_instruct_byte = False
+                in_utf8_block = True
+        if not in_utf8_block:
+            decoded.append(chr(val))
+        val = 0
+    return "".join(decoded)
+
+
+def _fixture_records_64() -> list[str]:
+    with open(HERE / "test64.marc", "r", encoding="utf8") as f:
+        return [record for record in _get_records_64(f.readlines()) if record]
+
+
+def test_chunk_from_librarything():
+    decoded = decode_64_str(msg)
+    assert decoded == reference_decode_64(msg)
+    assert decoded.startswith("00831     2200193 i 4500")
+    assert decoded.endswith("\x1e  \x1faYour library\x1e\x1d")
+
+
+def test_generator_matches_str():
+    assert "".join(decode_64(msg)) == decode_64_str(msg)
+
+
+def test_multibyte():
+    # encoding for "αλφα alpha"
+    assert decode_64_str("zrHOu8+GzrEgYWxwaGE=") == "αλφα alpha"
+    assert reference_decode_64("zrHOu8+GzrEgYWxwaGE=") == "αλφα alpha"
+    # "à", see TODO in README
+    assert decode_64_str("w6A=") == "à"
+
+
+def test_librarything_quirks():
+    # "." as padding, url-safe characters, and whitespace inside the encoding
+    assert decode_64_str("zrHOu8+GzrEgYWxwaGE.") == "αλφα alpha"
+    assert decode_64_str("zrHO u8+G\nzrEg YWxw aGE") == "αλφα alpha"
+    assert decode_64_bytes("-_8.") == b"\xfb\xff"
+    # stray 0x80 outside a multibyte character is skipped
+    assert decode_64_str("QYBC") == "AB" == reference_decode_64("QYBC")
+
+
+def test_errors_policy():
+    # a lone latin-1 "à" is not valid utf-8
+    assert decode_64_str("4A..", errors="replace") == "�"
+    assert decode_64_str("4A..", errors="ignore") == ""
+    try:
+        decode_64_str("4A..")
+    except UnicodeDecodeError:
+        pass
+    else:
+        raise AssertionError("expected UnicodeDecodeError")
+    try:
+        decode_64_bytes("QU!C")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError")
+
+
+def test_fixture_matches_reference():
+    for record in _fixture_records_64():
+        assert decode_64_str(record) == reference_decode_64(record)
+
+
+def test_batch_matches_single():
+    chunks = _fixture_records_64() + [msg, "", "zrHOu8+GzrEgYWxwaGE.", "QYBC", "QQ"]
+    assert decode_64_batch(chunks) == [decode_64_str(chunk) for chunk in chunks]
+    assert decode_64_batch([]) == []
+
+
+def test_split_matches_line_based_split():
+    chunks = list(iter_marc_records(HERE / "test64.marc"))
+    assert all(chunk.base64 for chunk in chunks)
+    assert [decode_64_str(chunk.data) for chunk in chunks] == [
+        decode_64_str(record) for record in _fixture_records_64()
+    ]
+
+
+def test_split_block_size():
+    filename = HERE / "librarything_UMClassics.marc"
+    chunks = list(iter_marc_records(filename))
+    assert chunks == list(iter_marc_records(filename, block_size=1000))
+    assert {chunk.base64 for chunk in chunks} == {True, False}
+    with open(filename, "rb") as f:
+        for chunk in chunks[:50]:
+            f.seek(chunk.offset)
+            assert f.read(len(chunk.data)) == chunk.data
+    for chunk in chunks:
+        assert record_text(chunk, "latin1").endswith("\x1e\x1d")
+
+
+def test_split_corrupt_length(tmp_path):
+    with open(HERE / "librarything_UMClassics.marc", "rb") as f:
+        data = f.read(200_000)
+    chunks = list(iter_marc_records(HERE / "librarything_UMClassics.marc"))
+    # records are found at the same offsets, with the
+    # same bytes apart from the corrupted lengths
+    expected = [
+        (chunk.offset, record_bytes(chunk)[5:])
+        for chunk in chunks
+        if chunk.offset < 150_000
+    ]
+    plain = next(chunk for chunk in chunks if not chunk.base64)
+    encoded = next(chunk for chunk in chunks if chunk.base64)
+    # corrupt the length in one plain leader, and
+    # in one base64 leader ("MDA4" -> "MDk4")
+    data = bytearray(data)
+    data[plain.offset : plain.offset + 5] = b"99999"
+    data[encoded.offset + 2] = ord("k")
+    corrupt = tmp_path / "corrupt.marc"
+    corrupt.write_bytes(bytes(data))
+    found = [
+        (chunk.offset, record_bytes(chunk)[5:]) for chunk in iter_marc_records(corrupt)
+    ]
+    assert found[: len(expected)] == expected
+
+
+def reference_normalize(records: str) -> str:
+    records = records.replace("\n", " ")
+    records = re.sub(r"(\x1e\x1d)(\s|\n)*(\d+)", r"\1\3", records)
+    return records.replace("\x00", "")
+
+
+def test_normalize_matches_reference():
+    data = (HERE / "librarything_UMClassics.marc").read_bytes()
+    assert normalize_records(data) == reference_normalize(data.decode("latin1")).encode(
+        "latin1"
+    )
+    for chunk in iter_marc_records(HERE / "test64.marc"):
+        record = decode_64_bytes(chunk.data)
+        assert normalize_records(record) == reference_normalize(
+            record.decode("utf8")
+        ).encode("utf8")
+
+
+def test_normalize():
+    records = b"00010\x1fa one\nline\x00\x1e\x1d \n\r 00020\x1e\x1d\n"
+    assert normalize_records(records) == b"00010\x1fa one line\x1e\x1d00020\x1e\x1d "
+    assert normalize_records(records) == reference_normalize(records.decode()).encode()
+    # a gap that isn't followed by a leader is left alone
+    assert normalize_records(b"\x1e\x1d  MDA") == b"\x1e\x1d  MDA"
+
+
+def test_detect_encoding():
+    assert detect_encoding(b"plain ascii") == "utf8"
+    assert detect_encoding("Κόλν Köln".encode("utf8")) == "utf8"
+    # librarything's stray 0x80 doesn't make a record latin-1
+    assert detect_encoding("Κ".encode("utf8") + b"\x80") == "utf8"
+    assert detect_encoding("Köln à".encode("latin1")) == "latin1"
+    assert detect_encoding("Köln \u2013".encode("cp1252")) == "cp1252"
+
+
+def test_transcode_record():
+    from pymarc import MARCReader
+
+    data = (HERE / "librarything_UMClassics.marc").read_bytes()
+    for chunk in iter_marc_records(HERE / "librarything_UMClassics.marc"):
+        record = data[chunk.offset : chunk.offset + len(chunk.data)]
+        if not chunk.base64 and detect_encoding(record) == "latin1":
+            break
+    utf8 = transcode_record(record, "latin1")
+    assert utf8[9:10] == b"a" and int(utf8[:5]) == len(utf8)
+    parsed = next(iter(MARCReader(utf8)))
+    assert parsed["245"].value() == normalize_records(
+        next(iter(MARCReader(record, file_encoding="latin1")))["245"]
+        .value()
+        .encode("utf8")
+    ).decode("utf8")
+    assert record_text(chunk, "auto") == utf8.decode("utf8")
+
+
+if __name__ == "__main__":
+    print("Testing with chunk of base64 from librarything marc file:")
+    print(decode_64_str(msg))
+    print("Desired string is 'αλφα alpha':")
+    print(decode_64_str("zrHOu8+GzrEgYWxwaGE="))
+    run_tests(globals())
@@ -0,0 +1,629 @@
+# finding duplicate records in a marc file, e.g. the same Loeb volume catalogued twice
+#
+# Each record gets keys from its ISBNs (020 $a), title (245 $a) and author (100 $a).
+# Records that share an ISBN, or the same normalized title and author, are duplicates
+# straight away. Titles that are only similar are matched with MinHash signatures of
+# their character trigrams and locality-sensitive hashing: records that agree on all
+# rows of one of the signature bands are candidates, and candidates are duplicates if
+# their signatures are similar enough, their authors don't differ and their titles have
+# the same volume numbers. Duplicates are then joined into clusters. The keys and
+# signatures are kept in a sidecar file next to the marc file (<filename>.dedup), so
+# that repeated runs only read the file again if it has changed, and only the new
+# records if it was appended to.
+
+import argparse
+import csv
+import hashlib
+import json
+import re
+import unicodedata
+from collections.abc import Generator, Iterable
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from pymarc import Record
+
+import instrumentation
+from utils import RecordView, _tail_crc, iter_marc_records, record_bytes
+
+# one row of a DedupIndex: a record's 001, and hashes of its
+# normalized title and author, of its author alone, and of
+# the volume numbers in its title (0 where there is none)
+KEY_DTYPE = np.dtype(
+    [("control", "S23"), ("title", "<u8"), ("author", "<u8"), ("numbers", "<u8")]
+)
+# minhash signatures are minima of (a * trigram + b) mod this prime, for random a and b
+_PRIME = (1 << 31) - 1
+_SIDECAR_VERSION = 2
+
+_PARENTHESES = re.compile(r"\(([^)]*)\)|\[([^\]]*)\]")
+_NOT_WORD = re.compile(r"[\W_]+")
+_ROMAN = re.compile(
+    r"(?=[mdclxvi])m{0,3}(?:cm|cd|d?c{0,3})(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3})"
+)
+_ROMAN_VALUES = {"m": 1000, "d": 500, "c": 100, "l": 50, "x": 10, "v": 5, "i": 1}
+# words that introduce a volume number, rather than being part of the title
+_NUMBER_WORDS = {
+    "v",
+    "vol",
+    "vols",
+    "volume",
+    "volumes",
+    "no",
+    "nos",
+    "bk",
+    "book",
+    "books",
+    "pt",
+    "part",
+    "parts",
+}
+_NUMBER_WORDS |= {
+    "pars",
+    "tom",
+    "tome",
+    "tomus",
+    "band",
+    "bd",
+    "teil",
+    "liber",
+    "libri",
+}
+# ordinals (and a few cardinals) that number volumes in the languages of the catalogue
+_NUMBER_NAMES = {
+    word: n
+    for words in (
+        "first second third fourth fifth sixth seventh eighth ninth tenth",
+        "one two three four five six seven eight nine ten",
+        "primus secundus tertius quartus quintus sextus septimus octavus nonus decimus",
+        "prima secunda tertia quarta quinta sexta septima octava nona decima",
+        "erster zweiter dritter vierter funfter sechster siebter achter neunter"
+        " zehnter",
+        "erste zweite dritte vierte funfte sechste siebte achte neunte zehnte",
+        "premier deuxieme troisieme quatrieme cinquieme sixieme septieme huitieme"
+        " neuvieme dixieme",
+    )
+    for n, word in enumerate(words.split(), 1)
+}
+_NUMBER_NAMES.update(premiere=1, seconde=2)
+_ARTICLES = {
+    "the",
+    "a",
+    "an",
+    "le",
+    "la",
+    "les",
+    "l",
+    "der",
+    "die",
+    "das",
+    "il",
+    "lo",
+    "el",
+}
+_ISBN = re.compile(r"97[89]\d{10}|\d{9}[\dX]")
+
+
+def normalize_text(text: str) -> str:
+    """Lowercases text, strips accents, and replaces punctuation by single spaces,
+    so that "Aristotle : Poetics." and "aristotle poetics" are the same."""
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(c for c in text if not unicodedata.combining(c))
+    return _NOT_WORD.sub(" ", text.casefold()).strip()
+
+
+def title_key(title: str) -> str:
+    """
+    A normalized title: without parenthesized notes
+    such as series statements, or a leading article.
+    """
+    words = normalize_text(_PARENTHESES.sub(" ", title)).split()
+    if len(words) > 1 and words[0] in _ARTICLES:
+        words = words[1:]
+    return " ".join(words)
+
+
+def author_key(author: str) -> str:
+    """A normalized author, with its words sorted, so that "Clement of Alexandria" and
+    "Alexandria, Clement of." are the same."""
+    return " ".join(sorted(normalize_text(author).split()))
+
+
+def _roman(word: str) -> Optional[int]:
+    if not _ROMAN.fullmatch(word):
+        return None
+    values = [_ROMAN_VALUES[c] for c in word]
+    return sum(-v if v < w else v for v, w in zip(values, values[1:] + [0]))
+
+
+def volume_numbers(title: str) -> Tuple[str, ...]:
+    """
+    The volume numbers in a normalized title, in order: arabic and roman numerals and
+    the ordinals in _NUMBER_NAMES as arabic numbers, and single letters after a number
+    word, e.g. ("2",) for both "the library v 2" and "library volume ii", or ("1", "a")
+    for "erster teil a". Titles that are otherwise the same but have different numbers
+    are different volumes, not duplicates.
+    """
+    words = title.split()
+    numbers = []
+    for i, word in enumerate(words):
+        after_number_word = i > 0 and words[i - 1] in _NUMBER_WORDS
+        if word.isdigit():
+            numbers.append(str(int(word)))
+        elif word in _NUMBER_NAMES:
+            numbers.append(str(_NUMBER_NAMES[word]))
+        elif word in _NUMBER_WORDS:
+            continue
+        elif len(word) > 1 or i == len(words) - 1 or after_number_word:
+            # single letters are only numerals after a number word or at the end
+            value = _roman(word)
+            if value is not None:
+                numbers.append(str(value))
+            elif len(word) == 1 and after_number_word:
+                numbers.append(word)
+    return tuple(numbers)
+
+
+def normalize_isbn(isbn: str) -> Optional[str]:
+    """
+    An ISBN as 13 digits, from the start of a 020 $a such as "0-674-99135-4 (hbk.)", or
+    None if there is no valid ISBN there. ISBN-10s are converted, so both forms match.
+    """
+    match = _ISBN.match(isbn.replace("-", "").replace(" ", "").upper())
+    if match is None:
+        return None
+    digits = match.group()
+    if len(digits) == 10:
+        if (
+            sum((10 - i) * (10 if c == "X" else int(c)) for i, c in enumerate(digits))
+            % 11
+        ):
+            return None
+        digits = "978" + digits[:9]
+    else:
+        digits = digits[:12]
+    check = (
+        10 - sum((3 if i % 2 else 1) * int(c) for i, c in enumerate(digits)) % 10
+    ) % 10
+    full = digits + str(check)
+    return full if len(match.group()) == 10 or full == match.group() else None
+
+
+def _hash(text: str) -> int:
+    "a stable 64 bit hash of a key, 0 for an empty key"
+    if not text:
+        return 0
+    return (
+        int.from_bytes(
+            hashlib.blake2b(text.encode("utf8"), digest_size=8).digest(), "little"
+        )
+        or 1
+    )
+
+
+def _subfield(record: Union[Record, RecordView], tag: str, code: str) -> str:
+    for field in record.get_fields(tag):
+        values = field.get_subfields(code)
+        if values:
+            return values[0]
+    return ""
+
+
+@instrumentation.timed("dedup_keys")
+def record_keys(
+    record: Union[Record, RecordView],
+) -> Tuple[bytes, list[str], str, str, str]:
+    """
+    The 001, valid ISBNs, normalized title and author, and the title with volume numbers
+    (245 $a, $n and $p) of a record.
+    """
+    control = record.get("001")
+    control = control.data if control is not None else ""
+    isbns = [
+        isbn
+        for field in record.get_fields("020")
+        for value in field.get_subfields("a")
+        if (isbn := normalize_isbn(value))
+    ]
+    full_title = _subfield(record, "245", "a")
+    title = title_key(full_title)
+    parts = [
+        value
+        for field in record.get_fields("245")[:1]
+        for value in field.get_subfields("n", "p")
+    ]
+    # parenthesized notes are left out of the title,
+    # but "(vol. 2)" and the like tell volumes apart
+    notes = [normalize_text(a or b) for a, b in _PARENTHESES.findall(full_title)]
+    notes = [note for note in notes if note.split(" ", 1)[0] in _NUMBER_WORDS]
+    numbered = " ".join(
+        [title, *notes, *(normalize_text(part) for part in parts)]
+    ).strip()
+    author = author_key(_subfield(record, "100", "a"))
+    return control.encode("utf8")[:23], isbns, title, author, numbered
+
+
+def _trigrams(titles: list[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The character trigrams of every title, each as an int, and the index of their first
+    trigram for every title, from a single array over all the titles' utf8 bytes. Titles
+    are padded with spaces, so every non-empty title has at least one trigram.
+    """
+    encoded = [f" {title} ".encode("utf8") if title else b"" for title in titles]
+    lengths = np.array([len(e) for e in encoded], dtype=np.int64)
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint32)
+    counts = np.maximum(lengths - 2, 0)
+    owner = np.repeat(np.arange(len(titles)), lengths)
+    codes = (
+        (data[:-2] << 16) | (data[1:-1] << 8) | data[2:] if len(data) >= 3 else data[:0]
+    )
+    # trigrams that run over the end of a title into the next aren't trigrams of either
+    codes = codes[owner[:-2] == owner[2:]] if len(codes) else codes
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return codes, starts
+
+
+@instrumentation.timed("minhash")
+def minhash(titles: list[str], num_perm: int = 64, seed: int = 0) -> np.ndarray:
+    """
+    MinHash signatures of the character trigrams of normalized
+    titles, one row of num_perm uint32s per title. Empty
+    titles get a row of _PRIME, which is never a minimum.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _PRIME, num_perm, dtype=np.uint64)
+    b = rng.integers(0, _PRIME, num_perm, dtype=np.uint64)
+    codes, starts = _trigrams(titles)
+    signatures = np.full((len(titles), num_perm), _PRIME, dtype=np.uint32)
+    has = np.array([bool(title) for title in titles], dtype=bool)
+    if not codes.size:
+        return signatures
+    codes = codes.astype(np.uint64)
+    for k in range(num_perm):
+        # trigrams are below 2**24 and a below 2**31, so this can't overflow 64 bits
+        hashed = (a[k] * codes + b[k]) % _PRIME
+        signatures[has, k] = np.minimum.reduceat(hashed, starts[has])
+    return signatures
+
+
+def _neighbours(
+    keys: np.ndarray, rows: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Pairs of rows with the same key, linking every row to the next one with its key,
+    which is enough for clusters without comparing every pair. 0 keys are left out."""
+    rows = np.arange(len(keys)) if rows is None else rows
+    keep = keys != 0
+    keys, rows = keys[keep], rows[keep]
+    order = np.argsort(keys, kind="stable")
+    keys, rows = keys[order], rows[order]
+    same = keys[1:] == keys[:-1]
+    return rows[:-1][same], rows[1:][same]
+
+
+def _components(n: int, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """
+    Connected components of n nodes joined by the
+    given edges, labelled by their smallest node.
+    """
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[left], labels[right])
+        previous = labels.copy()
+        np.minimum.at(labels, left, low)
+        np.minimum.at(labels, right, low)
+        # point every node at its label's label until nothing changes
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+        if np.array_equal(labels, previous):
+            return labels
+
+
+class DedupIndex:
+    """
+    Duplicate detection index for a marc file, read as RecordViews as in to_csv. The
+    keys of every record are kept in a sidecar file (<filename>.dedup by default), and
+    checked against the size and mtime of the marc file when opened, as MarcIndex does:
+    if records have only been appended, just the new records are read, otherwise the
+    index is rebuilt. Call clusters() to group the records, or write_clusters() for a
+    csv of the groups. Records are numbered by their position in the file, as in a
+    MarcIndex; records that can't be read keep their position, with empty keys.
+    """
+
+    def __init__(
+        self,
+        filename: Union[Path, str],
+        sidecar: Union[Path, str, None] = None,
+        num_perm: int = 64,
+        bands: int = 16,
+        seed: int = 0,
+    ):
+        if num_perm % bands:
+            raise ValueError(
+                f"num_perm ({num_perm}) must be a multiple of bands ({bands})."
+            )
+        self.filename = Path(filename)
+        if not self.filename.exists():
+            raise FileNotFoundError(f"File {self.filename} not found.")
+        self.sidecar = Path(sidecar) if sidecar else Path(f"{self.filename}.dedup")
+        self.num_perm, self.bands, self.seed = num_perm, bands, seed
+        self._refresh()
+
+    def _settings(self) -> dict:
+        return {
+            "version": _SIDECAR_VERSION,
+            "num_perm": self.num_perm,
+            "seed": self.seed,
+        }
+
+    def _load(self) -> Optional[dict]:
+        try:
+            with np.load(self.sidecar) as sidecar:
+                arrays = {name: sidecar[name] for name in sidecar.files}
+            meta = json.loads(str(arrays.pop("meta")))
+        except (OSError, KeyError, ValueError):
+            return None
+        if meta.get("settings") != self._settings():
+            return None
+        return {"meta": meta, **arrays}
+
+    def _refresh(self) -> None:
+        stat = self.filename.stat()
+        old = self._load()
+        start = 0
+        if old is not None:
+            size, mtime, crc = (
+                old["meta"]["size"],
+                old["meta"]["mtime"],
+                old["meta"]["crc"],
+            )
+            if (size, mtime) == (stat.st_size, stat.st_mtime_ns):
+                self._set(old)
+                return
+            with open(self.filename, "rb") as f:
+                appended = stat.st_size > size and _tail_crc(f, size) == crc
+            if appended and len(old["keys"]):
+                # the last record may have been incomplete, so it is read again
+                start = int(old["offsets"][-1])
+                old = _drop_last(old)
+        new = self._read(start, len(old["keys"]) if start else 0)
+        if start:
+            new = {
+                name: np.concatenate([old[name], new[name]])
+                for name in (
+                    "keys",
+                    "offsets",
+                    "signatures",
+                    "isbn_rows",
+                    "isbns",
+                    "text",
+                )
+            }
+        with open(self.filename, "rb") as f:
+            crc = _tail_crc(f, stat.st_size)
+        new["meta"] = {
+            "settings": self._settings(),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "crc": crc,
+        }
+        with open(self.sidecar, "wb") as f:
+            np.savez(f, **{**new, "meta": np.array(json.dumps(new["meta"]))})
+        self._set(new)
+
+    def _read(self, start: int, first: int) -> dict:
+        """
+        reads the keys of the records from byte `start` on, numbering them from `first`
+        """
+        keys, offsets, isbn_rows, isbns, titles, text = [], [], [], [], [], []
+        for i, chunk in enumerate(iter_marc_records(self.filename, start=start), first):
+            offsets.append(chunk.offset)
+            try:
+                record = RecordView(
+                    record_bytes(chunk),
+                    force_utf8=chunk.base64,
+                    utf8_handling="replace",
+                )
+            except ValueError as e:
+                # kept with empty keys, so that the positions
+                # of the later records stay those in the file
+                instrumentation.count("skipped")
+                print(f"warning: record at byte {chunk.offset} skipped: {e!r}")
+                keys.append((b"", 0, 0, 0))
+                titles.append("")
+                text.append("\t\t")
+                continue
+            control, record_isbns, title, author, title_numbers = record_keys(record)
+            numbers = volume_numbers(title_numbers)
+            keys.append(
+                (
+                    control,
+                    _hash(f"{title}\x1f{author}\x1f{numbers}" if title else ""),
+                    _hash(author),
+                    _hash(repr(numbers) if numbers else ""),
+                )
+            )
+            isbn_rows.extend([i] * len(record_isbns))
+            isbns.extend(int(isbn) for isbn in record_isbns)
+            titles.append(title)
+            # what the csv shows of each record, kept
+            # so that it doesn't need to be read again
+            shown = [
+                " ".join(record_isbns),
+                _subfield(record, "100", "a"),
+                _subfield(record, "245", "a"),
+            ]
+            text.append("\t".join(" ".join(s.split()) for s in shown))
+        return {
+            "keys": np.array(keys, dtype=KEY_DTYPE),
+            "offsets": np.array(offsets, dtype=np.uint64),
+            "signatures": minhash(titles, self.num_perm, self.seed),
+            "isbn_rows": np.array(isbn_rows, dtype=np.uint32),
+            "isbns": np.array(isbns, dtype=np.uint64),
+            "text": np.frombuffer(
+                "".join(f"{t}\n" for t in text).encode("utf8"), dtype=np.uint8
+            ),
+        }
+
+    def _set(self, arrays: dict) -> None:
+        self.keys = arrays["keys"]
+        self.signatures = arrays["signatures"]
+        self.isbn_rows = arrays["isbn_rows"]
+        self.isbns = arrays["isbns"]
+        self._text = arrays["text"]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def candidates(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Pairs of records (i < j) that share a band of their title signatures, without
+        repeats. Records without a title are never candidates.
+        """
+        rows = self.num_perm // self.bands
+        indices = np.flatnonzero(self.signatures[:, 0] != _PRIME)
+        signatures = self.signatures[indices].astype(np.uint64)
+        pairs = []
+        for band in range(self.bands):
+            # a hash of the rows of the band, so that bands are
+            # compared and sorted as single values; a collision
+            # only makes a candidate that clusters() then rejects
+            keys = np.zeros(len(indices), dtype=np.uint64)
+            for row in range(band * rows, (band + 1) * rows):
+                keys = (keys ^ signatures[:, row]) * np.uint64(0x9E3779B97F4A7C15)
+            left, right = _neighbours(keys, indices)
+            pairs.append(np.minimum(left, right) * len(self) + np.maximum(left, right))
+        pairs = (
+            np.unique(np.concatenate(pairs)) if pairs else np.empty(0, dtype=np.int64)
+        )
+        return pairs // len(self), pairs % len(self)
+
+    def clusters(self, threshold: float = 0.7) -> np.ndarray:
+        """
+        The cluster of every record, as the position of the first record in its cluster,
+        so that a record that has no duplicates is in a cluster of its own. Records are
+        duplicates if they share an ISBN, have the same normalized title and author, or
+        have signatures that agree in at least `threshold` of their values (an estimate
+        of the Jaccard similarity of their title trigrams), no different authors, and
+        the same volume numbers.
+        """
+        numbers = self.keys["numbers"]
+        isbn_rows = self.isbn_rows.astype(np.int64)
+        # sets of volumes can share an ISBN, so records with an ISBN in common still
+        # need the same numbers
+        isbn_keys = (self.isbns * np.uint64(0x9E3779B97F4A7C15)) ^ numbers[isbn_rows]
+        lefts, rights = [], []
+        for left, right in (
+            _neighbours(isbn_keys, isbn_rows),
+            _neighbours(self.keys["title"]),
+        ):
+            lefts.append(left)
+            rights.append(right)
+        left, right = self.candidates()
+        similarity = (self.signatures[left] == self.signatures[right]).mean(axis=1)
+        authors = self.keys["author"]
+        same = (
+            (similarity >= threshold)
+            & (
+                (authors[left] == authors[right])
+                | (authors[left] == 0)
+                | (authors[right] == 0)
+            )
+            & (numbers[left] == numbers[right])
+        )
+        lefts.append(left[same])
+        rights.append(right[same])
+        return _components(len(self), np.concatenate(lefts), np.concatenate(rights))
+
+    def text(self) -> list[Tuple[str, str, str]]:
+        "The ISBNs, author and title of every record, as shown by write_clusters."
+        lines = self._text.tobytes().decode("utf8").split("\n")[:-1]
+        return [tuple(line.split("\t")) for line in lines]
+
+    def groups(self, threshold: float = 0.7) -> Generator[list[int]]:
+        """
+        The positions of the records in each cluster
+        of more than one record, in file order.
+        """
+        labels = self.clusters(threshold)
+        order = np.argsort(labels, kind="stable")
+        sorted_labels = labels[order]
+        bounds = np.flatnonzero(np.diff(sorted_labels)) + 1
+        for group in np.split(order, bounds):
+            if len(group) > 1:
+                yield group.tolist()
+
+    def write_clusters(self, dest: Union[Path, str], threshold: float = 0.7) -> int:
+        """
+        Writes a csv of the clusters of duplicates, one row per record with its cluster
+        id (numbered from 1), position in the file, 001, ISBNs, author and title.
+        Returns the number of clusters.
+        """
+        text = self.text()
+        controls = self.keys["control"]
+        count = 0
+        with open(dest, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["cluster", "position", "001", "isbn", "author", "title"])
+            for count, group in enumerate(self.groups(threshold), 1):
+                for i in group:
+                    control = controls[i].decode("utf8", "replace")
+                    writer.writerow([count, i, control, *text[i]])
+        return count
+
+
+def _drop_last(arrays: dict) -> dict:
+    "the arrays of a DedupIndex without its last record"
+    last = len(arrays["keys"]) - 1
+    keep = arrays["isbn_rows"] != last
+    # the text of each record ends with a newline
+    lines = np.flatnonzero(arrays["text"] == ord("\n"))
+    return {
+        **arrays,
+        "keys": arrays["keys"][:last],
+        "offsets": arrays["offsets"][:last],
+        "signatures": arrays["signatures"][:last],
+        "isbn_rows": arrays["isbn_rows"][keep],
+        "isbns": arrays["isbns"][keep],
+        "text": arrays["text"][: lines[-2] + 1 if len(lines) > 1 else 0],
+    }
+
+
+def find_duplicates(
+    filename: Union[Path, str],
+    dest: Union[Path, str],
+    threshold: float = 0.7,
+    sidecar: Union[Path, str, None] = None,
+) -> int:
+    """
+    Writes the clusters of duplicate records in a marc
+    file to a csv, see DedupIndex.write_clusters.
+    """
+    return DedupIndex(filename, sidecar).write_clusters(dest, threshold)
+
+
+def _parse_args(args: Optional[Iterable[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Find duplicate records in a marc file (plain, or mixed with "
+        "base64 records) and write them as clusters to a csv."
+    )
+    parser.add_argument("filename")
+    parser.add_argument("dest", help="csv to write the clusters to")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.7,
+        help="how similar titles have to be to be duplicates, from 0 to 1",
+    )
+    parser.add_argument("--sidecar", help="index file, <filename>.dedup by default")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    clusters = find_duplicates(args.filename, args.dest, args.threshold, args.sidecar)
+    print(f"found {clusters} clusters of duplicates")
@@ -0,0 +1,87 @@
+import io
+from contextlib import redirect_stdout
+
+from pymarc import Field, Record, Subfield
+
+from dedup import DedupIndex, normalize_isbn, volume_numbers
+from testing import run_tests
+
+
+def test_dedup(tmp_path):
+    def record(control, title, author="", isbn=""):
+        record = Record(force_utf8=True)
+        record.add_field(Field(tag="001", data=control))
+        if isbn:
+            record.add_field(Field("020", [" ", " "], [Subfield("a", isbn)]))
+        if author:
+            record.add_field(Field("100", ["1", " "], [Subfield("a", author)]))
+        record.add_field(Field("245", ["1", "0"], [Subfield("a", title)]))
+        return record.as_marc()
+
+    assert (
+        normalize_isbn("0-674-99135-4 (hbk.)")
+        == normalize_isbn("9780674991354")
+        == "9780674991354"
+    )
+    assert normalize_isbn("0674991355") is None
+    assert (
+        volume_numbers("library volume ii")
+        == volume_numbers("the library v 2")
+        == ("2",)
+    )
+    records = [
+        record(
+            "1",
+            "The Library, Volume I: Books 1-3.9 (Loeb Classical Library).",
+            "Apollodorus.",
+        ),
+        record("2", "The Library. Vol. 1, Books 1-3.9", "Apollodorus"),
+        record("3", "The Library: v. 2 (Loeb Classical Library).", "Apollodorus."),
+        record("4", "On Old Age", "Cicero, Marcus Tullius.", "0-674-99170-2"),
+        record("5", "De Senectute", "Falconer, William Armistead.", "9780674991705"),
+        record("6", "Aeneidos Liber Primus", "Virgil.", "0198720343"),
+        record("7", "Aeneidos Liber Tertius", "Virgil.", "0198720343"),
+        record("8", "Medea.", "Euripides."),
+        record("9", "The Médea", "Euripides"),
+        record("10", "Medea", "Seneca."),
+    ]
+    filename = tmp_path / "dup.mrc"
+    filename.write_bytes(b"".join(records[:6]))
+    assert list(DedupIndex(filename).groups()) == [[0, 1], [3, 4]]
+    # appended records are read without reading the rest again
+    with open(filename, "ab") as f:
+        f.write(b"".join(records[6:]))
+    index = DedupIndex(filename)
+    assert list(index.groups()) == [[0, 1], [3, 4], [7, 8]]
+    assert index.write_clusters(tmp_path / "clusters.csv") == 3
+    rebuilt = DedupIndex(filename, sidecar=tmp_path / "rebuilt.dedup")
+    assert (rebuilt.signatures == index.signatures).all() and (
+        rebuilt.keys == index.keys
+    ).all()
+
+    # an unreadable record keeps its position, so the later ones stay in file order
+    unreadable = b"00034nam  2200049   4500001x\x1eabc\x1e\x1d"
+    filename.write_bytes(b"".join(records[:2]) + unreadable + b"".join(records[2:6]))
+    with redirect_stdout(io.StringIO()):
+        index = DedupIndex(filename)
+    assert len(index) == 7 and list(index.groups()) == [[0, 1], [4, 5]]
+    assert index.text()[2] == ("", "", "")
+    # a record that was cut off when the file was indexed is read again once the rest
+    # of it is appended
+    data = b"".join(records)
+    cut = len(b"".join(records[:7])) + 20
+    filename.write_bytes(data[:cut])
+    with redirect_stdout(io.StringIO()):
+        DedupIndex(filename)
+    with open(filename, "ab") as f:
+        f.write(data[cut:])
+    appended = DedupIndex(filename)
+    rebuilt = DedupIndex(filename, sidecar=tmp_path / "again.dedup")
+    assert len(appended) == len(records) and (appended.keys == rebuilt.keys).all()
+    assert (appended.isbns == rebuilt.isbns).all()
+    assert appended.text() == rebuilt.text()
+    assert list(appended.groups()) == [[0, 1], [3, 4], [7, 8]]
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -0,0 +1,329 @@
+# opt-in timers, counters and memory sampling for the conversion stages in utils,
+# csv_converter, cell_codec, pipeline, dedup, validation and marc_select
+#
+# Nothing in those modules is timed by default. The functions that make up a stage are
+# marked with the timed() or timed_iter() decorators, which time them as that stage
+# while a run is being instrumented (inside `with instrumented():`), and otherwise
+# only check that there is no such run before calling them. The paths that skip a
+# record call count(), which does nothing unless a run is being instrumented.
+#
+# The stages are: split (iter_marc_records), decode_64, get_records_64, normalize,
+# detect_encoding, transcode, record_views, collect_tags, flatten, pymarc
+# (csv_converter.iter_records), process_record, csv_row, parquet_row, to_csv,
+# to_parquet, to_marc (each including the pipeline's sink), read_csv, rows_to_marc,
+# decode_cells, dedup_keys, minhash, validate and select. Times are exclusive, i.e. the
+# time spent in a stage called from another stage only counts for the inner one, so
+# the time left for to_csv, say, is the time spent writing the csv. Generators are
+# timed while they produce each item, not while their caller handles it.
+
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable, Generator
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Optional, TextIO, Union
+
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+# stages that make an extra pass over a file, during which records aren't counted again
+_PREPASSES = {"collect_tags"}
+
+# the run being instrumented, if any
+_active: Optional["Stats"] = None
+
+
+class Stats:
+    """
+    Exclusive time and calls per stage, counters, and the peak resident memory of an
+    instrumented run. Each thread keeps its own stack of stages and its own counts, so
+    the stages of the reading, processing and writing threads of run_pipeline are timed
+    separately without locking, and added up when they are read.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        self.peak_rss = _rss()
+        # how far the file being split has been read, for progress reports
+        self.position = 0
+        self.size = 0
+        self._local = threading.local()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _state(self) -> threading.local:
+        local = self._local
+        if not hasattr(local, "stack"):
+            local.stack = []
+            local.seconds = Counter()
+            local.calls = Counter()
+            local.counters = Counter()
+            local.muted = 0
+            with self._lock:
+                self._threads.append((local.seconds, local.calls, local.counters))
+        return local
+
+    def enter(self, stage: str, call=True) -> None:
+        local = self._state()
+        now = time.perf_counter()
+        if local.stack:
+            outer = local.stack[-1]
+            local.seconds[outer[0]] += now - outer[1]
+        local.stack.append([stage, now])
+        if call:
+            local.calls[stage] += 1
+        if stage in _PREPASSES:
+            local.muted += 1
+
+    def exit(self) -> None:
+        local = self._local
+        now = time.perf_counter()
+        stage, start = local.stack.pop()
+        local.seconds[stage] += now - start
+        if local.stack:
+            local.stack[-1][1] = now
+        if stage in _PREPASSES:
+            local.muted -= 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        local = self._state()
+        if not local.muted:
+            local.counters[name] += n
+
+    @property
+    def counters(self) -> Counter:
+        "the counts of all the threads so far"
+        counters = Counter()
+        with self._lock:
+            for _, _, thread_counters in self._threads:
+                counters.update(thread_counters)
+        return counters
+
+    def counting(self) -> bool:
+        return not self._state().muted
+
+    def sample(self) -> None:
+        rss = _rss()
+        if rss is not None and rss > (self.peak_rss or 0):
+            self.peak_rss = rss
+
+    def stages(self) -> dict[str, dict]:
+        seconds, calls = Counter(), Counter()
+        with self._lock:
+            for thread_seconds, thread_calls, _ in self._threads:
+                seconds.update(thread_seconds)
+                calls.update(thread_calls)
+        return {
+            stage: {"seconds": round(seconds[stage], 6), "calls": calls[stage]}
+            for stage in sorted(seconds, key=seconds.get, reverse=True)
+        }
+
+    def report(self) -> dict:
+        elapsed = self.elapsed or time.perf_counter() - self.start
+        return {
+            "elapsed": round(elapsed, 6),
+            "stages": self.stages(),
+            "counters": dict(self.counters),
+            "peak_rss": self.peak_rss,
+        }
+
+    def progress(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        counters = self.counters
+        records = counters["records"]
+        text = f"{records} records, {counters['bytes'] / 2**20:.1f} MB"
+        if self.size:
+            text += f" ({self.position / self.size:.0%})"
+        text += f", {records / elapsed:.0f} records/s"
+        if self.peak_rss:
+            text += f", peak rss {self.peak_rss / 2**20:.0f} MB"
+        return text
+
+
+def _rss() -> Optional[int]:
+    """
+    the resident memory of this process in bytes,
+    or its peak so far where /proc isn't there
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return None
+    # kB on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def active() -> Optional[Stats]:
+    "the Stats of the run being instrumented, or None"
+    return _active
+
+
+def count(name: str, n: int = 1) -> None:
+    "adds n to a counter of the run being instrumented, if there is one"
+    if _active is not None:
+        _active.count(name, n)
+
+
+def timed(stage: str) -> Callable[[Callable], Callable]:
+    "decorator timing each call of a function as `stage` of the run being instrumented"
+
+    def decorate(func: Callable) -> Callable:
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            stats = _active
+            if stats is None:
+                return func(*args, **kwargs)
+            stats.enter(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.exit()
+
+        return timed_func
+
+    return decorate
+
+
+def timed_iter(stage: str) -> Callable[[Callable], Callable]:
+    """
+    decorator timing a generator function as `stage` of the run being instrumented,
+    while it produces each item
+    """
+
+    def decorate(func: Callable) -> Callable:
+        @wraps(func)
+        def timed_func(*args, **kwargs) -> Generator:
+            stats = _active
+            if stats is None:
+                return func(*args, **kwargs)
+            stats.enter(stage)
+            try:
+                items = func(*args, **kwargs)
+            finally:
+                stats.exit()
+            return _timed_items(items, stage, stats)
+
+        return timed_func
+
+    return decorate
+
+
+def _timed_items(items: Generator, stage: str, stats: Stats) -> Generator:
+    while True:
+        stats.enter(stage, call=False)
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        finally:
+            stats.exit()
+        yield item
+
+
+def timed_split(func: Callable) -> Callable:
+    """
+    decorator for iter_marc_records, timing it as the split stage,
+    and counting the records, bytes and base64 records read
+    """
+    split = timed_iter("split")(func)
+
+    @wraps(func)
+    def timed_func(filename, *args, **kwargs) -> Generator:
+        stats = _active
+        if stats is None:
+            return func(filename, *args, **kwargs)
+        return _counted(split(filename, *args, **kwargs), filename, stats)
+
+    return timed_func
+
+
+def _counted(chunks: Generator, filename, stats: Stats) -> Generator:
+    if not stats.counting():
+        yield from chunks
+        return
+    if isinstance(filename, (str, Path)):
+        stats.size = os.path.getsize(filename)
+    for chunk in chunks:
+        stats.count("records")
+        stats.count("bytes", len(chunk.data))
+        if chunk.base64:
+            stats.count("base64")
+        stats.position = chunk.offset + len(chunk.data)
+        yield chunk
+
+
+@contextmanager
+def instrumented(
+    report: Union[Path, str, TextIO, None] = None,
+    progress: float = 0,
+    profile: Union[Path, str, None] = None,
+    sample_interval: float = 0.1,
+) -> Generator[Stats]:
+    """
+    Times the conversion stages run inside the with block, counts the records, bytes,
+    base64 records and skipped records read, and samples the peak resident memory every
+    sample_interval seconds. On exit the report (see Stats.report) is written as json to
+    `report`, a path or a text stream, if given. With progress > 0, a progress line goes
+    to stderr every `progress` seconds, and with `profile`, the with block is also run
+    under cProfile and the stats dumped there (readable with pstats); cProfile only sees
+    the thread that enters the block. Stages run in worker processes (workers > 1) are
+    only seen as time spent waiting for them.
+    """
+    global _active
+    if _active is not None:
+        raise RuntimeError("A run is already being instrumented.")
+    stats = Stats()
+    stop = threading.Event()
+
+    def sample() -> None:
+        last = time.perf_counter()
+        while not stop.wait(sample_interval):
+            stats.sample()
+            if progress and time.perf_counter() - last >= progress:
+                last = time.perf_counter()
+                print(stats.progress(), file=sys.stderr)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    profiler = cProfile.Profile() if profile else None
+    _active = stats
+    sampler.start()
+    try:
+        if profiler:
+            profiler.enable()
+        try:
+            yield stats
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(profile)
+    finally:
+        stats.elapsed = time.perf_counter() - stats.start
+        stop.set()
+        sampler.join()
+        stats.sample()
+        _active = None
+        if report is not None:
+            _write_report(stats.report(), report)
+
+
+def _write_report(report: dict, dest: Union[Path, str, TextIO]) -> None:
+    if hasattr(dest, "write"):
+        json.dump(report, dest, indent=2)
+        dest.write("\n")
+        return
+    with open(dest, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
@@ -0,0 +1,56 @@
+import json
+from pathlib import Path
+
+import csv_converter
+import instrumentation
+from instrumentation import instrumented
+from pipeline import run_pipeline
+from testing import run_tests
+from utils import iter_marc_records
+
+HERE = Path(__file__).parent
+
+
+def test_instrumented(tmp_path):
+    source = HERE / "librarything_UMClassics.marc"
+    chunks = list(iter_marc_records(source))
+    with instrumented(
+        report=tmp_path / "report.json", profile=tmp_path / "run.prof"
+    ) as stats:
+        assert instrumentation.active() is stats
+        csv_converter.to_csv(source, tmp_path / "lt.csv")
+    # the tag pass isn't counted as records read
+    assert instrumentation.active() is None
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert report["counters"]["records"] == len(chunks)
+    assert report["counters"]["base64"] == sum(chunk.base64 for chunk in chunks)
+    assert report["counters"]["bytes"] == sum(len(chunk.data) for chunk in chunks)
+    assert report["stages"]["csv_row"]["calls"] == len(chunks)
+    assert {"split", "decode_64", "record_views", "collect_tags", "to_csv"} <= set(
+        report["stages"]
+    )
+    assert (
+        sum(stage["seconds"] for stage in report["stages"].values())
+        <= report["elapsed"]
+    )
+    assert report["peak_rss"] > 0 and stats.report()["counters"] == report["counters"]
+    assert (tmp_path / "run.prof").stat().st_size > 0
+
+
+def test_instrumented_pipeline(tmp_path):
+    # the reading, processing and writing threads each time their own stages
+    source = HERE / "librarything_UMClassics.marc"
+    sinks = {"marc": tmp_path / "lt.marc", "csv": tmp_path / "lt.csv"}
+    with instrumented() as stats:
+        written = run_pipeline(source, sinks)
+    report = stats.report()
+    assert report["counters"]["records"] == written == 6711
+    assert report["stages"]["process_record"]["calls"] == written
+    assert {"split", "csv_row", "to_csv", "to_marc"} <= set(report["stages"])
+    # nothing is timed outside the with block
+    run_pipeline(source, sinks)
+    assert stats.report()["stages"] == report["stages"]
+
+
+if __name__ == "__main__":
+    run_tests(globals())
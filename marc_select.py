@@ -0,0 +1,382 @@
+# picking records out of a marc file by their fields, without converting the file
+#
+# A query is a list of conditions on a tag, a subfield or a slice of the leader or a
+# control field, e.g. 050$a^=PA 6121 or 008/07-10>=1900, all of which a record has to
+# meet, and optionally a list of 001s. Records are looked at as cheaply as possible: a
+# plain record is dropped straight away if it doesn't contain the text a condition
+# needs, then the leader and the directory are checked (for base64 records, only the
+# directory is decoded for this), and only the fields a condition is on are read, for
+# the records that are left. Records that match are written as they are. With an offset
+# index (see utils.MarcIndex), the file isn't split again, and the text and the 001s are
+# looked up for the whole file at once, so only the candidates are looked at at all.
+
+import argparse
+import operator
+import re
+import sys
+from collections.abc import Callable, Generator, Iterable, Sequence
+from contextlib import ExitStack, nullcontext
+from pathlib import Path
+from typing import BinaryIO, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+import instrumentation
+from utils import (
+    MarcChunk,
+    MarcIndex,
+    _chunk_control,
+    _control_number,
+    _record_head,
+    iter_marc_records,
+    record_bytes,
+)
+
+# TAG[$code][/start[-end]][op value], with ! in
+# front for records that don't meet the rest
+_CONDITION = re.compile(
+    r"(?P<negate>!)?(?P<tag>LDR|[0-9A-Za-z]{3})(?:\$(?P<code>[0-9a-z]))?"
+    r"(?:/(?P<start>\d+)(?:-(?P<end>\d+))?)?"
+    r"(?:(?P<op>!=|\^=|<=|>=|=|<|>|~)(?P<value>.*))?",
+    re.DOTALL,
+)
+OPERATORS: dict[str, Callable[[bytes, bytes], bool]] = {
+    "=": operator.eq,
+    "^=": bytes.startswith,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+class Condition(NamedTuple):
+    """
+    What a record has to have: a field with `tag` (LDR for the leader), or, with `op`, a
+    field whose value meets `op` and `value`. The value is the data of a control field,
+    or with `code`, any of the subfields with that code, or the subfields of a data
+    field joined by spaces, and with `positions`, that slice of it (end excluded). With
+    `negate`, a record mustn't have such a field.
+    """
+
+    tag: bytes
+    code: Optional[bytes] = None
+    positions: Optional[Tuple[int, int]] = None
+    op: Optional[str] = None
+    value: Union[bytes, re.Pattern, None] = None
+    negate: bool = False
+
+
+def parse_condition(text: str) -> Condition:
+    """
+    Reads a condition written as TAG[$code][/start[-end]][op value], e.g. "245", "!856",
+    "050$a^=PA 6121", "LDR/06=a", "008/07-10>=1900" or "650$a~(?i)rome". Operators are =
+    != ^= (starts with), < <= > >= (bytewise, so numbers should be the same width) and ~
+    (regular expression search); values are compared as utf8 bytes, and taken as they
+    are, spaces included.
+    """
+    match = _CONDITION.fullmatch(text)
+    if match is None:
+        raise ValueError(f"Can't read condition {text!r}.")
+    start, end = match["start"], match["end"]
+    positions = None
+    if start is not None:
+        positions = (int(start), int(end if end is not None else start) + 1)
+    op, value = match["op"], match["value"]
+    negate = bool(match["negate"])
+    if op == "!=":
+        op, negate = "=", not negate
+    if op == "~":
+        value = re.compile(value.encode("utf8"))
+    elif op is not None:
+        value = value.encode("utf8")
+    return Condition(
+        match["tag"].encode(),
+        match["code"].encode() if match["code"] else None,
+        positions,
+        op,
+        value,
+        negate,
+    )
+
+
+def _needle(condition: Condition) -> Optional[bytes]:
+    """
+    bytes that a record meeting the condition has
+    to contain, if there are any worth looking for
+    """
+    if (
+        condition.negate
+        or condition.op not in ("=", "^=")
+        or not condition.value
+        or condition.tag == b"LDR"
+    ):
+        return None
+    if condition.code is not None:
+        return (
+            b"\x1f" + condition.code + condition.value
+            if condition.positions is None
+            else condition.value
+        )
+    if condition.tag < b"010" and condition.tag.isdigit():
+        return condition.value
+    # the subfields of a data field are joined by spaces, which aren't in the record
+    return None
+
+
+def _entries(record: bytes, tag: bytes, base: int) -> list[Tuple[int, int]]:
+    "(start, length) of the fields with a tag, found in the directory of a marc record"
+    entries = []
+    i = record.find(tag, 24, base - 1)
+    while i >= 0:
+        if (i - 24) % 12:
+            i = record.find(tag, i + 1, base - 1)
+            continue
+        try:
+            entries.append(
+                (base + int(record[i + 7 : i + 12]), int(record[i + 3 : i + 7]))
+            )
+        except ValueError:
+            pass
+        i = record.find(tag, i + 12, base - 1)
+    return entries
+
+
+def _values(condition: Condition, field: bytes) -> list[bytes]:
+    "the values of a field (without its terminator) that a condition looks at"
+    if condition.tag == b"LDR" or (condition.tag < b"010" and condition.tag.isdigit()):
+        values = [field]
+    elif condition.code is not None:
+        values = [
+            subfield[1:]
+            for subfield in field.split(b"\x1f")[1:]
+            if subfield[:1] == condition.code
+        ]
+    else:
+        values = [b" ".join(subfield[1:] for subfield in field.split(b"\x1f")[1:])]
+    if condition.positions is not None:
+        start, end = condition.positions
+        values = [value[start:end] for value in values]
+    return values
+
+
+def _test(condition: Condition) -> Callable[[bytes], bool]:
+    "whether a value meets the condition, before negating it"
+    if condition.op == "~":
+        return condition.value.search
+    compare, target = OPERATORS[condition.op], condition.value
+    return lambda value: compare(value, target)
+
+
+def _meets(
+    condition: Condition, test: Callable[[bytes], bool], fields: Iterable[bytes]
+) -> bool:
+    "whether any value in the fields meets the condition, before negating it"
+    for field in fields:
+        for value in _values(condition, field):
+            if test(value):
+                return True
+    return False
+
+
+class Query:
+    """
+    The conditions a record has to meet (see Condition, or
+    parse_condition for them written out), and optionally the 001s it has
+    to have one of. Calling a query with a record from iter_marc_records
+    returns the record's marc bytes if it matches, or None.
+    """
+
+    def __init__(
+        self,
+        conditions: Sequence[Union[Condition, str]] = (),
+        controls: Optional[Iterable[Union[str, bytes]]] = None,
+    ):
+        self.conditions = [
+            parse_condition(condition) if isinstance(condition, str) else condition
+            for condition in conditions
+        ]
+        self.controls = None
+        if controls is not None:
+            self.controls = frozenset(
+                control.encode("utf8") if isinstance(control, str) else control
+                for control in controls
+            )
+        self.needles = [needle for needle in map(_needle, self.conditions) if needle]
+        # leader conditions first, as they are the cheapest, with their tests
+        tests = [
+            None if condition.op is None else _test(condition)
+            for condition in self.conditions
+        ]
+        self._leader = [
+            (c, test) for c, test in zip(self.conditions, tests) if c.tag == b"LDR"
+        ]
+        self._fields = [
+            (c, test) for c, test in zip(self.conditions, tests) if c.tag != b"LDR"
+        ]
+
+    @instrumentation.timed("select")
+    def __call__(self, chunk: MarcChunk) -> Optional[bytes]:
+        if chunk.base64:
+            record = None
+            head = _record_head(chunk, 24)
+        else:
+            record = bytes(chunk.data)
+            for needle in self.needles:
+                if needle not in record:
+                    return None
+            head = record
+        for condition, test in self._leader:
+            met = test is None or _meets(condition, test, [head[:24]])
+            if met == condition.negate:
+                return None
+        if self.controls is not None:
+            control = (
+                _control_number(record) if record is not None else _chunk_control(chunk)
+            )
+            if control not in self.controls:
+                return None
+        if not self._fields:
+            return record if record is not None else record_bytes(chunk)
+        try:
+            base = int(head[12:17])
+        except ValueError:
+            return None
+        if record is None:
+            head = _record_head(chunk, base)
+        # the tags of the conditions, from the directory, before reading any fields
+        entries = []
+        for condition, test in self._fields:
+            found = _entries(head, condition.tag, base)
+            if test is None and bool(found) == condition.negate:
+                return None
+            if test is not None and not found and not condition.negate:
+                return None
+            entries.append(found)
+        if record is None:
+            record = record_bytes(chunk)
+        for (condition, test), found in zip(self._fields, entries):
+            if test is None or not found:
+                continue
+            fields = [record[start : start + length - 1] for start, length in found]
+            if _meets(condition, test, fields) == condition.negate:
+                return None
+        return record
+
+    def candidates(self, index: MarcIndex) -> np.ndarray:
+        """
+        The positions in `index` of the records that can match, in file order: those
+        that have one of the 001s and contain the text conditions need, found for the
+        whole file at once.
+        """
+        rows = index.rows
+        keep = np.ones(len(rows), bool)
+        if self.controls is not None:
+            # the index keeps the first 23 bytes of each 001, so longer ones are checked
+            # again by __call__
+            keep &= np.isin(
+                rows["control"],
+                np.array([control[:23] for control in self.controls], "S23"),
+            )
+        for needle in self.needles:
+            # base64 records can't be searched as they are in the file
+            keep &= index.containing(needle) | rows["base64"]
+        return np.flatnonzero(keep)
+
+
+def select_records(
+    source: Union[Path, str, BinaryIO], query: Query, index: Optional[MarcIndex] = None
+) -> Generator[bytes]:
+    """
+    Generator of the marc bytes of the records in `source` that match `query`, in file
+    order, read through `index` if given.
+    """
+    if index is None:
+        chunks = iter_marc_records(source)
+    else:
+        chunks = index.chunks(query.candidates(index))
+    for chunk in chunks:
+        record = query(chunk)
+        if record is not None:
+            yield record
+
+
+def marc_select(
+    source: Union[Path, str, BinaryIO],
+    dest: Union[Path, str, BinaryIO],
+    conditions: Sequence[Union[Condition, str]] = (),
+    controls: Optional[Iterable[Union[str, bytes]]] = None,
+    index: Optional[MarcIndex] = None,
+) -> int:
+    """
+    Writes the records of a marc file (plain, or mixed with base64 records) that meet
+    all the conditions (see parse_condition) and, if `controls` is given, have one of
+    those 001s, to dest, a path or a binary file. Plain records are written byte for
+    byte as they are in the source, and base64 records decoded. Uses `index` if given,
+    or the source's index (<source>.idx) if there is one, which is brought up to date if
+    the source has changed. Returns the number of records written.
+    """
+    query = Query(conditions, controls)
+    with ExitStack() as stack:
+        if (
+            index is None
+            and not hasattr(source, "read")
+            and Path(f"{source}.idx").exists()
+        ):
+            # opened here, so closed here too
+            index = stack.enter_context(MarcIndex(source))
+        f = stack.enter_context(
+            nullcontext(dest) if hasattr(dest, "write") else open(dest, "wb")
+        )
+        written = 0
+        for record in select_records(source, query, index):
+            f.write(record)
+            written += 1
+    return written
+
+
+def _parse_args(args: Optional[Iterable[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Write the records of a marc file that meet some conditions "
+        "to a new marc file."
+    )
+    parser.add_argument("source", help="marc file to read, or - for stdin")
+    parser.add_argument("dest", help="marc file to write, or - for stdout")
+    parser.add_argument(
+        "--where",
+        action="append",
+        default=[],
+        help='a condition records have to meet, e.g. "050$a^=PA 6121" '
+        'or "008/07-10>=1900"; can be repeated',
+    )
+    parser.add_argument("--control", nargs="+", help="001s of the records to write")
+    parser.add_argument(
+        "--controls", help="file with the 001s of the records to write, one per line"
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="index the source (<source>.idx) first, "
+        "which makes this and later selections quicker",
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    controls = None
+    if args.control or args.controls:
+        controls = list(args.control or [])
+        if args.controls:
+            controls += Path(args.controls).read_text("utf8").split()
+    if args.index and args.source == "-":
+        raise ValueError("--index needs a source file.")
+    with MarcIndex(args.source) if args.index else nullcontext() as index:
+        written = marc_select(
+            sys.stdin.buffer if args.source == "-" else args.source,
+            sys.stdout.buffer if args.dest == "-" else args.dest,
+            args.where,
+            controls,
+            index,
+        )
+    print(f"selected {written} records", file=sys.stderr)
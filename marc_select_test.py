@@ -0,0 +1,104 @@
+import re
+from pathlib import Path
+
+import marc_select as marc_select_module
+from marc_select import marc_select, parse_condition
+from testing import run_tests
+from utils import (
+    MarcIndex,
+    RecordView,
+    _control_number,
+    iter_marc_records,
+    record_bytes,
+)
+
+HERE = Path(__file__).parent
+
+
+def test_marc_select(tmp_path):
+    source = tmp_path / "lt.marc"
+    source.write_bytes((HERE / "librarything_UMClassics.marc").read_bytes())
+    chunks = list(iter_marc_records(source))
+    views = [
+        RecordView(record_bytes(chunk), force_utf8=True, utf8_handling="replace")
+        for chunk in chunks
+    ]
+    subfields = lambda view, tag, code: [
+        s for f in view.get_fields(tag) for s in f.get_subfields(code)
+    ]
+    queries = [
+        (
+            ["090$a^=LOEB-PA 6121"],
+            lambda view: any(
+                s.startswith("LOEB-PA 6121") for s in subfields(view, "090", "a")
+            ),
+        ),
+        (
+            ["LDR/06= ", "!020"],
+            lambda view: view.leader[6] == " " and "020" not in view,
+        ),
+        (
+            ["264$c~19[0-4]\\d", "100", "005/00-03>=2024"],
+            lambda view: (
+                any(re.search(r"19[0-4]\d", s) for s in subfields(view, "264", "c"))
+                and "100" in view
+                and view["005"].data[:4] >= "2024"
+            ),
+        ),
+    ]
+    assert parse_condition("008/07-10!=1900") == (
+        b"008",
+        None,
+        (7, 11),
+        "=",
+        b"1900",
+        True,
+    )
+    for conditions, keep in queries:
+        expected = b"".join(
+            record_bytes(chunk) for chunk, view in zip(chunks, views) if keep(view)
+        )
+        assert (
+            marc_select(source, tmp_path / "plain.mrc", conditions)
+            == expected.count(b"\x1d")
+            > 0
+        )
+        assert (tmp_path / "plain.mrc").read_bytes() == expected
+        # with an index next to the source, which is used without asking
+        MarcIndex(source).close()
+        marc_select(source, tmp_path / "indexed.mrc", conditions)
+        assert (tmp_path / "indexed.mrc").read_bytes() == expected
+        (tmp_path / "lt.marc.idx").unlink()
+    # plain records are written as they are, and base64 ones decoded
+    controls = [_control_number(record_bytes(chunk)).decode() for chunk in chunks[:20]]
+    assert marc_select(source, tmp_path / "some.mrc", controls=controls[::2]) == 10
+    assert (tmp_path / "some.mrc").read_bytes() == b"".join(
+        record_bytes(chunk) for chunk in chunks[:20:2]
+    )
+
+
+def test_marc_select_closes_its_index(tmp_path):
+    source = tmp_path / "pga.mrc"
+    source.write_bytes((HERE / "PGA-Australiana.mrc").read_bytes())
+    MarcIndex(source).close()
+    opened = []
+
+    class RecordedIndex(MarcIndex):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            opened.append(self)
+
+    marc_select_module.MarcIndex = RecordedIndex
+    try:
+        assert marc_select(source, tmp_path / "all.mrc") == 278
+    finally:
+        marc_select_module.MarcIndex = MarcIndex
+    # the index found next to the source is closed, and an index passed in isn't
+    assert len(opened) == 1 and opened[0]._data == b"" and not len(opened[0].rows)
+    with MarcIndex(source) as index:
+        marc_select(source, tmp_path / "all.mrc", index=index)
+        assert len(index.rows) == 278
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -0,0 +1,871 @@
+# streaming pipeline: a marc file (mixed with base64 records, or from stdin) in,
+# cleaned marc, csv and parquet out, in a single pass
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import mmap
+import os
+import pickle
+import queue
+import sys
+import threading
+from collections.abc import Callable, Generator, Iterable, Sequence
+from contextlib import ExitStack, nullcontext
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryFile
+from typing import BinaryIO, Optional, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pymarc import Record
+
+import instrumentation
+from csv_converter import (
+    _csv_row,
+    _csv_row_bytes,
+    _parquet_row,
+    _parquet_row_bytes,
+    parquet_schema,
+)
+from utils import (
+    MarcChunk,
+    _chunk_control,
+    _chunk_tags,
+    collect_tags,
+    detect_encoding,
+    iter_marc_records,
+    map_record_batches,
+    record_bytes,
+    transcode_record,
+)
+from validation import Validator, print_summary
+
+# marks the end of a queue
+_DONE = object()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> None:
+    "puts item on a bounded queue, giving up if the pipeline is being stopped"
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _drain(q: queue.Queue) -> Generator:
+    "yields the items of a queue of lists, up to _DONE"
+    while (batch := q.get()) is not _DONE:
+        yield from batch
+
+
+def has_tags(tags: Sequence[str], record: Record) -> bool:
+    "filter for run_pipeline: keeps records that have a field with each of tags."
+    return all(record.get(tag) is not None for tag in tags)
+
+
+def drop_tags(tags: Sequence[str], record: Record) -> Record:
+    "transform for run_pipeline: removes every field with one of tags."
+    record.remove_fields(*tags)
+    return record
+
+
+@instrumentation.timed("process_record")
+def _process_record(
+    chunk: MarcChunk,
+    needs: frozenset[str],
+    encoding: str,
+    errors: str,
+    filters: Sequence[Callable[[Record], bool]],
+    transforms: Sequence[Callable[[Record], Optional[Record]]],
+    include_indicator: bool,
+) -> Optional[dict]:
+    """
+    Decodes, normalizes and transcodes a record to utf8, applies filters and transforms,
+    and returns a dict with what the sinks need: "marc" bytes, a "csv" row and/or a
+    "parquet" row, or None if the record is filtered out or can't be read. Records are
+    only parsed with pymarc for filters and transforms, otherwise the rows are read
+    straight from the record bytes.
+    """
+    item = {}
+    try:
+        # corrupt base64, or text that can't be decoded with errors="strict"
+        data = record_bytes(chunk)
+        codec = (
+            detect_encoding(data)
+            if encoding == "auto"
+            else ("utf8" if chunk.base64 else encoding)
+        )
+        marc = transcode_record(data, codec, errors)
+        if filters or transforms:
+            record = Record(data=marc, to_unicode=True, force_utf8=True)
+            if not all(keep(record) for keep in filters):
+                return None
+            for transform in transforms:
+                record = transform(record)
+                if record is None:
+                    return None
+            if transforms:
+                marc = record.as_marc()
+            if "csv" in needs:
+                item["csv"] = _csv_row(record, include_indicator)
+            if "parquet" in needs:
+                item["parquet"] = _parquet_row(record)
+        else:
+            if "csv" in needs:
+                item["csv"] = _csv_row_bytes(marc, include_indicator)
+            if "parquet" in needs:
+                item["parquet"] = _parquet_row_bytes(marc)
+    except Exception as e:
+        instrumentation.count("skipped")
+        print(f"warning: record at byte {chunk.offset} skipped: {e!r}", file=sys.stderr)
+        return None
+    if "marc" in needs:
+        item["marc"] = marc
+    return item
+
+
+def _process_batch(
+    batch: list[MarcChunk], validator: Optional[Validator] = None, **kwargs
+) -> list[dict]:
+    """
+    _process_record for a batch of records, leaving out those
+    that aren't kept. With a validator, the marc of the records
+    kept is checked, and their problems are in "issues".
+    """
+    items = [(chunk.offset, _process_record(chunk, **kwargs)) for chunk in batch]
+    items = [(offset, item) for offset, item in items if item is not None]
+    if validator is not None and items:
+        by_offset = dict(items)
+        records = [item["marc"] for item in by_offset.values()]
+        for issue in validator.scan_batch(records, list(by_offset)):
+            by_offset[issue[0]].setdefault("issues", []).append(issue)
+    return [item for _, item in items]
+
+
+def _open_binary(dest: Union[Path, str]) -> BinaryIO:
+    return sys.stdout.buffer if str(dest) == "-" else open(dest, "wb")
+
+
+class _Spool:
+    """
+    rows pickled to a temporary file, for sinks that only know their columns once every
+    row is in
+    """
+
+    def __init__(self):
+        self.f = TemporaryFile()
+        self.tags = set()
+
+    def add(self, rows: list[dict]) -> None:
+        for row in rows:
+            self.tags.update(row)
+        pickle.dump(rows, self.f, pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self) -> Generator[list[dict]]:
+        self.f.seek(0)
+        while True:
+            try:
+                yield pickle.load(self.f)
+            except EOFError:
+                self.f.close()
+                return
+
+
+class MarcSink:
+    "writes the cleaned records as utf8 marc"
+
+    needs = "marc"
+
+    def __init__(self, dest: Union[Path, str], columns=None):
+        self.f = _open_binary(dest)
+        self.to_stdout = str(dest) == "-"
+
+    @instrumentation.timed("to_marc")
+    def write(self, items: list[dict]) -> None:
+        self.f.write(b"".join(item["marc"] for item in items))
+
+    def close(self) -> None:
+        self.f.flush()
+        if not self.to_stdout:
+            self.f.close()
+
+
+class CsvSink:
+    """
+    writes csv in the format of csv_converter.to_csv. Without columns, rows are spooled
+    to a temporary file and written at the end, with the tags found as columns.
+    """
+
+    needs = "csv"
+
+    def __init__(self, dest: Union[Path, str], columns: Optional[Sequence[str]] = None):
+        self.dest = dest
+        self.to_stdout = str(dest) == "-"
+        self.spool = None
+        if columns is None:
+            self.spool = _Spool()
+            return
+        self._open(columns)
+
+    def _open(self, columns: Sequence[str]) -> None:
+        if self.to_stdout:
+            self.f = sys.stdout
+        else:
+            self.f = open(self.dest, "w", encoding="utf8", newline="")
+        self.writer = csv.DictWriter(self.f, list(columns), extrasaction="ignore")
+        self.writer.writeheader()
+
+    @instrumentation.timed("to_csv")
+    def write(self, items: list[dict]) -> None:
+        rows = [item["csv"] for item in items]
+        if self.spool is not None:
+            self.spool.add(rows)
+            return
+        self.writer.writerows(rows)
+
+    @instrumentation.timed("to_csv")
+    def close(self) -> None:
+        if self.spool is not None:
+            self._open(sorted(self.spool.tags | {"LDR"}))
+            for rows in self.spool:
+                self.writer.writerows(rows)
+        self.f.flush()
+        if not self.to_stdout:
+            self.f.close()
+
+
+class ParquetSink:
+    """
+    writes parquet in the format of csv_converter.to_parquet, one row group per batch.
+    Without columns, rows are spooled to a temporary file and written at the end.
+    """
+
+    needs = "parquet"
+
+    def __init__(self, dest: Union[Path, str], columns: Optional[Sequence[str]] = None):
+        self.dest = dest
+        self.to_stdout = str(dest) == "-"
+        self.spool = None
+        if columns is None:
+            self.spool = _Spool()
+            return
+        self._open(columns)
+
+    def _open(self, columns: Sequence[str]) -> None:
+        self.f = _open_binary(self.dest)
+        self.schema = parquet_schema(columns)
+        self.writer = pq.ParquetWriter(self.f, self.schema)
+
+    @instrumentation.timed("to_parquet")
+    def write(self, items: list[dict]) -> None:
+        rows = [item["parquet"] for item in items]
+        if self.spool is not None:
+            self.spool.add(rows)
+            return
+        if rows:
+            self.writer.write_table(pa.Table.from_pylist(rows, self.schema))
+
+    @instrumentation.timed("to_parquet")
+    def close(self) -> None:
+        if self.spool is not None:
+            self._open(sorted(self.spool.tags - {"LDR"}))
+            for rows in self.spool:
+                if rows:
+                    self.writer.write_table(pa.Table.from_pylist(rows, self.schema))
+        self.writer.close()
+        self.f.flush()
+        if not self.to_stdout:
+            self.f.close()
+
+
+SINKS = {"marc": MarcSink, "csv": CsvSink, "parquet": ParquetSink}
+
+
+def run_pipeline(
+    source: Union[Path, str, BinaryIO],
+    sinks: dict[str, Union[Path, str]],
+    encoding="auto",
+    errors="replace",
+    filters: Sequence[Callable[[Record], bool]] = (),
+    transforms: Sequence[Callable[[Record], Optional[Record]]] = (),
+    columns: Optional[Sequence[str]] = None,
+    include_indicator=True,
+    workers: int = 1,
+    batch_size: int = 500,
+    queue_size: int = 8,
+    validator: Optional[Validator] = None,
+) -> int:
+    """
+    Reads a marc file, or a binary stream such as sys.stdin.buffer, with a mix of plain
+    and base64 records, and writes the records to every sink in one pass: sinks maps
+    "marc", "csv" and/or "parquet" to a path, or "-" for stdout. Each record is decoded,
+    has its encoding detected (or uses `encoding` for plain records), is normalized and
+    transcoded to utf8 as in flatten_mixed_marc, then parsed with pymarc if filters,
+    transforms, csv or parquet need it. Filters take a Record and return whether to keep
+    it; transforms return a Record, or None to drop it. Reading, processing (in
+    `workers` processes if workers > 1) and each sink run in their own threads,
+    connected by queues holding at most queue_size batches of batch_size records, so the
+    file I/O overlaps with the decoding and memory use stays bounded. The csv and
+    parquet columns are `columns` if given, otherwise the tags in the file, collected
+    with a cheap first pass over the record directories; from a stream, the rows are
+    spooled instead. With a validation.Validator, the cleaned marc of each record
+    written is checked, and the problems are added to the validator's issues at the
+    record's offset in the source. Returns the number of records written.
+    """
+    if not sinks:
+        raise ValueError("At least one of marc, csv or parquet output is needed.")
+    needs = frozenset(sinks)
+    if columns is None and needs - {"marc"} and not hasattr(source, "read"):
+        # every entry should have a leader, which isn't in the record directory
+        columns = sorted(collect_tags(source) | {"LDR"})
+    opened = [SINKS[kind](dest, columns) for kind, dest in sinks.items()]
+
+    stop = threading.Event()
+    failures = []
+
+    def read(q: queue.Queue) -> None:
+        try:
+            batch = []
+            for chunk in iter_marc_records(source):
+                batch.append(chunk)
+                if len(batch) == batch_size:
+                    _put(q, batch, stop)
+                    batch = []
+            if batch:
+                _put(q, batch, stop)
+        except BaseException as e:
+            # the processing thread stops at _DONE and raises it
+            failures.append(e)
+        finally:
+            _put(q, _DONE, stop)
+
+    def write(sink, q: queue.Queue) -> None:
+        items = None
+        try:
+            while (items := q.get()) is not _DONE:
+                if not failures:
+                    sink.write(items)
+            sink.close()
+        except BaseException as e:
+            failures.append(e)
+            stop.set()
+            # keep taking batches so that the processing thread isn't blocked
+            while items is not _DONE:
+                items = q.get()
+
+    chunks = queue.Queue(queue_size)
+    outputs = [queue.Queue(queue_size) for _ in opened]
+    threads = [threading.Thread(target=read, args=(chunks,), daemon=True)]
+    threads += [
+        threading.Thread(target=write, args=(sink, q), daemon=True)
+        for sink, q in zip(opened, outputs)
+    ]
+    for thread in threads:
+        thread.start()
+
+    process = partial(
+        _process_batch,
+        validator=validator,
+        # the validator checks the marc, even if it isn't written
+        needs=needs | {"marc"} if validator is not None else needs,
+        encoding=encoding,
+        errors=errors,
+        filters=tuple(filters),
+        transforms=tuple(transforms),
+        include_indicator=include_indicator,
+    )
+    written = 0
+    try:
+        for items in map_record_batches(process, _drain(chunks), workers, batch_size):
+            if stop.is_set():
+                break
+            written += len(items)
+            if validator is not None:
+                validator.add(
+                    [issue for item in items for issue in item.get("issues", ())],
+                    len(items),
+                )
+            for q in outputs:
+                _put(q, items, stop)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for q in outputs:
+            q.put(_DONE)
+        for thread in threads[1:]:
+            thread.join()
+    if failures:
+        raise failures[0]
+    return written
+
+
+# one row of the state of an incremental export: a record's 001, which it is matched by
+# on the next run, a hash of its bytes in the source, which tells whether it changed,
+# and where it was written to in the marc and csv output (length 0 if it was filtered
+# out)
+STATE_DTYPE = np.dtype(
+    [
+        ("control", "S23"),
+        ("hash", "<u8"),
+        ("marc_offset", "<u8"),
+        ("marc_length", "<u4"),
+        ("csv_offset", "<u8"),
+        ("csv_length", "<u4"),
+    ]
+)
+
+
+def _record_hash(data: Union[bytes, memoryview]) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def _describe(func: Callable) -> str:
+    """
+    a stable description of a filter or transform,
+    for checking that a state file still applies
+    """
+    if isinstance(func, partial):
+        return f"{_describe(func.func)}{func.args!r}{func.keywords!r}"
+    return f"{func.__module__}.{func.__qualname__}"
+
+
+def load_state(path: Union[Path, str]) -> Optional[Tuple[np.ndarray, dict]]:
+    """
+    Reads a state file written by run_incremental, as its STATE_DTYPE rows and its
+    metadata, or None.
+    """
+    try:
+        with np.load(path) as state:
+            return state["records"], json.loads(str(state["meta"]))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def save_state(path: Union[Path, str], records: np.ndarray, meta: dict) -> None:
+    with open(path, "wb") as f:
+        np.savez(f, records=records, meta=np.array(json.dumps(meta)))
+
+
+def _process_entries(entries: list[tuple], **kwargs) -> list:
+    """
+    processes the new records in a batch of
+    run_incremental entries, passing the others through
+    """
+    return [
+        _process_record(chunk, **kwargs) if chunk is not None else None
+        for _, _, _, chunk in entries
+    ]
+
+
+def run_incremental(
+    source: Union[Path, str],
+    marc: Union[Path, str],
+    csv_dest: Optional[Union[Path, str]] = None,
+    state: Optional[Union[Path, str]] = None,
+    encoding="auto",
+    errors="replace",
+    filters: Sequence[Callable[[Record], bool]] = (),
+    transforms: Sequence[Callable[[Record], Optional[Record]]] = (),
+    include_indicator=True,
+    workers: int = 1,
+    batch_size: int = 500,
+) -> dict:
+    """
+    Like run_pipeline with marc (and optionally csv) output, but only processes the
+    records that are new or have changed since the last run. The state of each run is
+    kept in `state` (<marc>.state by default): the 001 of every record in the source, a
+    hash of its raw bytes, and where it went in the outputs. Records are matched with
+    the last run by their 001 (by their hash if they have none), and those whose hash is
+    the same are byte-copied from the previous outputs, so a run costs little more than
+    reading the source once when only a few records have changed. Also writes
+    delta_<marc>, with just the new and changed records, and deleted_<marc>.txt, with
+    the 001 of every record that was in the last run but isn't in the source any more.
+    If there is no usable state, e.g. on the first run, or if the outputs or the options
+    have changed since, every record is processed. New csv columns are added after the
+    previous ones, and the copied rows get empty cells for them. Returns counts of the
+    records that were copied, converted (of which changed: those with a 001 from the
+    last run) and deleted.
+    """
+    marc = Path(marc)
+    state = Path(state) if state else Path(f"{marc}.state")
+    options = {
+        "encoding": encoding,
+        "errors": errors,
+        "include_indicator": include_indicator,
+        "filters": [_describe(f) for f in filters],
+        "transforms": [_describe(f) for f in transforms],
+    }
+    previous = load_state(state)
+    if previous is not None and not _state_applies(
+        previous[1], options, marc, csv_dest
+    ):
+        previous = None
+    rows, meta = previous if previous is not None else (np.empty(0, STATE_DTYPE), {})
+
+    # one pass over the source to match each record with its row in the state by its
+    # 001 (or its hash, without one), and tell from the hash whether it has changed
+    old_controls = rows["control"].tolist()
+    old_hashes = rows["hash"].tolist()
+    by_key = {}
+    for j, (control, digest) in enumerate(zip(old_controls, old_hashes)):
+        by_key.setdefault(control or digest, []).append(j)
+    used = [False] * len(rows)
+    # (control, hash, previous row or -1, (offset, length, base64)) per record, with
+    # only the location of the records to process
+    entries = []
+    controls = set()
+    tags = set()
+    changed = 0
+    for chunk in iter_marc_records(source):
+        digest = _record_hash(chunk.data)
+        control = _chunk_control(chunk)[:23]
+        controls.add(control)
+        j = _match(by_key.get(control or digest, ()), digest, old_hashes, used)
+        if j >= 0:
+            used[j] = True
+            if old_hashes[j] == digest:
+                entries.append((control, digest, j, None))
+                continue
+            changed += 1
+        if csv_dest is not None:
+            tags.update(_chunk_tags(chunk))
+        entries.append(
+            (control, digest, -1, (chunk.offset, len(chunk.data), chunk.base64))
+        )
+    deleted = sorted(
+        {control for control, was_used in zip(old_controls, used) if not was_used}
+        - controls
+        - {b""}
+    )
+
+    columns = meta.get("columns") or ["LDR"]
+    added = sorted({tag.decode("ascii", "replace") for tag in tags} - set(columns))
+    # previous rows are widened to the new columns as they are copied
+    padding = b"," * len(added) if meta.get("columns") else b""
+    columns += added
+    if not meta.get("columns"):
+        columns = sorted(columns)
+
+    needs = frozenset(["marc", "csv"] if csv_dest is not None else ["marc"])
+    process = partial(
+        _process_entries,
+        needs=needs,
+        encoding=encoding,
+        errors=errors,
+        filters=tuple(filters),
+        transforms=tuple(transforms),
+        include_indicator=include_indicator,
+    )
+    old_rows = rows[["marc_offset", "marc_length", "csv_offset", "csv_length"]].tolist()
+    new_rows = []
+    counts = {
+        "records": len(entries),
+        "copied": 0,
+        "converted": 0,
+        "changed": changed,
+        "deleted": len(deleted),
+    }
+    tmp_marc = marc.with_name(f"{marc.name}.tmp")
+    tmp_csv = Path(f"{csv_dest}.tmp") if csv_dest is not None else None
+    with ExitStack() as stack:
+        old_marc = _map_file(stack, marc) if previous is not None else b""
+        old_csv = (
+            _map_file(stack, csv_dest) if previous is not None and csv_dest else b""
+        )
+        out_marc = stack.enter_context(open(tmp_marc, "wb"))
+        delta = stack.enter_context(open(marc.with_name(f"delta_{marc.name}"), "wb"))
+        out_csv = stack.enter_context(open(tmp_csv, "wb")) if tmp_csv else None
+        if out_csv:
+            line = io.StringIO()
+            csv.writer(line).writerow(columns)
+            out_csv.write(line.getvalue().encode("utf8"))
+            row_writer = csv.DictWriter(line, columns, extrasaction="ignore")
+        # ranges of the previous outputs to copy, grown while they are contiguous
+        marc_copy = _RangeCopy(old_marc, out_marc)
+        csv_copy = _RangeCopy(old_csv, out_csv, padding)
+        loaded = _load_entries(entries, _map_file(stack, source))
+        results = map_record_batches(process, loaded, workers, batch_size)
+        i = 0
+        for batch in results:
+            for item in batch:
+                control, digest, j, _ = entries[i]
+                i += 1
+                if j >= 0:
+                    counts["copied"] += 1
+                    marc_offset, marc_length, csv_offset, csv_length = old_rows[j]
+                    marc_offset = marc_copy.add(marc_offset, marc_length)
+                    if out_csv and csv_length:
+                        csv_offset = csv_copy.add(csv_offset, csv_length)
+                        csv_length += len(padding)
+                elif item is not None:
+                    counts["converted"] += 1
+                    marc_copy.flush()
+                    marc_offset, marc_length = out_marc.tell(), len(item["marc"])
+                    out_marc.write(item["marc"])
+                    delta.write(item["marc"])
+                    csv_offset = csv_length = 0
+                    if out_csv:
+                        csv_copy.flush()
+                        line.seek(0)
+                        line.truncate()
+                        row_writer.writerow(item["csv"])
+                        text = line.getvalue().encode("utf8")
+                        csv_offset, csv_length = out_csv.tell(), len(text)
+                        out_csv.write(text)
+                else:
+                    # filtered out, so there's nothing to copy next time either
+                    marc_offset, marc_length, csv_offset, csv_length = 0, 0, 0, 0
+                new_rows.append(
+                    (control, digest, marc_offset, marc_length, csv_offset, csv_length)
+                )
+        marc_copy.flush()
+        csv_copy.flush()
+    os.replace(tmp_marc, marc)
+    if tmp_csv:
+        os.replace(tmp_csv, csv_dest)
+    with open(marc.with_name(f"deleted_{marc.name}.txt"), "w") as f:
+        f.writelines(f"{control.decode('utf8', 'replace')}\n" for control in deleted)
+    save_state(
+        state,
+        np.array(new_rows, STATE_DTYPE),
+        {
+            "options": options,
+            "columns": columns if csv_dest is not None else None,
+            "marc_size": marc.stat().st_size,
+            "csv_size": Path(csv_dest).stat().st_size if csv_dest is not None else None,
+        },
+    )
+    return counts
+
+
+def _match(candidates: Sequence[int], digest: int, hashes: list, used: list) -> int:
+    """
+    the first unused row of the state among candidates with the same hash, or else the
+    first unused one, or -1
+    """
+    match = -1
+    for j in candidates:
+        if not used[j]:
+            if hashes[j] == digest:
+                return j
+            if match < 0:
+                match = j
+    return match
+
+
+def _load_entries(
+    entries: list[tuple], data: Union[mmap.mmap, bytes]
+) -> Generator[tuple]:
+    """
+    run_incremental entries with the records to process read again from the source, as
+    they are needed
+    """
+    for control, digest, j, location in entries:
+        if location is not None:
+            offset, length, base64 = location
+            location = MarcChunk(offset, bytes(data[offset : offset + length]), base64)
+        yield control, digest, j, location
+
+
+def _state_applies(
+    meta: dict, options: dict, marc: Path, csv_dest: Optional[Union[Path, str]]
+) -> bool:
+    """
+    whether the outputs of the last run are still
+    there as they were, and were made the same way
+    """
+    if meta["options"] != options or not marc.exists():
+        return False
+    if marc.stat().st_size != meta["marc_size"]:
+        return False
+    if csv_dest is None:
+        return True
+    return (
+        meta["csv_size"] is not None
+        and Path(csv_dest).exists()
+        and Path(csv_dest).stat().st_size == meta["csv_size"]
+    )
+
+
+def _map_file(stack: ExitStack, path: Union[Path, str]) -> Union[mmap.mmap, bytes]:
+    """
+    memory-maps a file for reading for as long as
+    stack is open (mmap can't map an empty file)
+    """
+    f = stack.enter_context(open(path, "rb"))
+    if not os.fstat(f.fileno()).st_size:
+        return b""
+    return stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class _RangeCopy:
+    """
+    copies byte ranges from a previous output, joining contiguous ranges into a single
+    write. With padding, each range is a csv row, and gets the padding (empty cells for
+    new columns) before its line terminator, so ranges are copied one by one.
+    """
+
+    def __init__(
+        self,
+        source: Union[mmap.mmap, bytes],
+        out: Optional[BinaryIO],
+        padding: bytes = b"",
+    ):
+        self.source = source
+        self.out = out
+        self.padding = padding
+        self.start = self.end = 0
+
+    def add(self, start: int, length: int) -> int:
+        "queues a range to be copied, and returns the offset it will have in the output"
+        if self.padding:
+            self.flush()
+            offset = self.out.tell()
+            # csv.writer ends rows with \r\n
+            self.out.write(self.source[start : start + length - 2])
+            self.out.write(self.padding + b"\r\n")
+            return offset
+        if start != self.end:
+            self.flush()
+            self.start = self.end = start
+        offset = self.out.tell() + (self.end - self.start)
+        self.end += length
+        return offset
+
+    def flush(self) -> None:
+        if self.end > self.start:
+            self.out.write(self.source[self.start : self.end])
+        self.start = self.end
+
+
+def _parse_args(args: Optional[Iterable[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Clean a marc file with base64 records and convert it in one pass."
+        " With no output options, writes cleaned marc to stdout."
+    )
+    parser.add_argument(
+        "source", nargs="?", default="-", help="marc file to read, or - for stdin"
+    )
+    for kind in SINKS:
+        parser.add_argument(f"--{kind}", help=f"where to write {kind}, or - for stdout")
+    parser.add_argument(
+        "--encoding",
+        default="auto",
+        help="encoding of the plain records, or auto to detect it record by record",
+    )
+    parser.add_argument("--errors", default="replace")
+    parser.add_argument(
+        "--has", nargs="+", default=[], help="only keep records with all these tags"
+    )
+    parser.add_argument(
+        "--drop", nargs="+", default=[], help="remove the fields with these tags"
+    )
+    parser.add_argument("--columns", nargs="+", help="csv and parquet columns")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only process the records that changed since the last run; "
+        "needs --marc and a source file",
+    )
+    parser.add_argument(
+        "--state", help="state file for --incremental, <marc>.state by default"
+    )
+    parser.add_argument(
+        "--report",
+        help="write a json report of the time spent per stage, counts and peak memory "
+        "here, or - for stderr",
+    )
+    parser.add_argument(
+        "--progress",
+        type=float,
+        nargs="?",
+        const=5.0,
+        default=0,
+        help="print progress to stderr every this many seconds (5 by default)",
+    )
+    parser.add_argument(
+        "--profile", help="also write a cProfile dump of the run here, for pstats"
+    )
+    parser.add_argument(
+        "--validate",
+        help="check the cleaned records and write the problems here "
+        "as tab-separated values, or - for stderr",
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    sinks = {kind: getattr(args, kind) for kind in SINKS if getattr(args, kind)}
+    if not sinks:
+        sinks = {"marc": "-"}
+    if list(sinks.values()).count("-") > 1:
+        raise ValueError("Only one output can go to stdout.")
+    filters = [partial(has_tags, args.has)] if args.has else []
+    transforms = [partial(drop_tags, args.drop)] if args.drop else []
+    if args.incremental:
+        if args.validate:
+            raise ValueError("--validate can't be used with --incremental.")
+        if args.source == "-" or sinks.get("marc", "-") == "-" or "-" in sinks.values():
+            raise ValueError(
+                "--incremental needs a source file and --marc, "
+                "and can't write to stdout."
+            )
+        if "parquet" in sinks or args.columns:
+            raise ValueError(
+                "--incremental only writes marc and csv, with all columns."
+            )
+    report = sys.stderr if args.report == "-" else args.report
+    instrument = (
+        instrumentation.instrumented(report, args.progress, args.profile)
+        if report or args.progress or args.profile
+        else nullcontext()
+    )
+    validator = Validator() if args.validate else None
+    with instrument:
+        if args.incremental:
+            counts = run_incremental(
+                Path(args.source),
+                sinks["marc"],
+                sinks.get("csv"),
+                state=args.state,
+                encoding=args.encoding,
+                errors=args.errors,
+                filters=filters,
+                transforms=transforms,
+                workers=args.workers,
+                batch_size=args.batch_size,
+            )
+            print(
+                f"{counts['records']} records: {counts['copied']} unchanged, "
+                f"{counts['converted']} converted ({counts['changed']} changed), "
+                f"{counts['deleted']} deleted",
+                file=sys.stderr,
+            )
+        else:
+            written = run_pipeline(
+                sys.stdin.buffer if args.source == "-" else Path(args.source),
+                sinks,
+                encoding=args.encoding,
+                errors=args.errors,
+                filters=filters,
+                transforms=transforms,
+                columns=args.columns,
+                workers=args.workers,
+                batch_size=args.batch_size,
+                validator=validator,
+            )
+            print(f"wrote {written} records", file=sys.stderr)
+    if validator is not None:
+        validator.write_report(sys.stderr if args.validate == "-" else args.validate)
+        print_summary(validator)
@@ -0,0 +1,133 @@
+import csv
+import io
+from contextlib import chdir, redirect_stderr, redirect_stdout
+from pathlib import Path
+
+from csv_converter import read_catalogue, to_csv, to_parquet
+from instrumentation import instrumented
+from pipeline import _process_record, run_incremental, run_pipeline
+from testing import run_tests
+from utils import (
+    MarcChunk,
+    _control_number,
+    flatten_mixed_marc,
+    iter_marc_records,
+    record_bytes,
+)
+
+HERE = Path(__file__).parent
+
+
+def test_pipeline(tmp_path):
+    source = HERE / "librarything_UMClassics.marc"
+    (tmp_path / source.name).write_bytes(source.read_bytes())
+    # flatten_mixed_marc writes to the working directory
+    with chdir(tmp_path), redirect_stdout(None):
+        flattened = flatten_mixed_marc(source.name, errors="replace")
+    to_csv(tmp_path / flattened, tmp_path / "flattened.csv")
+    to_parquet(tmp_path / flattened, tmp_path / "flattened.parquet")
+    sinks = {"marc": "one.marc", "csv": "one.csv", "parquet": "one.parquet"}
+    written = run_pipeline(
+        source, {sink: tmp_path / name for sink, name in sinks.items()}
+    )
+    assert written == 6711
+    assert (tmp_path / "one.marc").read_bytes() == (tmp_path / flattened).read_bytes()
+    assert (tmp_path / "one.csv").read_text() == (
+        tmp_path / "flattened.csv"
+    ).read_text()
+    expected = read_catalogue(tmp_path / "flattened.parquet")
+    assert len(expected) == written
+    assert read_catalogue(tmp_path / "one.parquet").equals(expected)
+    # from a stream, the csv rows are spooled until the columns are known
+    stream = {"csv": tmp_path / "stream.csv", "parquet": tmp_path / "stream.parquet"}
+    run_pipeline(io.BytesIO(source.read_bytes()), stream)
+    assert (tmp_path / "stream.csv").read_text() == (tmp_path / "one.csv").read_text()
+    assert read_catalogue(stream["parquet"]).equals(expected)
+
+
+def test_unreadable_records_skipped():
+    # records that can't be decoded are skipped and counted, like any other problem
+    options = {
+        "needs": frozenset(["marc", "csv"]),
+        "encoding": "utf8",
+        "errors": "strict",
+        "filters": (),
+        "transforms": (),
+        "include_indicator": True,
+    }
+    plain = record_bytes(next(iter_marc_records(HERE / "PGA-Australiana.mrc")))
+    latin1 = plain[:-2] + b"\xe9" + plain[-2:]
+    with instrumented() as stats, redirect_stderr(io.StringIO()):
+        assert _process_record(MarcChunk(0, plain, False), **options) is not None
+        assert (
+            _process_record(MarcChunk(0, b"MDAwNTBu!!!@@@\n", True), **options) is None
+        )
+        options["encoding"] = "ascii"
+        assert _process_record(MarcChunk(0, latin1, False), **options) is None
+    assert stats.report()["counters"]["skipped"] == 2
+
+
+def test_incremental(tmp_path):
+    source = HERE / "librarything_UMClassics.marc"
+    data = source.read_bytes()
+    out = {"marc": tmp_path / "out.marc", "csv": tmp_path / "out.csv"}
+    full = {"marc": tmp_path / "full.marc", "csv": tmp_path / "full.csv"}
+    counts = run_incremental(source, out["marc"], out["csv"])
+    assert counts["converted"] == counts["records"] == 6711
+    run_pipeline(source, full)
+    assert out["marc"].read_bytes() == full["marc"].read_bytes()
+    assert out["csv"].read_bytes() == full["csv"].read_bytes()
+
+    # drop the first record and change a plain one,
+    # keeping the separators between records
+    chunks = list(iter_marc_records(source))
+    ends = [chunk.offset for chunk in chunks[1:]] + [len(data)]
+    plain = next(i for i, chunk in enumerate(chunks) if not chunk.base64 and i > 0)
+    spans = [data[chunk.offset : end] for chunk, end in zip(chunks, ends)]
+    i = spans[plain].find(b"\x1fa") + 2
+    spans[plain] = spans[plain][:i] + b"X" + spans[plain][i + 1 :]
+    changed = tmp_path / "changed.marc"
+    changed.write_bytes(b"".join(spans[1:]))
+    counts = run_incremental(changed, out["marc"], out["csv"])
+    assert counts == {
+        "records": 6710,
+        "copied": 6709,
+        "converted": 1,
+        "changed": 1,
+        "deleted": 1,
+    }
+    run_pipeline(changed, full)
+    assert out["marc"].read_bytes() == full["marc"].read_bytes()
+    assert out["csv"].read_bytes() == full["csv"].read_bytes()
+    assert (tmp_path / "delta_out.marc").read_bytes().count(b"\x1d") == 1
+    deleted = (tmp_path / "deleted_out.marc.txt").read_text().split()
+    assert deleted == [_control_number(record_bytes(chunks[0])).decode()]
+
+
+def test_incremental_new_columns(tmp_path):
+    # the first 100 records have no 590 or 921
+    source = HERE / "librarything_UMClassics.marc"
+    data = source.read_bytes()
+    first = tmp_path / "first.marc"
+    first.write_bytes(data[: list(iter_marc_records(source))[100].offset])
+    out = {"marc": tmp_path / "out.marc", "csv": tmp_path / "out.csv"}
+    run_incremental(first, out["marc"], out["csv"])
+    counts = run_incremental(source, out["marc"], out["csv"])
+    assert (counts["copied"], counts["converted"]) == (100, 6611)
+    full = {"marc": tmp_path / "full.marc", "csv": tmp_path / "full.csv"}
+    run_pipeline(source, full)
+    assert out["marc"].read_bytes() == full["marc"].read_bytes()
+    # the new columns come last, and the copied rows are widened to them
+    with open(out["csv"], newline="") as f:
+        rows = list(csv.reader(f))
+    assert rows[0][-2:] == ["590", "921"]
+    assert all(len(row) == len(rows[0]) for row in rows)
+    with open(out["csv"], newline="") as f, open(full["csv"], newline="") as g:
+        assert list(csv.DictReader(f)) == list(csv.DictReader(g))
+    widened = out["csv"].read_bytes()
+    assert run_incremental(source, out["marc"], out["csv"])["copied"] == 6711
+    assert out["csv"].read_bytes() == widened
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -0,0 +1,403 @@
+# synthetic catalogues of any size, for scale and fuzz testing
+#
+# The records are modelled on the bundled exports: each one takes the leader, tags,
+# indicators and subfield codes of a real record, and fills the subfields with values
+# that real records have in that tag and subfield, so the fields, their lengths and how
+# often they occur are as in the exports, but the combinations are new. Some records get
+# Greek or accented words (à among them, see the TODO in the README), some are written
+# in latin-1, and some in base64, as librarything does it: wrapped at 76 characters,
+# padded with ".", and followed by a newline. Only a pool of distinct records is built
+# in Python. The catalogue is drawn from the pool a block of records at a time, and each
+# record gets its own 001, written into the block with numpy (for base64 records, by
+# encoding again just the base64 groups the 001 is in), so files are written about as
+# fast as the disk takes them.
+
+import argparse
+import base64
+import random
+import re
+import sys
+from collections import defaultdict
+from collections.abc import Iterable, Sequence
+from pathlib import Path
+from typing import NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from utils import (
+    _directory,
+    detect_encoding,
+    iter_marc_records,
+    record_bytes,
+    transcode_record,
+)
+
+HERE = Path(__file__).parent
+SOURCES = (HERE / "librarything_UMClassics.marc", HERE / "PGA-Australiana.mrc")
+# words put into the text of multibyte records: Greek, and Latin letters with diacritics
+WORDS = (
+    "Ἰλιάς",
+    "Ὀδύσσεια",
+    "αλφα",
+    "λόγος",
+    "Θουκυδίδης",
+    "Ἱστορίαι",
+    "à",
+    "Voyage à Rome",
+    "déjà",
+    "Œuvres complètes",
+    "Köln",
+    "naïve",
+    "São Paulo",
+    "façon",
+    "Dvořák",
+    "Ærø",
+    "Müller",
+    "años",
+)
+# the subfields words are put into
+_TEXT = (
+    (b"245", "a"),
+    (b"245", "b"),
+    (b"100", "a"),
+    (b"520", "a"),
+    (b"264", "b"),
+    (b"650", "a"),
+)
+_BATCH = 10_000
+_ALPHABET = np.frombuffer(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/", np.uint8
+)
+_SIZE = re.compile(r"(\d+(?:\.\d+)?)\s*([kmgt]?)b?", re.IGNORECASE)
+
+
+class _Shape(NamedTuple):
+    """
+    the leader of a real record, and its fields as (tag, indicators, subfield codes),
+    None in control fields
+    """
+
+    leader: str
+    fields: list[Tuple[bytes, Optional[str], Optional[list[str]]]]
+
+
+class CatalogueModel:
+    """
+    The shapes of the records in some marc files (plain, or mixed with base64), and the
+    values found in each tag and subfield, from which record() makes new records.
+    Records are read with their encoding detected, as in flatten_mixed_marc, so the
+    values are text.
+    """
+
+    def __init__(self, sources: Sequence[Union[Path, str]] = SOURCES):
+        self.shapes: list[_Shape] = []
+        self.values: dict[Tuple[bytes, Optional[str]], list[str]] = defaultdict(list)
+        for source in sources:
+            for chunk in iter_marc_records(source):
+                data = record_bytes(chunk)
+                encoding = "utf8" if chunk.base64 else detect_encoding(data)
+                self._add(transcode_record(data, encoding, "replace"))
+        if not self.shapes:
+            raise ValueError(f"No records in {', '.join(map(str, sources))}.")
+
+    def _add(self, record: bytes) -> None:
+        fields = []
+        for tag, start, length in _directory(record):
+            text = (
+                record[start : start + length].rstrip(b"\x1e").decode("utf8", "replace")
+            )
+            if tag == b"001":
+                continue
+            if tag < b"010" and tag.isdigit():
+                fields.append((tag, None, None))
+                self.values[tag, None].append(text)
+                continue
+            indicators, *subfields = text.split("\x1f")
+            codes = [subfield[:1] for subfield in subfields if subfield]
+            fields.append((tag, indicators[:2].ljust(2), codes))
+            for subfield in subfields:
+                if subfield:
+                    self.values[tag, subfield[:1]].append(subfield[1:])
+        if fields:
+            self.shapes.append(_Shape(record[:24].decode("ascii", "replace"), fields))
+
+    def record(
+        self,
+        rng: random.Random,
+        control: str,
+        encoding: str = "utf8",
+        words: Sequence[str] = (),
+    ) -> bytes:
+        """
+        A new record in the shape of a random real one, with `control` as its 001
+        (first), values drawn from the same tag and subfield of any record, each of
+        `words` put into one of its text subfields, and written in `encoding`;
+        characters latin-1 hasn't got become "?".
+        """
+        shape = rng.choice(self.shapes)
+        fields = [(b"001", control)]
+        for tag, indicators, codes in shape.fields:
+            if codes is None:
+                fields.append((tag, rng.choice(self.values[tag, None])))
+            else:
+                subfields = [
+                    [code, rng.choice(self.values[tag, code])] for code in codes
+                ]
+                fields.append((tag, indicators, subfields))
+        text = [
+            subfield
+            for field in fields[1:]
+            if len(field) == 3
+            for subfield in field[2]
+            if (field[0], subfield[0]) in _TEXT
+        ]
+        for word in words:
+            if text:
+                subfield = rng.choice(text)
+                value = subfield[1].split(" ")
+                value.insert(rng.randrange(len(value) + 1), word)
+                subfield[1] = " ".join(value)
+        encoded = []
+        for field in fields:
+            if len(field) == 2:
+                encoded.append((field[0], field[1].encode(encoding, "replace")))
+            else:
+                tag, indicators, subfields = field
+                data = indicators + "".join(
+                    f"\x1f{code}{value}" for code, value in subfields
+                )
+                encoded.append((tag, data.encode(encoding, "replace")))
+        return _marc(shape.leader, encoded)
+
+
+def _marc(leader: str, fields: list[Tuple[bytes, bytes]]) -> bytes:
+    """
+    serializes a record from its leader and (tag, data) fields, leaving the leader's
+    codes as they are
+    """
+    directory = []
+    offset = 0
+    for tag, data in fields:
+        directory.append(b"%s%04d%05d" % (tag, len(data) + 1, offset))
+        offset += len(data) + 1
+    base = 24 + 12 * len(fields) + 1
+    head = f"{base + offset + 1:05d}{leader[5:12]}{base:05d}{leader[17:24]}".encode(
+        "ascii"
+    )
+    return (
+        head
+        + b"".join(directory)
+        + b"\x1e"
+        + b"".join(data + b"\x1e" for _, data in fields)
+        + b"\x1d"
+    )
+
+
+def to_base64(record: bytes, wrap: int = 76, padding: bytes = b".") -> bytes:
+    """
+    A record in base64 the way librarything writes it: wrapped at `wrap` characters,
+    padded with `padding`.
+    """
+    if wrap == 76:
+        # encodebytes wraps at 76 characters itself, and ends with a newline
+        return base64.encodebytes(record).replace(b"=", padding)
+    encoded = base64.b64encode(record).replace(b"=", padding)
+    return (
+        b"\n".join(encoded[i : i + wrap] for i in range(0, len(encoded), wrap)) + b"\n"
+    )
+
+
+def _groups(width: int) -> int:
+    "the number of base64 groups (of 3 bytes) a 001 of this width can be in"
+    return -(-(width + 2) // 3)
+
+
+def _positions(
+    offsets: np.ndarray, firsts: np.ndarray, size: int, wrap: int
+) -> np.ndarray:
+    """
+    where the base64 of `size` bytes from `firsts` in each record goes, in records at
+    `offsets` in a block
+    """
+    characters = (firsts // 3 * 4)[:, None] + np.arange(size // 3 * 4)
+    return offsets[:, None] + characters + characters // wrap
+
+
+def _encode(groups: np.ndarray, at: np.ndarray, digits: np.ndarray) -> np.ndarray:
+    "base64 of the groups of bytes (one row each) with the digits written in at `at`"
+    groups = groups.copy()
+    groups[
+        np.arange(len(groups))[:, None], at[:, None] + np.arange(digits.shape[1])
+    ] = digits
+    bits = groups.reshape(len(groups), -1, 3).astype(np.uint32)
+    bits = bits[..., 0] << 16 | bits[..., 1] << 8 | bits[..., 2]
+    sextets = bits[..., None] >> np.array([18, 12, 6, 0], np.uint32) & 63
+    return _ALPHABET[sextets.reshape(len(groups), -1)]
+
+
+def write_catalogue(
+    dest: Union[Path, str],
+    records: Optional[int] = None,
+    size: Optional[int] = None,
+    base64_fraction: float = 0.5,
+    latin1_fraction: float = 0.0,
+    multibyte_fraction: float = 0.2,
+    wrap: int = 76,
+    padding: str = ".",
+    seed: int = 0,
+    pool_size: int = 4096,
+    model: Optional[CatalogueModel] = None,
+) -> int:
+    """
+    Writes a synthetic catalogue of `records` records, or of at least `size` bytes, to
+    dest, and returns the number of records written. About base64_fraction of the
+    records are base64 (wrapped at `wrap` characters and padded with `padding`),
+    latin1_fraction are plain latin-1, and the rest plain utf8; multibyte_fraction of
+    the records have Greek or accented words in their text (in latin-1 records, the
+    Greek becomes "?"). The records come from a pool of pool_size records made by
+    `model` (a CatalogueModel of the bundled exports by default), each with its own 001,
+    numbered from 1. The same arguments always write the same file.
+    """
+    if (records is None) == (size is None):
+        raise ValueError("Give either the number of records or the size.")
+    if base64_fraction + latin1_fraction > 1:
+        raise ValueError("base64_fraction and latin1_fraction add up to more than 1.")
+    model = model or CatalogueModel()
+    rng = random.Random(seed)
+    # the 001s are all the same width, so that they
+    # can be stamped into the pool's records
+    width = max(8, len(str(records or size)))
+    padding = padding.encode("ascii")
+    # the pool: base64 records, then latin-1 and utf8 ones, the base64 records being the
+    # utf8 ones encoded
+    pools = {}
+    for encoding in ("latin1", "utf8"):
+        pools[encoding] = []
+        while len(pools[encoding]) < pool_size:
+            words = (
+                rng.sample(WORDS, rng.randint(1, 3))
+                if rng.random() < multibyte_fraction
+                else ()
+            )
+            record = model.record(rng, "0" * width, encoding, words)
+            # the 001 is the first field, right after the
+            # directory; it has to be followed by a whole base64
+            # group, so that stamping it doesn't touch the padding
+            if int(record[12:17]) // 3 * 3 + _groups(width) * 3 <= len(record) // 3 * 3:
+                pools[encoding].append(record)
+    plain = pools["latin1"] + pools["utf8"]
+    pool = [to_base64(record, wrap, padding) for record in pools["utf8"]] + plain
+    lengths = np.array([len(record) for record in pool])
+    starts = np.array([int(record[12:17]) for record in pools["utf8"] + plain])
+    # for base64 records, the whole base64 groups the 001 is in, which are encoded again
+    # for each record
+    firsts = starts[:pool_size] // 3 * 3
+    groups = np.array(
+        [
+            list(record[first : first + _groups(width) * 3])
+            for record, first in zip(pools["utf8"], firsts)
+        ],
+        np.uint8,
+    ).reshape(pool_size, -1)
+    draws = np.random.default_rng(seed)
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    written = count = 0
+    with open(dest, "wb") as f:
+        while (records is None or count < records) and (size is None or written < size):
+            n = _BATCH if records is None else min(_BATCH, records - count)
+            # 0 for base64, 1 for latin-1 and 2 for
+            # utf8, and the record of the pool for each
+            kinds = np.searchsorted(
+                np.cumsum([base64_fraction, latin1_fraction]), draws.random(n), "right"
+            )
+            picks = draws.integers(0, pool_size, n) + kinds * pool_size
+            ends = np.cumsum(lengths[picks])
+            if size is not None:
+                # just enough records to get to the size
+                n = min(n, int(np.searchsorted(ends, size - written)) + 1)
+                kinds, picks, ends = kinds[:n], picks[:n], ends[:n]
+            block = bytearray(b"".join(map(pool.__getitem__, picks.tolist())))
+            data = np.frombuffer(block, np.uint8)
+            offsets = ends - lengths[picks]
+            digits = (
+                np.arange(count + 1, count + n + 1)[:, None] // powers % 10 + 48
+            ).astype(np.uint8)
+            stamped = kinds != 0
+            data[(offsets + starts[picks])[stamped, None] + np.arange(width)] = digits[
+                stamped
+            ]
+            encoded = ~stamped
+            if encoded.any():
+                picked = picks[encoded]
+                data[
+                    _positions(offsets[encoded], firsts[picked], groups.shape[1], wrap)
+                ] = _encode(
+                    groups[picked], starts[picked] - firsts[picked], digits[encoded]
+                )
+            f.write(block)
+            written += len(block)
+            count += n
+    return count
+
+
+def _size(text: str) -> int:
+    "a size in bytes, e.g. 500MB or 2G"
+    match = _SIZE.fullmatch(text.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"Can't read size {text!r}.")
+    number, unit = match.groups()
+    return (
+        int(float(number) * 1024 ** ("kmgt".find(unit.lower()) + 1))
+        if unit
+        else int(number)
+    )
+
+
+def _parse_args(args: Optional[Iterable[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic marc catalogue of any size, "
+        "modelled on the bundled exports."
+    )
+    parser.add_argument("dest", help="marc file to write")
+    amount = parser.add_mutually_exclusive_group(required=True)
+    amount.add_argument("--records", type=int, help="number of records")
+    amount.add_argument("--size", type=_size, help="size of the file, e.g. 500MB")
+    parser.add_argument("--base64-fraction", type=float, default=0.5)
+    parser.add_argument("--latin1-fraction", type=float, default=0.0)
+    parser.add_argument(
+        "--multibyte-fraction",
+        type=float,
+        default=0.2,
+        help="records with Greek or accented words",
+    )
+    parser.add_argument(
+        "--wrap", type=int, default=76, help="length of the base64 lines"
+    )
+    parser.add_argument(
+        "--padding", default=".", help="base64 padding, . as librarything has it, or ="
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--sources",
+        nargs="+",
+        default=SOURCES,
+        help="marc files to model the records on (the exports)",
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    written = write_catalogue(
+        args.dest,
+        args.records,
+        args.size,
+        args.base64_fraction,
+        args.latin1_fraction,
+        args.multibyte_fraction,
+        args.wrap,
+        args.padding,
+        args.seed,
+        model=CatalogueModel(args.sources),
+    )
+    print(f"wrote {written} records to {args.dest}", file=sys.stderr)
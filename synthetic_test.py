@@ -0,0 +1,73 @@
+from synthetic import CatalogueModel, to_base64, write_catalogue
+from testing import run_tests
+from utils import (
+    RecordView,
+    _control_number,
+    detect_encoding,
+    iter_marc_records,
+    record_bytes,
+    transcode_record,
+)
+
+
+def test_synthetic(tmp_path):
+    model = CatalogueModel()
+    kwargs = dict(
+        latin1_fraction=0.2, multibyte_fraction=0.5, pool_size=256, model=model
+    )
+    assert write_catalogue(tmp_path / "a.mrc", 2000, **kwargs) == 2000
+    write_catalogue(tmp_path / "b.mrc", 2000, **kwargs)
+    assert (tmp_path / "a.mrc").read_bytes() == (tmp_path / "b.mrc").read_bytes()
+    write_catalogue(tmp_path / "b.mrc", 2000, seed=1, **kwargs)
+    assert (tmp_path / "a.mrc").read_bytes() != (tmp_path / "b.mrc").read_bytes()
+    chunks = list(iter_marc_records(tmp_path / "a.mrc"))
+    records = [record_bytes(chunk) for chunk in chunks]
+    assert len(records) == 2000 and 800 < sum(chunk.base64 for chunk in chunks) < 1200
+    assert [_control_number(record) for record in records] == [
+        b"%08d" % i for i in range(1, 2001)
+    ]
+    # base64 records are written the way librarything writes them
+    assert (tmp_path / "a.mrc").read_bytes() == b"".join(
+        to_base64(record) if chunk.base64 else record
+        for chunk, record in zip(chunks, records)
+    )
+    encodings = [detect_encoding(record) for record in records]
+    assert all(
+        encoding == "utf8" for chunk, encoding in zip(chunks, encodings) if chunk.base64
+    )
+    # latin-1 records with nothing but ascii in them are detected as utf8
+    assert 50 < encodings.count("latin1") < 400
+    text = [
+        transcode_record(record, encoding).decode("utf8")
+        for record, encoding in zip(records, encodings)
+    ]
+    assert all(
+        RecordView(record.encode("utf8"), force_utf8=True).to_record()["245"]
+        for record in text
+    )
+    assert (
+        sum("à" in record for record in text) > 100
+        and sum("λ" in record for record in text) > 100
+    )
+    # by size, with other base64 lines and padding
+    written = write_catalogue(
+        tmp_path / "c.mrc",
+        size=100_000,
+        wrap=60,
+        padding="=",
+        pool_size=256,
+        model=model,
+    )
+    data = (tmp_path / "c.mrc").read_bytes()
+    chunks = list(iter_marc_records(tmp_path / "c.mrc"))
+    assert len(chunks) == written and len(data) >= 100_000 > len(data) - len(
+        chunks[-1].data
+    )
+    assert data == b"".join(
+        to_base64(record_bytes(chunk), 60, b"=") if chunk.base64 else bytes(chunk.data)
+        for chunk in chunks
+    )
+
+
+if __name__ == "__main__":
+    run_tests(globals())
@@ -0,0 +1,19 @@
+# helper for running the test modules (<module>_test.py) as scripts, without pytest
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+
+def run_tests(namespace: dict) -> None:
+    """
+    Runs the test functions in a test module's globals, for running it as a script,
+    giving a fresh temporary directory to the ones that take tmp_path, as pytest does.
+    """
+    for name, test in list(namespace.items()):
+        if name.startswith("test_") and callable(test):
+            if "tmp_path" in test.__code__.co_varnames[: test.__code__.co_argcount]:
+                with TemporaryDirectory() as tmp:
+                    test(Path(tmp))
+            else:
+                test()
+            print(f"{name} passed")
@@ -1,179 +1,200 @@
-from collections.abc import Generator
-from typing import Optional, Union, Tuple
+from array import array
+from collections import deque
+from collections.abc import Callable, Collection, Generator, Iterable, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from typing import BinaryIO, NamedTuple, Optional, TypeVar, Union, Tuple
 from pathlib import Path
+import binascii
+import codecs
+import mmap
+import os
 import re
+import struct
+import zlib
+
+import numpy as np
+from pymarc import Field, Indicators, Leader, Record, Subfield
+from pymarc.marc8 import marc8_to_unicode
+from pymarc.record import normalize_subfield_code
+
+import instrumentation
+
+S = TypeVar("S")
+T = TypeVar("T")
 
 # regex pattern for finding start of marc recordr"\d{5}(\s|[A-Za-z]){3}[A-Za-z\s#]{2}[012]"
 RECORD_START = r"^\d{5}(\s|[A-Za-z]){3}[A-Za-z\s#]{2}[012]"
+_RECORD_START = re.compile(RECORD_START)
+_RECORD_START_BYTES = re.compile(RECORD_START.encode())
+
+
+# bytes skipped when decoding base64: padding ("=", or "." as used in
+# librarything exports), and anything str.isspace() treats as
+# whitespace, which includes the marc separators \x1c-\x1f.
+_B64_SKIP = b"=. \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
+# map the url-safe alphabet ("-" and "_") onto the standard one ("+" and "/")
+_B64_TABLE = bytes.maketrans(b"-_", b"+/")
+# lookup table from ascii byte to 6-bit base64 value
+# for decode_64_batch, 255 marks invalid bytes
+_B64_VALUES = np.full(256, 255, dtype=np.uint8)
+_B64_VALUES[
+    np.frombuffer(
+        b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/",
+        dtype=np.uint8,
+    )
+] = np.arange(64, dtype=np.uint8)
+
+
+def _clean_64(encoded: Union[str, bytes]) -> bytes:
+    """
+    helper function for decode_64_bytes: strips padding
+    and whitespace, and normalizes url-safe characters.
+    """
+    if isinstance(encoded, str):
+        try:
+            encoded = encoded.encode("ascii")
+        except UnicodeEncodeError as e:
+            raise ValueError(
+                f"string:\n{encoded}\n\n"
+                f"contains invalid base64 character: {encoded[e.start]}"
+            ) from e
+    data = encoded.translate(_B64_TABLE, _B64_SKIP)
+    # a single leftover character holds fewer than 8 bits, so it can't encode anything
+    if len(data) % 4 == 1:
+        data = data[:-1]
+    return data
+
+
+def _skip_stray_0x80(errors: str) -> str:
+    """
+    Returns name of a codec error handler that drops stray 0x80 bytes,
+    which turn up in librarything base64, and otherwise defers to the handler `errors`.
+    """
+    name = f"marc64_{errors}"
+    try:
+        codecs.lookup_error(name)
+    except LookupError:
+        fallback = codecs.lookup_error(errors)
+
+        def handler(exc: UnicodeError) -> Tuple[str, int]:
+            if (
+                isinstance(exc, UnicodeDecodeError)
+                and exc.end - exc.start == 1
+                and exc.object[exc.start] == 0x80
+            ):
+                return "", exc.end
+            return fallback(exc)
+
+        codecs.register_error(name, handler)
+    return name
 
 
-def _char_to_64(encoding_char: str) -> Optional[int]:
-    "helper function for decode_64."
-    assert len(encoding_char) == 1
-    of_64 = None
-    if encoding_char.isupper():
-        of_64 = ord(encoding_char) - 65
-    elif encoding_char.islower():
-        of_64 = ord(encoding_char) - 71
-    elif encoding_char.isnumeric():
-        of_64 = ord(encoding_char) + 4
-    elif encoding_char == "+":
-        of_64 = 62
-    elif encoding_char == "-":
-        of_64 = 62
-    elif encoding_char == "/":
-        of_64 = 63
-    elif encoding_char == "_":
-        of_64 = 63
-    return of_64
-
-
-def _to_byte(of_64: Union[int, str]) -> list:
-    if isinstance(of_64, str):
-        of_64 = int(of_64)
-    assert of_64 < 64, f"input to _to_byte contains invalid base64 character: {of_64}"
-    byte = [0, 0, 0, 0, 0, 0]
-    if of_64 % 2 == 1:
-        byte[5] = 1
-    if of_64 % 4 > 1:
-        byte[4] = 1
-    if of_64 % 8 > 3:
-        byte[3] = 1
-    if of_64 % 16 > 7:
-        byte[2] = 1
-    if of_64 % 32 > 15:
-        byte[1] = 1
-    if of_64 % 64 > 31:
-        byte[0] = 1
-    return byte
-
-
-def _eval_multibyte(encoding: list) -> int:
-    "convert a binary encoding of any length to an integer value"
-    val = 0
-    exponent = len(encoding) - 1
-    for bit in encoding:
-        if bit:
-            val += 2**exponent
-        exponent -= 1
-    return val
-
-
-def decode_64(encoded: str) -> Generator[str]:
+@instrumentation.timed("decode_64")
+def decode_64_bytes(encoded: Union[str, bytes]) -> bytes:
+    """
+    Function to convert base64 (with alphanumeric characters, "+" and "/", or "-" and
+    "_") into the bytes it encodes. Padding ("=" or ".") and whitespace are ignored
+    wherever they occur, and any bits left over from taking groups of 8 are discarded.
+    """
+    data = _clean_64(encoded)
+    if len(data) % 4:
+        data += b"=" * (4 - len(data) % 4)
+    try:
+        return binascii.a2b_base64(data, strict_mode=True)
+    except binascii.Error as e:
+        raise ValueError(
+            f"string:\n{encoded!r}\n\ncontains invalid base64 character"
+        ) from e
+
+
+@instrumentation.timed("decode_64")
+def decode_64_str(encoded: Union[str, bytes], errors: str = "strict") -> str:
+    """
+    Function to convert base64 encoding utf-8 into a string.
+    Stray 0x80 bytes outside of a multibyte character are skipped,
+    other invalid utf-8 is handled according to `errors`, as for bytes.decode.
+    """
+    return decode_64_bytes(encoded).decode("utf8", errors=_skip_stray_0x80(errors))
+
+
+def decode_64(encoded: Union[str, bytes], errors: str = "strict") -> Generator[str]:
     """
     Function to convert base64 in utf-8 (i.e. with
     alphanumeric characters, "+", and "/") into unicode characters.
     Returns a generator that yields decoded string character by character.
     """
-    bytes = []
-    for char in encoded:
-        # deal with padding character
-        # marc files output by librarything seem to use "." as padding character, rather than "="
-        if char == "=" or char == "." or char.isspace():
-            continue
-        of_64 = _char_to_64(char)
-        assert of_64 is not None, (
-            f"string:\n{encoded}\n\ncontains invalid base64 character: {char}"
+    yield from decode_64_str(encoded, errors)
+
+
+@instrumentation.timed("decode_64")
+def decode_64_batch(
+    chunks: Sequence[Union[str, bytes]], errors: str = "strict"
+) -> list[str]:
+    """
+    Decodes a batch of separately padded base64 chunks, e.g. one per record, in a single
+    numpy pass. Equivalent to [decode_64_str(chunk, errors) for chunk in chunks].
+    """
+    cleaned = [_clean_64(chunk) for chunk in chunks]
+    lengths = np.fromiter(
+        (len(chunk) for chunk in cleaned), dtype=np.int64, count=len(cleaned)
+    )
+    # pad every chunk with "A" (i.e. 0) to a whole number of 4-character groups,
+    # so that chunks line up with groups of 3 decoded bytes
+    padding = -lengths % 4
+    padded = b"".join(
+        chunk + b"A" * pad for chunk, pad in zip(cleaned, padding.tolist())
+    )
+    values = _B64_VALUES[np.frombuffer(padded, dtype=np.uint8)]
+    if (values == 255).any():
+        bad = int(
+            np.searchsorted(
+                np.cumsum(lengths + padding), np.argmax(values == 255), side="right"
+            )
         )
-        byte = _to_byte(of_64)
-        bytes.extend(byte)
-    # discard any bits left over from taking groups of 8
-    if len(bytes) % 8 != 0:
-        bytes = bytes[: len(bytes) - len(bytes) % 8]
-    val = 0
-    # TODO: test/debug that adding utf8 functionality hasn't broken code for ASCII, and works for utf8
-    block_len = 0  # keeps track of how many bytes encode a single utf8 char
-    utf8_block = []  # contains bits in a multibyte utf8 encoding
-    in_utf8_block = False
-    for i in range(int(len(bytes) / 8)):
-        binary_byte = bytes[i * 8 : (i + 1) * 8]
-        invalid_standalone = [1, 0, 0, 0, 0, 0, 0, 0]
-        if (
-            not in_utf8_block and binary_byte == invalid_standalone
-        ):  # skip invalid UTF8 byte
-            continue
+        raise ValueError(
+            f"string:\n{chunks[bad]!r}\n\ncontains invalid base64 character"
+        )
+    quads = values.reshape(-1, 4)
+    decoded = np.empty((len(quads), 3), dtype=np.uint8)
+    decoded[:, 0] = (quads[:, 0] << 2) | (quads[:, 1] >> 4)
+    decoded[:, 1] = ((quads[:, 1] & 15) << 4) | (quads[:, 2] >> 2)
+    decoded[:, 2] = ((quads[:, 2] & 3) << 6) | quads[:, 3]
+    buffer = decoded.tobytes()
+    starts = np.concatenate(
+        ([0], np.cumsum((lengths + padding) // 4 * 3)[:-1])
+    ).tolist()
+    sizes = (lengths * 6 // 8).tolist()
+    errors = _skip_stray_0x80(errors)
+    return [
+        buffer[start : start + size].decode("utf8", errors=errors)
+        for start, size in zip(starts, sizes)
+    ]
 
-        utf8_instruct_byte = False  # keeps track of whether current byte encodes how many bytes encode current char
-        # handle case where currently in multibyte character encoding
-        if in_utf8_block:
-            for j, bit in enumerate(binary_byte):
-                if j < 2:
-                    continue
-                utf8_block.append(bit)
-            block_len -= 1
-            if block_len == 0:
-                in_utf8_block = False
-                yield chr(_eval_multibyte(utf8_block))
-                utf8_block = []
-            continue
-        # now, handle case where we are not already in a multibyte character encoding.
-        # this also handles the first byte of a multibyte encoding.
-        for j, bit in enumerate(binary_byte):
-            # first, check if this is the tail of the first byte in a multibyte utf8 encoding
-            if in_utf8_block:
-                utf8_block.append(bit)
-                continue
-            # handle utf-8 binary encodings, which have 1 as first bit
-            if j == 0 and bit == 1:
-                # this handles non-ASCII characters in utf-8
-                utf8_instruct_byte = True
-                continue
-            if bit:
-                # handle regular ASCII binary encodings
-                if not utf8_instruct_byte:
-                    val += 2 ** (7 - j)
-                # handle utf8 instructions for how many bytes encode char
-                else:
-                    block_len += 1
-            elif (
-                utf8_instruct_byte
-            ):  # exits from receiving utf8 instructions on encountering a 0
-                utf8_instruct_byte = False
-                in_utf8_block = True
-        if not in_utf8_block:
-            yield chr(val)
-        val = 0
-
-
-def _check_base64(line: str) -> Tuple[bool, int, int]:
-    "This detects first line in base64 in marc file."
-    if "MDA" not in line and "MDE" not in line:
-        return False, -1, -1
-    match = re.search(r"(\n|\x1c|\x1d|\x1e\x1f)MD[AE]", line)
-    if match:
-        start, end = match.span()
-        start = start + 1  # we don't want index of record delimiter
-    else:
-        match = re.search(r"^MD", line)
-        if match:
-            start, end = match.span()
-    if match:
-        start, end = match.span()
-        return True, start, end
-    return False, -1, -1
-
-
-def _handle_base64(line: str, lines: list, base64_buffer: list) -> bool:
-    is_match, start, _ = _check_base64(line)
-    if not is_match:
-        lines.append(line)
-        return False
-    start += 1
-    # base64 encoding sometimes continues on same line as regular utf8 record
-    if start > 0:
-        lines.append(line[:start])
-    # assume first line of base64 encoding section never has regular utf8 after base64.
-    base64_buffer.append(line[start:])
-    return True
-
-
-def _normalize_record_spacing(records: str) -> str:
-    records = records.replace("\n", " ")
-    pattern = r"(\x1e\x1d)(\s|\n)*(\d+)"
-    records = re.sub(pattern, r"\1\3", records)
+
+# folds line breaks into spaces and deletes null characters, for normalize_records
+_FOLD_NEWLINES = bytes.maketrans(b"\n", b" ")
+_DELETE = b"\x00"
+# whitespace left between the end of one record and the leader of the next
+_RECORD_GAP = re.compile(rb"(?<=\x1e\x1d)[ \t\r\x0b\x0c]+(?=\d)")
+
+
+@instrumentation.timed("normalize")
+def normalize_records(records: bytes) -> bytes:
+    """
+    Cleans up one or more marc records: line breaks become spaces, random null
+    characters are removed, and any whitespace between the end of a record and the next
+    leader is dropped. Line breaks and nulls are handled in a single bytes.translate
+    pass, and the gap pattern is only searched for when there is more than one record.
+    """
+    records = records.translate(_FOLD_NEWLINES, _DELETE)
+    if records.find(b"\x1d", 0, len(records) - 1) >= 0:
+        records = _RECORD_GAP.sub(b"", records)
     return records
 
 
+@instrumentation.timed("get_records_64")
 def _get_records_64(records: list[str]) -> list[str]:
     """Function to take in a list of lines in base64 read from a marc file
     and return a new list in which each item is a string encoding a single records.
@@ -184,8 +205,8 @@ def _get_records_64(records: list[str]) -> list[str]:
     for line in records:
         line = line.strip()
         incipit = line[:18]
-        incipit = "".join([char for char in decode_64(incipit)])
-        if re.search(RECORD_START, incipit):
+        incipit = decode_64_str(incipit, errors="replace")
+        if _RECORD_START.search(incipit):
             by_record.append("".join(cur_buffer))
             cur_buffer = [line]
         else:
@@ -195,138 +216,1096 @@ def _get_records_64(records: list[str]) -> list[str]:
     return by_record
 
 
-# more elegant would be to do this the intended way for the marc format,
-# namely by reading the number of bytes in the record from the start of the record,
-# but this was easier.
-def flatten_mixed_marc(filename: Union[Path, str], encoding="utf8") -> Path:
-    """Take path to marc file containing mix of regular utf8 and base64 utf8,
-    and rewrites it to only include regular utf8, i.e. binary encodings of
-    the final characters themselves in utf8. This relies on
-    base64 encoding strings beginning with MDA and plain utf8 strsing beginning with 00###.
+class MarcChunk(NamedTuple):
+    """
+    A single record as it appears in a marc file, plain or base64, and its byte offset
+    in the file.
+    """
+
+    offset: int
+    data: bytes
+    base64: bool
+
+
+class _Blocks:
+    "Window onto a binary file that is read in blocks, for iter_marc_records."
+
+    def __init__(self, f: BinaryIO, block_size: int):
+        self.f = f
+        self.block_size = block_size
+        self.buf = b""
+        self.pos = 0
+        self.offset = 0  # offset in the file of buf[0]
+        self.eof = False
+
+    def remaining(self) -> int:
+        return len(self.buf) - self.pos
+
+    def fill(self, n: int) -> bool:
+        "Buffers at least n bytes past pos, if the file has that many left."
+        while self.remaining() < n and not self.eof:
+            block = self.f.read(max(self.block_size, n - self.remaining()))
+            if not block:
+                self.eof = True
+                break
+            self.offset += self.pos
+            self.buf = self.buf[self.pos :] + block
+            self.pos = 0
+        return self.remaining() >= n
+
+    def peek(self, n: int, start: int = 0) -> bytes:
+        self.fill(start + n)
+        return self.buf[self.pos + start : self.pos + start + n]
+
+    def find(self, sub: bytes, start: int = 0) -> int:
+        "Index of sub relative to pos, reading further blocks as needed, or -1."
+        while True:
+            i = self.buf.find(sub, self.pos + start)
+            if i >= 0:
+                return i - self.pos
+            if self.eof:
+                return -1
+            # no need to search again what has already been searched
+            start = max(start, self.remaining() - len(sub) + 1)
+            self.fill(self.remaining() + self.block_size)
+
+    def skip(self, chars: bytes) -> None:
+        while self.fill(1) and self.buf[self.pos] in chars:
+            self.pos += 1
+
+    def take(self, n: int) -> MarcChunk:
+        self.fill(n)
+        data = self.buf[self.pos : self.pos + n]
+        chunk = MarcChunk(self.offset + self.pos, data, False)
+        self.pos += len(data)
+        return chunk
+
+
+# bytes that show up between records, e.g. the line break at the end of a base64 block
+_GAP = b" \t\n\r\x00"
+_B64_CHARS = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/-_=."
+# librarything wraps base64 at 76 characters, and
+# starts each base64 record on a new line
+_B64_LINE = 76
+
+
+def _terminated_size(blocks: _Blocks) -> int:
+    "fallback for records with a corrupt length: read up to the record terminator."
+    instrumentation.count("corrupt")
+    end = blocks.find(b"\x1d")
+    return end + 1 if end >= 0 else blocks.remaining()
+
+
+def _plain_size(blocks: _Blocks) -> int:
+    length = int(blocks.peek(5))
+    if length >= 24 and blocks.fill(length) and blocks.peek(1, length - 1) == b"\x1d":
+        return length
+    return _terminated_size(blocks)
+
+
+def _starts_record(line: bytes) -> bool:
+    "checks whether a line starts a plain or base64 record."
+    if _RECORD_START_BYTES.match(line):
+        return True
+    try:
+        return bool(_RECORD_START_BYTES.match(decode_64_bytes(line[:24])))
+    except ValueError:
+        return False
+
+
+def _base64_lines_size(blocks: _Blocks) -> int:
+    """fallback for base64 records with a corrupt length: read line by line until
+    a line ending in padding, or a line that starts a new record."""
+    instrumentation.count("corrupt")
+    start = 0
+    while True:
+        end = blocks.find(b"\n", start)
+        if end < 0:
+            return blocks.remaining()
+        line = blocks.peek(end - start, start).rstrip()
+        if start > 0 and _starts_record(line):
+            return start
+        if line.endswith((b".", b"=")):
+            return end
+        start = end + 1
+
+
+def _base64_size(blocks: _Blocks) -> int:
+    """
+    Size of the base64 record at the current position, worked out from the record length
+    in its leader and librarything's line wrapping.
+    """
+    try:
+        leader = decode_64_bytes(blocks.peek(8))
+    except ValueError:
+        return _base64_lines_size(blocks)
+    if not leader[:5].isdigit():
+        return _base64_lines_size(blocks)
+    encoded = -(-int(leader[:5]) // 3) * 4
+    size = encoded + (encoded - 1) // _B64_LINE
+    block = blocks.peek(size)
+    chars = block.translate(None, b"\n")
+    if len(chars) == encoded and blocks.peek(1, size) in (b"", b"\n", b"\r"):
+        try:
+            if decode_64_bytes(chars[-4:]).endswith(b"\x1d"):
+                return size
+        except ValueError:
+            pass
+    return _base64_lines_size(blocks)
+
+
+@instrumentation.timed_split
+def iter_marc_records(
+    filename: Union[Path, str, BinaryIO], block_size: int = 1 << 20, start: int = 0
+) -> Generator[MarcChunk]:
+    """
+    Generator that splits a marc file with a mix of plain and base64 records into single
+    records, reading the file in blocks of block_size bytes, so memory use doesn't
+    depend on file size. Uses the record length in each leader to jump from record to
+    record, and only falls back on the record terminator (plain records) or the line
+    structure of the base64 (base64 records) where the length is corrupt. Reading begins
+    at byte offset `start`, which should be the start of a record. `filename` can also
+    be a binary file object, e.g. sys.stdin.buffer, which is read from where it is
+    (start then only sets the offsets of the records) and not closed.
+    """
+    is_file = hasattr(filename, "read")
+    with nullcontext(filename) if is_file else open(filename, "rb") as f:
+        if not is_file:
+            f.seek(start)
+        blocks = _Blocks(f, block_size)
+        blocks.offset = start
+        while True:
+            blocks.skip(_GAP)
+            if not blocks.fill(1):
+                return
+            if blocks.peek(5).isdigit():
+                yield blocks.take(_plain_size(blocks))
+                continue
+            line_end = blocks.find(b"\n")
+            first_line = blocks.peek(line_end if line_end >= 0 else _B64_LINE)
+            if first_line and not first_line.rstrip().translate(None, _B64_CHARS):
+                yield blocks.take(_base64_size(blocks))._replace(base64=True)
+            else:
+                # neither a plain nor a base64 leader,
+                # so pass on whatever is here as it is
+                yield blocks.take(_terminated_size(blocks))
+
+
+# ascii bytes, deleted before the utf8 check, and a run of well-formed utf8 sequences
+# (plus the stray 0x80 bytes librarything leaves in its utf8), for detect_encoding
+_ASCII = bytes(range(0x80))
+_UTF8_RUN = re.compile(
+    rb"(?:[\xc2-\xdf][\x80-\xbf]"
+    rb"|\xe0[\xa0-\xbf][\x80-\xbf]|[\xe1-\xec\xee\xef][\x80-\xbf]{2}"
+    rb"|\xed[\x80-\x9f][\x80-\xbf]"
+    rb"|\xf0[\x90-\xbf][\x80-\xbf]{2}|[\xf1-\xf3][\x80-\xbf]{3}"
+    rb"|\xf4[\x80-\x8f][\x80-\xbf]{2}"
+    rb"|\x80)*"
+)
+# latin-1 has no use for the C1 control characters
+# 0x80-0x9f, but windows-1252 puts punctuation there
+_C1 = re.compile(rb"[\x80-\x9f]")
+
+
+@instrumentation.timed("detect_encoding")
+def detect_encoding(record: bytes) -> str:
+    """
+    Works out the encoding of a single marc record with byte-level checks, without trial
+    decoding. A record whose non-ascii bytes, taken together, are well-formed utf8 is
+    "utf8". Leader position 9 isn't relied on, since librarything leaves it blank for
+    utf8 records and a record marked "a" can still turn out to be latin-1. Any other
+    record is "cp1252" if it uses the bytes 0x80-0x9f, which latin-1 text never does,
+    and "latin1" otherwise.
+    """
+    if record.isascii():
+        return "utf8"
+    # deleting the ascii bytes is much faster than finding each non-ascii run; it could
+    # join up a latin-1 lead byte and continuation bytes across ascii, but real text
+    # doesn't do that
+    high = record.translate(None, _ASCII)
+    if _UTF8_RUN.fullmatch(high):
+        return "utf8"
+    return "cp1252" if _C1.search(high) else "latin1"
+
+
+@instrumentation.timed("transcode")
+def transcode_record(
+    record: bytes, encoding: str, errors="strict", normalize=True
+) -> bytes:
+    """
+    Re-encodes a marc record from `encoding` to utf8 field by field,
+    rebuilding the directory and the lengths in the leader so they match the
+    new bytes, and marks it as utf8 in leader position 9. With
+    normalize=True, fields are cleaned up with normalize_records first.
+    Records whose directory can't be read are re-encoded as a whole instead.
+    """
+    codec_errors = _skip_stray_0x80(errors) if encoding == "utf8" else errors
+    # fast path: utf8 whose length won't change, so only leader position 9 needs setting
+    if encoding == "utf8" and b"\x00" not in record and b"\x80" not in record:
+        if normalize:
+            record = normalize_records(record)
+        return record[:9] + b"a" + record[10:]
+    try:
+        entries = _directory(record)
+    except ValueError:
+        entries = []
+    if not entries or any(start + length > len(record) for _, start, length in entries):
+        if normalize:
+            record = normalize_records(record)
+        return record.decode(encoding, codec_errors).encode("utf8")
+    directory = []
+    fields = []
+    offset = 0
+    for tag, start, length in entries:
+        data = record[start : start + length]
+        if normalize:
+            data = normalize_records(data)
+        data = data.decode(encoding, codec_errors).encode("utf8")
+        directory.append(b"%s%04d%05d" % (tag, len(data), offset))
+        fields.append(data)
+        offset += len(data)
+    base = 24 + 12 * len(directory) + 1
+    length = base + offset + 1
+    if length > 99999:
+        # too long to record in the leader, so leave the lengths as they were
+        return record.decode(encoding, codec_errors).encode("utf8")
+    leader = b"%05d%sa%s%05d%s" % (
+        length,
+        record[5:9],
+        record[10:12],
+        base,
+        record[17:24],
+    )
+    return leader + b"".join(directory) + b"\x1e" + b"".join(fields) + b"\x1d"
+
+
+def record_text(
+    chunk: MarcChunk, encoding="utf8", errors="strict", normalize=False
+) -> str:
+    """
+    Decodes a record from iter_marc_records. Base64 records are always
+    utf8, plain records are decoded with `encoding`. With normalize=True,
+    the record bytes are cleaned up with normalize_records before
+    decoding. With encoding="auto", the encoding of every record, base64
+    or not, is found with detect_encoding, and the record is transcoded to
+    utf8 with transcode_record, so that its lengths are right for utf8.
+    """
+    data = record_bytes(chunk)
+    if encoding == "auto":
+        return transcode_record(data, detect_encoding(data), errors, normalize).decode(
+            "utf8"
+        )
+    if normalize:
+        data = normalize_records(data)
+    if chunk.base64:
+        return data.decode("utf8", errors=_skip_stray_0x80(errors))
+    return data.decode(encoding)
+
+
+def record_bytes(chunk: MarcChunk) -> bytes:
+    "Raw marc bytes of a record from iter_marc_records, decoding base64 records."
+    data = bytes(chunk.data)
+    return decode_64_bytes(data) if chunk.base64 else data
+
+
+def _record_head(chunk: MarcChunk, size: int) -> bytes:
+    """
+    At least the first `size` bytes of a record from iter_marc_records (or all of it, if
+    shorter), decoding only as much of a base64 record as is needed.
+    """
+    if not chunk.base64:
+        return bytes(chunk.data[:size])
+    # a base64 line is 76 characters and a newline, and decodes to 57 bytes
+    end = (size // 57 + 1) * (_B64_LINE + 1)
+    head = decode_64_bytes(bytes(chunk.data[:end]))
+    if len(head) < size and end < len(chunk.data):
+        return record_bytes(chunk)
+    return head
+
+
+def _directory(record: bytes) -> list[Tuple[bytes, int, int]]:
+    """
+    Reads the directory of a marc record into (tag, start, length)
+    entries, with start relative to the start of the record.
+    Returns [] if the leader's base address is unreadable.
+    """
+    try:
+        base = int(record[12:17])
+    except ValueError:
+        return []
+    directory = record[24 : base - 1]
+    return [
+        (
+            directory[i : i + 3],
+            base + int(directory[i + 7 : i + 12]),
+            int(directory[i + 3 : i + 7]),
+        )
+        for i in range(0, len(directory) - 11, 12)
+    ]
+
+
+def record_tags(record: bytes) -> list[str]:
+    """
+    Tags of the fields in a marc record, read from
+    its directory without parsing the fields.
+    """
+    try:
+        return [tag.decode("ascii") for tag in _directory_tags(record)]
+    except UnicodeDecodeError:
+        return []
+
+
+def _directory_tags(record: bytes) -> list[bytes]:
+    """
+    the tags in the directory of a marc record, without reading the lengths and starts.
+    """
+    try:
+        base = int(record[12:17])
+    except ValueError:
+        return []
+    directory = record[24 : base - 1]
+    return [directory[i : i + 3] for i in range(0, len(directory) - 11, 12)]
+
+
+@instrumentation.timed("collect_tags")
+def collect_tags(
+    filename: Union[Path, str], index: Optional["MarcIndex"] = None
+) -> set[str]:
+    """
+    Set of tags used anywhere in a marc file, from the directories of its records.
+    Uses the record offsets in `index` if there is one, instead of splitting the file.
+    """
+    tags = set()
+    chunks = (
+        (index.chunk(i) for i in range(len(index)))
+        if index is not None
+        else iter_marc_records(filename)
+    )
+    for chunk in chunks:
+        tags.update(_chunk_tags(chunk))
+    return {tag.decode("ascii", "replace") for tag in tags}
+
+
+def _chunk_tags(chunk: MarcChunk) -> list[bytes]:
+    """
+    the tags in the directory of a record from iter_marc_records, decoding only the
+    directory of base64 records.
+    """
+    head = _record_head(chunk, 24)
+    try:
+        head = _record_head(chunk, int(head[12:17]))
+    except ValueError:
+        pass
+    return _directory_tags(head)
+
+
+def find_fields(record: bytes, tags: Collection[bytes]) -> list[Tuple[bytes, bytes]]:
+    """
+    Fields of a marc record with the given tags, as (tag, data) pairs in record order,
+    without the field terminator. Only the directory entries of these tags are read,
+    so the rest of the record is skipped without being decoded.
+    """
+    try:
+        base = int(record[12:17])
+    except ValueError:
+        return []
+    found = []
+    for i in range(24, base - 12, 12):
+        tag = record[i : i + 3]
+        if tag not in tags:
+            continue
+        try:
+            length = int(record[i + 3 : i + 7])
+            start = base + int(record[i + 7 : i + 12])
+        except ValueError:
+            continue
+        data = record[start : start + length]
+        found.append((tag, data[:-1] if data.endswith(b"\x1e") else data))
+    return found
+
+
+def _control_entry(record: bytes) -> Optional[Tuple[int, int]]:
+    """
+    (start, length) of the first 001 in the directory
+    of a marc record, or None if it has none.
+    """
+    try:
+        base = int(record[12:17])
+    except ValueError:
+        return None
+    # the 001 is nearly always the first entry, so this seldom reads more than one
+    i = record.find(b"001", 24, base - 1)
+    while i >= 0:
+        if (i - 24) % 12 == 0:
+            try:
+                return base + int(record[i + 7 : i + 12]), int(record[i + 3 : i + 7])
+            except ValueError:
+                return None
+        i = record.find(b"001", i + 1, base - 1)
+    return None
+
+
+def _control_number(record: bytes) -> bytes:
+    """
+    Reads the 001 field of a marc record from its
+    directory, or returns b"" if it has none.
+    """
+    entry = _control_entry(record)
+    if entry is None:
+        return b""
+    start, length = entry
+    data = record[start : start + length]
+    return data[:-1] if data.endswith(b"\x1e") else data
+
+
+def _chunk_control(chunk: MarcChunk) -> bytes:
+    """
+    The 001 of a record from iter_marc_records, like _control_number, but only decoding
+    as much of a base64 record as is needed to get to it.
+    """
+    if not chunk.base64:
+        return _control_number(bytes(chunk.data))
+    head = _record_head(chunk, 24)
+    try:
+        # the 001 is nearly always the first field,
+        # so the directory and a little more will do
+        head = _record_head(chunk, int(head[12:17]) + 64)
+    except ValueError:
+        return b""
+    entry = _control_entry(head)
+    if entry is not None and sum(entry) > len(head):
+        head = _record_head(chunk, sum(entry))
+    return _control_number(head)
+
+
+class FieldView:
+    """
+    A field of a RecordView, read-only and decoded when it is read, with the attributes
+    and methods of a pymarc Field that read it. Values are decoded as pymarc decodes
+    them (see RecordView).
+    """
+
+    __slots__ = ("tag", "control_field", "_data", "_utf8", "_errors")
+
+    def __init__(self, tag: str, data: memoryview, utf8: bool, errors: str = "strict"):
+        self.tag = tag
+        self.control_field = tag < "010" and tag.isdigit()
+        self._data = data  # the field without its terminator
+        self._utf8 = utf8
+        self._errors = errors
+
+    def is_control_field(self) -> bool:
+        return self.control_field
+
+    @property
+    def data(self) -> Optional[str]:
+        "The data of a control field, None for data fields."
+        if not self.control_field:
+            return None
+        return bytes(self._data).decode(
+            "utf-8" if self._utf8 else "iso8859-1", self._errors
+        )
+
+    def _indicators(self) -> str:
+        head = bytes(self._data[:2])
+        i = head.find(b"\x1f")
+        return ((head if i < 0 else head[:i]).decode("ascii", "replace") + "  ")[:2]
+
+    @property
+    def indicators(self) -> Optional[Indicators]:
+        return None if self.control_field else Indicators(*self._indicators())
+
+    @property
+    def indicator1(self) -> str:
+        return "" if self.control_field else self._indicators()[0]
+
+    @property
+    def indicator2(self) -> str:
+        return "" if self.control_field else self._indicators()[1]
+
+    def _decode(self, value: bytes) -> str:
+        if self._utf8:
+            return value.decode("utf-8", self._errors)
+        return marc8_to_unicode(value)
+
+    @property
+    def subfields(self) -> list[Subfield]:
+        "The subfields of a data field, [] for control fields."
+        if self.control_field:
+            return []
+        subfields = []
+        for subfield in bytes(self._data).split(b"\x1f")[1:]:
+            if not subfield:
+                continue
+            try:
+                code, skip = subfield[:1].decode("ascii"), 1
+            except UnicodeDecodeError:
+                code, skip = normalize_subfield_code(subfield)
+            subfields.append(Subfield(code, self._decode(subfield[skip:])))
+        return subfields
+
+    def get_subfields(self, *codes: str) -> list[str]:
+        return [s.value for s in self.subfields if s.code in codes]
+
+    def get(self, code: str, default: Optional[str] = None) -> Optional[str]:
+        for subfield in self.subfields:
+            if subfield.code == code:
+                return subfield.value
+        return default
+
+    def __getitem__(self, code: str) -> str:
+        value = self.get(code)
+        if value is None:
+            raise KeyError(code)
+        return value
+
+    def value(self) -> str:
+        if self.control_field:
+            return self.data or ""
+        return " ".join(s.value.strip() for s in self.subfields)
+
+    def raw(self) -> bytes:
+        "The field as it is in the record, without its terminator."
+        return bytes(self._data)
+
+    def to_field(self) -> Field:
+        "The field as a pymarc Field."
+        if self.control_field:
+            return Field(tag=self.tag, data=self.data)
+        return Field(tag=self.tag, indicators=self.indicators, subfields=self.subfields)
+
+    def __repr__(self) -> str:
+        return f"FieldView({self.tag!r}, {self.raw()!r})"
+
+
+class RecordView:
+    """
+    A read-only view of a marc record, for reading records without parsing them into a
+    pymarc Record. Only the directory is read up front, into an array of field starts
+    and lengths; fields are decoded when they are read, as FieldViews. RecordView and
+    FieldView have the attributes and methods of pymarc's Record and Field that read
+    them (leader, get_fields, get, [tag], subfields, ...), and decode values the same
+    way: as utf8 if leader position 9 is "a" or force_utf8 is set, otherwise control
+    fields as latin-1 and subfields as MARC-8. Use to_record() for a Record that can be
+    changed. Raises ValueError if the leader or directory can't be read.
+    """
+
+    __slots__ = ("data", "utf8", "utf8_handling", "_directory", "_entries")
+
+    def __init__(
+        self, data: Union[bytes, memoryview], force_utf8=False, utf8_handling="strict"
+    ):
+        self.data = memoryview(data)
+        base = int(bytes(self.data[12:17]))
+        if not 24 < base < len(self.data) or (base - 25) % 12:
+            raise ValueError(
+                f"invalid base address {base} for a record of {len(self.data)} bytes"
+            )
+        # the tags are read from the directory itself, which is 12 bytes per field
+        self._directory = bytes(self.data[24 : base - 1])
+        directory = self._directory
+        # (start, length) of every field, one after the other
+        self._entries = array(
+            "L",
+            [
+                n
+                for i in range(0, len(directory), 12)
+                for n in (
+                    base + int(directory[i + 7 : i + 12]),
+                    int(directory[i + 3 : i + 7]),
+                )
+            ],
+        )
+        self.utf8 = force_utf8 or self.data[9:10] == b"a"
+        self.utf8_handling = utf8_handling
+
+    @property
+    def leader(self) -> Leader:
+        return Leader(bytes(self.data[:24]).decode("ascii"))
+
+    def __len__(self) -> int:
+        return len(self._entries) // 2
+
+    def _field(self, i: int) -> FieldView:
+        start, length = self._entries[2 * i], self._entries[2 * i + 1]
+        # pymarc drops the last byte of a field, which should be the field terminator
+        data = self.data[start : start + length - 1]
+        tag = self._directory[12 * i : 12 * i + 3].decode("ascii")
+        return FieldView(tag, data, self.utf8, self.utf8_handling)
+
+    def _positions(self, tags: Collection[str]) -> Generator[int]:
+        for tag in tags:
+            key = tag.encode("ascii")
+            i = self._directory.find(key)
+            while i >= 0:
+                if i % 12 == 0:
+                    yield i // 12
+                i = self._directory.find(key, i + 1)
+
+    @property
+    def fields(self) -> list[FieldView]:
+        return [self._field(i) for i in range(len(self))]
+
+    def __iter__(self) -> Generator[FieldView]:
+        for i in range(len(self)):
+            yield self._field(i)
+
+    def get_fields(self, *tags: str) -> list[FieldView]:
+        """
+        The fields with any of the given tags, or all
+        of them if no tags are given, in record order.
+        """
+        if not tags:
+            return self.fields
+        return [self._field(i) for i in sorted(set(self._positions(tags)))]
+
+    def get(self, tag: str, default: Optional[FieldView] = None) -> Optional[FieldView]:
+        for i in self._positions([tag]):
+            return self._field(i)
+        return default
+
+    def __getitem__(self, tag: str) -> FieldView:
+        field = self.get(tag)
+        if field is None:
+            raise KeyError(tag)
+        return field
+
+    def __contains__(self, tag: str) -> bool:
+        return self.get(tag) is not None
+
+    def raw_fields(self) -> Generator[Tuple[str, memoryview]]:
+        """
+        (tag, data) of every field as it is in the record, without its terminator,
+        without decoding it.
+        """
+        directory, entries = self._directory, self._entries
+        for i in range(len(self)):
+            start = entries[2 * i]
+            yield (
+                directory[12 * i : 12 * i + 3].decode("ascii"),
+                self.data[start : start + entries[2 * i + 1] - 1],
+            )
+
+    def tags(self) -> list[str]:
+        return [
+            self._directory[i : i + 3].decode("ascii")
+            for i in range(0, len(self._directory), 12)
+        ]
+
+    def as_marc(self) -> bytes:
+        return bytes(self.data)
+
+    def to_record(self) -> Record:
+        "The record parsed into a pymarc Record, e.g. to change it."
+        return Record(
+            data=bytes(self.data),
+            force_utf8=self.utf8,
+            utf8_handling=self.utf8_handling,
+        )
+
+
+@instrumentation.timed_iter("record_views")
+def iter_record_views(
+    filename: Union[Path, str, BinaryIO],
+    start: int = 0,
+    force_utf8=False,
+    utf8_handling="strict",
+    validator: Optional[Callable[[bytes, int], None]] = None,
+) -> Generator[RecordView]:
+    """
+    Generator of RecordViews of the records in a marc file, from iter_marc_records, so
+    files with base64 records are read as well (base64 records are always utf8). Records
+    whose directory can't be read are reported and skipped. Each record's bytes and
+    offset are passed to `validator` if given (a validation.Validator), including those
+    of the records that are skipped.
+    """
+    for chunk in iter_marc_records(filename, start=start):
+        data = record_bytes(chunk)
+        if validator is not None:
+            validator(data, chunk.offset)
+        try:
+            yield RecordView(
+                data, force_utf8=force_utf8 or chunk.base64, utf8_handling=utf8_handling
+            )
+        except ValueError as e:
+            instrumentation.count("skipped")
+            print(f"warning: record at byte {chunk.offset} skipped: {e!r}")
+
+
+# one row of a MarcIndex: where a record is in the
+# file, whether it is base64, and its 001
+INDEX_DTYPE = np.dtype(
+    [("offset", "<u8"), ("length", "<u4"), ("base64", "?"), ("control", "S23")]
+)
+# sidecar header: magic, size and mtime of the
+# indexed file, and crc32 of its last few kB
+_INDEX_HEADER = struct.Struct("<8sQqI4x")
+_INDEX_MAGIC = b"MARCIDX1"
+_INDEX_TAIL = 4096
+
+
+def _tail_crc(f: BinaryIO, size: int) -> int:
+    f.seek(max(0, size - _INDEX_TAIL))
+    return zlib.crc32(f.read(min(size, _INDEX_TAIL)))
+
+
+class MarcIndex:
+    """
+    Offset index for a marc file, for random access to records without rescanning the
+    file. The index is kept in a sidecar file next to the marc file (<filename>.idx),
+    holding a numpy structured array with one INDEX_DTYPE row per record, and both are
+    memory-mapped. The index is checked against the size and mtime of the marc file when
+    opened: if records have only been appended, just the new records are indexed,
+    otherwise it is rebuilt.
+    """
+
+    def __init__(
+        self, filename: Union[Path, str], sidecar: Union[Path, str, None] = None
+    ):
+        self.filename = Path(filename)
+        if not self.filename.exists():
+            raise FileNotFoundError(f"File {self.filename} not found.")
+        self.sidecar = Path(sidecar) if sidecar else Path(f"{self.filename}.idx")
+        self._by_control = None
+        self._refresh()
+
+    def _read_header(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            with open(self.sidecar, "rb") as f:
+                magic, size, mtime, crc = _INDEX_HEADER.unpack(
+                    f.read(_INDEX_HEADER.size)
+                )
+        except (FileNotFoundError, struct.error):
+            return None
+        if magic != _INDEX_MAGIC:
+            return None
+        return size, mtime, crc
+
+    def _refresh(self) -> None:
+        stat = self.filename.stat()
+        header = self._read_header()
+        if header is None:
+            self._build(stat, 0)
+        elif header[:2] != (stat.st_size, stat.st_mtime_ns):
+            size, _, crc = header
+            with open(self.filename, "rb") as f:
+                appended = stat.st_size > size and _tail_crc(f, size) == crc
+            self._build(stat, size if appended else 0)
+        self._map()
+
+    def _build(self, stat: os.stat_result, indexed_size: int) -> None:
+        "(re)indexes the file from indexed_size, or from scratch if indexed_size is 0."
+        rows = []
+        start = 0
+        if indexed_size:
+            old = np.fromfile(
+                self.sidecar, dtype=INDEX_DTYPE, offset=_INDEX_HEADER.size
+            )
+            # the last record may have been incomplete, so it is indexed again
+            if len(old):
+                start = int(old["offset"][-1])
+                old = old[:-1]
+        for chunk in iter_marc_records(self.filename, start=start):
+            rows.append(
+                (chunk.offset, len(chunk.data), chunk.base64, _chunk_control(chunk))
+            )
+        new = np.array(rows, dtype=INDEX_DTYPE)
+        with open(self.filename, "rb") as f:
+            crc = _tail_crc(f, stat.st_size)
+        header = _INDEX_HEADER.pack(_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, crc)
+        if indexed_size:
+            with open(self.sidecar, "r+b") as f:
+                f.write(header)
+                f.seek(_INDEX_HEADER.size + old.nbytes)
+                f.truncate()
+                f.write(new.tobytes())
+        else:
+            with open(self.sidecar, "wb") as f:
+                f.write(header)
+                f.write(new.tobytes())
+        self._by_control = None
+
+    def _map(self) -> None:
+        with open(self.filename, "rb") as f:
+            # mmap can't map an empty file
+            self._data = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if self.filename.stat().st_size
+                else b""
+            )
+        count = (
+            self.sidecar.stat().st_size - _INDEX_HEADER.size
+        ) // INDEX_DTYPE.itemsize
+        self.rows = (
+            np.memmap(
+                self.sidecar,
+                dtype=INDEX_DTYPE,
+                mode="r",
+                offset=_INDEX_HEADER.size,
+                shape=(count,),
+            )
+            if count
+            else np.empty(0, dtype=INDEX_DTYPE)
+        )
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def raw(self, i: int) -> memoryview:
+        """
+        The i-th record as it appears in the file, i.e.
+        still in base64 if it is base64, without copying.
+        """
+        row = self.rows[i]
+        offset = int(row["offset"])
+        return memoryview(self._data)[offset : offset + int(row["length"])]
+
+    def chunk(self, i: int) -> MarcChunk:
+        row = self.rows[i]
+        return MarcChunk(int(row["offset"]), self.raw(i), bool(row["base64"]))
+
+    def chunks(self, positions: Optional[Sequence[int]] = None) -> Generator[MarcChunk]:
+        """
+        The records at the given positions (all of them by default) as MarcChunks, like
+        chunk(), but reading the rows for them all at once, which is much quicker than
+        one by one.
+        """
+        rows = self.rows if positions is None else self.rows[positions]
+        data = memoryview(self._data)
+        for offset, length, base64 in zip(
+            rows["offset"].tolist(), rows["length"].tolist(), rows["base64"].tolist()
+        ):
+            yield MarcChunk(offset, data[offset : offset + length], base64)
+
+    def record_bytes(self, i: int) -> bytes:
+        "The i-th record as marc bytes, decoding base64."
+        return record_bytes(self.chunk(i))
+
+    def record(self, i: int, **kwargs) -> Record:
+        """The i-th record parsed into a pymarc Record, kwargs are passed on to Record.
+        Base64 records are always utf8, so force_utf8 is set for them."""
+        if self.rows[i]["base64"]:
+            kwargs.setdefault("force_utf8", True)
+        return Record(data=self.record_bytes(i), **kwargs)
+
+    def view(self, i: int, **kwargs) -> RecordView:
+        """
+        The i-th record as a read-only RecordView, which is cheaper than record() when
+        only some fields are read; kwargs are passed on to RecordView. Base64 records
+        are always utf8.
+        """
+        if self.rows[i]["base64"]:
+            kwargs.setdefault("force_utf8", True)
+        return RecordView(self.record_bytes(i), **kwargs)
+
+    def position(self, control: Union[str, bytes]) -> int:
+        """
+        Position in the file of the (first) record with the given 001, raises KeyError
+        if there is none.
+        """
+        if isinstance(control, str):
+            control = control.encode("utf8")
+        if self._by_control is None:
+            order = np.argsort(self.rows["control"], kind="stable")
+            self._by_control = (order, self.rows["control"][order])
+        order, controls = self._by_control
+        i = int(np.searchsorted(controls, control))
+        if i == len(controls) or controls[i] != control:
+            raise KeyError(control)
+        return int(order[i])
+
+    def by_control(self, control: Union[str, bytes], **kwargs) -> Record:
+        return self.record(self.position(control), **kwargs)
+
+    def containing(self, needle: bytes) -> np.ndarray:
+        """
+        Whether each record contains `needle` as it is in the file
+        (so a base64 record only if its base64 does), from one
+        search of the whole file rather than record by record.
+        """
+        found = np.fromiter(
+            (m.start() for m in re.finditer(re.escape(needle), self._data)), np.int64
+        )
+        mask = np.zeros(len(self.rows), bool)
+        if len(found) and len(self.rows):
+            offsets = self.rows["offset"].astype(np.int64)
+            i = np.maximum(np.searchsorted(offsets, found, "right") - 1, 0)
+            inside = (found >= offsets[i]) & (
+                found + len(needle) <= offsets[i] + self.rows["length"][i]
+            )
+            mask[i[inside]] = True
+        return mask
+
+    def refresh(self) -> None:
+        "Picks up changes to the marc file since the index was opened."
+        self.close()
+        self._refresh()
+
+    def close(self) -> None:
+        """
+        Unmaps the file and the index. Records from raw() or chunks() that are still
+        held (e.g. by a RecordView) keep the file mapped until they are released.
+        """
+        if isinstance(self._data, mmap.mmap):
+            try:
+                self._data.close()
+            except BufferError:
+                # mmap can't be closed while there are views of it,
+                # so it's left to be unmapped once they are gone
+                pass
+        self._data = b""
+        self.rows = np.empty(0, dtype=INDEX_DTYPE)
+        self._by_control = None
+
+    def __enter__(self) -> "MarcIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _batched(items: Iterable[S], size: int) -> Generator[list[S]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def map_record_batches(
+    func: Callable[[list[S]], T],
+    records: Iterable[S],
+    workers: int = 1,
+    batch_size: int = 500,
+) -> Generator[T]:
+    """
+    Applies func to batches of batch_size records (e.g. MarcChunks, or csv rows), in a
+    pool of `workers` processes if workers > 1, and yields the results in the original
+    record order. At most 2 * workers batches are in flight at once, so memory use stays
+    bounded however far the pool falls behind the reader. func has to be picklable, e.g.
+    a module-level function or a functools.partial of one.
+    """
+    batches = _batched(records, batch_size)
+    if workers <= 1:
+        yield from map(func, batches)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for batch in batches:
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+            pending.append(pool.submit(func, batch))
+        while pending:
+            yield pending.popleft().result()
+
+
+def _flatten_batch(
+    batch: list[MarcChunk], encoding: str, errors: str
+) -> Tuple[str, int]:
+    records = []
+    for chunk in batch:
+        records.append(record_text(chunk, encoding, errors, normalize=True))
+    return "".join(records), len(records)
+
+
+@instrumentation.timed("flatten")
+def flatten_mixed_marc(
+    filename: Union[Path, str], encoding="auto", errors="strict", workers: int = 1
+) -> Path:
+    """
+    Take path to marc file containing mix of regular utf8 and base64 utf8, and rewrites
+    it to only include regular utf8, i.e. binary encodings of the final characters
+    themselves in utf8. Plain records are read with `encoding`; by default ("auto") the
+    encoding is detected record by record and the records are transcoded to utf8 with
+    valid lengths, so there's no need to separate and iconv the file first. Invalid
+    utf-8 in base64 records is handled according to `errors`, as for bytes.decode. With
+    workers > 1, records are decoded in a pool of that many processes; the output is the
+    same as with a single process.
     """
     if isinstance(filename, str):
         filename = Path(filename)
     if not filename.exists():
         raise FileNotFoundError(f"File {filename} not found.")
-    lines = []
-    base64_buffer = []
-    with open(str(filename), "r", encoding=encoding) as f:
-        in_base64 = False
-        base64_segment = ""
-        base64_records = []
-        for line in f:
-            if not in_base64:
-                in_base64 = _handle_base64(line, lines, base64_buffer)
-                continue
-                # base64 encoding sometimes continues on same line as regular utf8 record
-            match = re.search(RECORD_START, line)
-            if match:
-                start, _ = match.span()
-                if start > 0:
-                    base64_buffer.append(line[:start])
-                base64_records = _get_records_64(base64_buffer)
-                for line_64 in base64_records:
-                    base64_segment = "".join([char for char in decode_64(line_64)])
-                    lines.append(base64_segment)
-                base64_buffer = []
-                in_base64 = _handle_base64(line[start:], lines, base64_buffer)
-                continue
-            base64_buffer.append(line)
-        # deal with anything left over in base64_buffer
-        base64_records = _get_records_64(base64_buffer)
-        for line_64 in base64_records:
-            base64_segment = "".join([char for char in decode_64(line_64)])
-            lines.append(base64_segment)
-        del base64_buffer, base64_segment, base64_records
     count = 0
-    for i, line in enumerate(lines):
-        lines[i] = _normalize_record_spacing(line)
-        # deal with random null characters
-        lines[i] = line.replace("\x00", "")
+    flatten = partial(_flatten_batch, encoding=encoding, errors=errors)
     with open(f"flattened_{filename}", "w", encoding="utf8") as f:
-        for line in lines:
-            count += 1
-            f.write(line)
+        for records, n in map_record_batches(
+            flatten, iter_marc_records(filename), workers
+        ):
+            count += n
+            f.write(records)
     msg = f"""
         Converted base64 in marc file {filename} to standard utf8
-        and wrote {count} lines to flattened_{filename}.
+        and wrote {count} records to flattened_{filename}.
     """
     print(msg)
     return Path(f"flattened_{filename}")
 
 
+def _separate_batch(
+    batch: list[MarcChunk], encoding: str, errors: str
+) -> Tuple[str, int, str, int]:
+    records = []
+    records_64 = []
+    count = 0
+    count_64 = 0
+    for chunk in batch:
+        record = record_text(chunk, encoding, errors, normalize=True)
+        if not chunk.base64:
+            count += len(record)
+            records.append(record)
+            continue
+        count_64 += len(record)
+        records_64.append(record)
+    return "".join(records), count, "".join(records_64), count_64
+
+
 # default encoding here is ISO-8859-1, since that's what the marc exports from librarything are
 # encoded in, even though base64 sections must be mapped to utf8.
+@instrumentation.timed("flatten")
 def separate_mixed_marc(
-    filename: Union[Path, str], encoding="ISO-8859-1"
+    filename: Union[Path, str], encoding="ISO-8859-1", errors="strict", workers: int = 1
 ) -> Tuple[Path, Path]:
-    """Take path to marc file containing mix of regular utf8 and base64 utf8,
-    and rewrites it to only include regular utf8, i.e. binary encodings of
-    the final characters themselves in utf8. This relies on
-    base64 encoding strings beginning with MDA and plain utf8 strsing beginning with 00###.
+    """
+    Take path to marc file containing mix of regular utf8 and base64 utf8, and writes
+    the plain records (in `encoding`) and the base64 records (decoded to utf8) to
+    separate files. Invalid utf-8 in base64 records is handled according to `errors`, as
+    for bytes.decode. With workers > 1, records are decoded in a pool of that many
+    processes; the output is the same as with a single process.
     """
     if isinstance(filename, str):
         filename = Path(filename)
     if not filename.exists():
         raise FileNotFoundError(f"File {filename} not found.")
-    lines = []
-    base64_lines = []
-    base64_buffer = []
-    with open(str(filename), "r", encoding=encoding) as f:
-        in_base64 = False
-        base64_segment = ""
-        for line in f:
-            if not in_base64:
-                in_base64 = _handle_base64(line, lines, base64_buffer)
-                continue
-                # base64 encoding sometimes continues on same line as regular utf8 record
-            match = re.search(RECORD_START, line)
-            if match:
-                start, _ = match.span()
-                if start > 0:
-                    base64_buffer.append(line[:start])
-                base64_records = _get_records_64(base64_buffer)
-                for line_64 in base64_records:
-                    base64_segment = "".join([char for char in decode_64(line_64)])
-                    base64_lines.append(base64_segment)
-                base64_buffer = []
-                in_base64 = _handle_base64(line[start:], lines, base64_buffer)
-                continue
-            base64_buffer.append(line)
-        # deal with anything left over in base64_buffer
-        base64_records = _get_records_64(base64_buffer)
-        for line_64 in base64_records:
-            base64_segment = "".join([char for char in decode_64(line_64)])
-            base64_lines.append(base64_segment)
-        del base64_segment, base64_buffer, base64_records
     if encoding == "ISO-8859-1":
         enc_name = "LATIN1"
     else:
         enc_name = encoding
 
     count = 0
-    with open(f"{enc_name}_{filename}", "w", encoding=encoding) as f:
-        for line in lines:
-            line = _normalize_record_spacing(line)
-            count += len(line)
-            f.write(line)
+    count_64 = 0
+    separate = partial(_separate_batch, encoding=encoding, errors=errors)
+    with (
+        open(f"{enc_name}_{filename}", "w", encoding=encoding) as f,
+        open(f"UTF8_{filename}", "w", encoding="utf8") as f_64,
+    ):
+        for records, n, records_64, n_64 in map_record_batches(
+            separate, iter_marc_records(filename), workers
+        ):
+            count += n
+            count_64 += n_64
+            f.write(records)
+            f_64.write(records_64)
     msg = f"""
         from {filename} wrote {enc_name}_{filename} with {count} characters 
         in encoding format {encoding}.
     """
     print(msg)
-
-    count = 0
-    with open(f"UTF8_{filename}", "w", encoding="utf8") as f:
-        for line in base64_lines:
-            count += len(line)
-            line = _normalize_record_spacing(line)
-            # deal with random null characters
-            line = line.replace("\x00", "")
-            line = line.strip("\n")
-            f.write(line)
     msg = f"""
-        from {filename} wrote UTF8_{filename} with {count} characters 
+        from {filename} wrote UTF8_{filename} with {count_64} characters 
         in encoding format UTF8.
     """
     print(msg)
@@ -0,0 +1,91 @@
+from contextlib import chdir, redirect_stdout
+from pathlib import Path
+
+from csv_converter import iter_records
+from testing import run_tests
+from utils import (
+    MarcIndex,
+    RecordView,
+    flatten_mixed_marc,
+    iter_marc_records,
+    iter_record_views,
+    separate_mixed_marc,
+)
+
+HERE = Path(__file__).parent
+
+
+def test_index(tmp_path):
+    filename = tmp_path / "librarything_UMClassics.marc"
+    filename.write_bytes((HERE / "librarything_UMClassics.marc").read_bytes())
+    chunks = list(iter_marc_records(filename))
+    with MarcIndex(filename) as index:
+        assert len(index) == len(chunks)
+        assert bytes(index.raw(1)) == chunks[1].data
+        position = index.position("65277343")
+        assert index.by_control("65277343")["001"].data == "65277343"
+        assert index.record(position)["001"].data == "65277343"
+    # appended records are picked up from the sidecar without reindexing everything
+    with open(filename, "ab") as f:
+        f.write((HERE / "PGA-Australiana.mrc").read_bytes())
+    with MarcIndex(filename) as index:
+        assert len(index) == len(list(iter_marc_records(filename)))
+        assert index.record(len(index) - 1)["245"] is not None
+
+
+def test_index_close_with_views(tmp_path):
+    filename = tmp_path / "pga.mrc"
+    filename.write_bytes((HERE / "PGA-Australiana.mrc").read_bytes())
+    index = MarcIndex(filename)
+    raw = index.raw(0)
+    chunk = next(index.chunks([1]))
+    expected = (bytes(raw), bytes(chunk.data))
+    view = RecordView(chunk.data)
+    # the views keep the file mapped after the index is closed
+    index.close()
+    assert (bytes(raw), bytes(chunk.data)) == expected
+    assert view["245"].raw() == RecordView(expected[1])["245"].raw()
+    del raw, chunk, view
+    index.close()
+
+
+def test_record_view():
+    # PGA-Australiana is utf8, the LibraryThing file
+    # is read as MARC-8 by pymarc, as its leaders say
+    for name in ("PGA-Australiana.mrc", "UTF8_librarything_UMClassics.marc"):
+        views = list(iter_record_views(HERE / name))
+        records = list(iter_records(HERE / name))
+        assert len(views) == len(records)
+        for i, (view, record) in enumerate(zip(views, records)):
+            assert view.leader.leader == record.leader.leader
+            assert [(f.tag, f.data, f.indicators, f.subfields) for f in view] == [
+                (f.tag, f.data, f.indicators, f.subfields) for f in record
+            ]
+            assert [f.value() for f in view.get_fields("245", "100")] == [
+                f.value() for f in record.get_fields("245", "100")
+            ]
+            if i % 100 == 0:
+                assert str(view.to_record()) == str(record)
+    assert views[0]["245"]["a"] == records[0]["245"]["a"]
+    assert views[0].get("999") is None and "999" not in views[0]
+
+
+def test_workers_output(tmp_path):
+    # records are decoded in batches across processes,
+    # and have to be written in the order they came in
+    for name in ["librarything_UMClassics.marc", "PGA-Australiana.mrc"]:
+        outputs = []
+        for workers in [1, 3]:
+            directory = tmp_path / f"{workers}_{name}"
+            directory.mkdir()
+            (directory / name).write_bytes((HERE / name).read_bytes())
+            # the output files are written to the working directory
+            with chdir(directory), redirect_stdout(None):
+                paths = [flatten_mixed_marc(name, errors="replace", workers=workers)]
+                paths += separate_mixed_marc(name, errors="replace", workers=workers)
+            outputs.append([(directory / path).read_bytes() for path in paths])
+        assert outputs[0] == outputs[1] and all(outputs[0][:2])
+
+
+if __name__ == "__main__":
+    run_tests(globals())
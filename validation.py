@@ -0,0 +1,638 @@
+# checking marc records before they go to Library
+# World, in the same pass as reading or writing them
+#
+# A Validator checks the raw bytes of a record: the leader (its codes, the record
+# length against the actual byte count, and the base address against the end of
+# the directory), the directory (12-byte entries that follow on from each other
+# and end on field terminators), the record terminator, indicators and subfields
+# per tag, non-repeatable tags, required tags, and whether leader/09 agrees with
+# the encoding. The rules per tag are in RULES, compiled once into a table keyed
+# by the tag's bytes. Records are checked in batches: numpy screens a whole batch
+# at once (see Validator.screen), and only the records that fail are gone through
+# field by field in Python. The readers and writers take a validator and hand it
+# each record as it goes past, and the problems are collected as (byte offset,
+# 001, tag, code, detail), for a compact tab-separated report.
+
+import argparse
+import csv
+import re
+import sys
+from collections import Counter
+from collections.abc import Iterable, Mapping, Sequence
+from contextlib import nullcontext
+from itertools import accumulate
+from pathlib import Path
+from typing import NamedTuple, Optional, TextIO, Tuple, Union
+
+import numpy as np
+
+import instrumentation
+from utils import _control_number, iter_marc_records, record_bytes
+
+
+class Rule(NamedTuple):
+    """
+    what a field with a tag may look like: its indicators, whether it repeats, and
+    subfields it must have
+    """
+
+    ind1: str = ""
+    ind2: str = ""
+    repeatable: bool = True
+    subfields: str = ""
+
+
+# indicators are digits, lowercase letters or blank
+ANY_INDICATOR = "0123456789abcdefghijklmnopqrstuvwxyz "
+_DIGITS = "0123456789"
+# the marc 21 bibliographic rules for the fields in the catalogue; tags that aren't here
+# may have any indicators, and "" allows any indicator as well
+RULES = {
+    "001": Rule(repeatable=False),
+    "003": Rule(repeatable=False),
+    "005": Rule(repeatable=False),
+    "008": Rule(repeatable=False),
+    "010": Rule(" ", " ", repeatable=False),
+    "020": Rule(" ", " "),
+    "022": Rule(" 01", " "),
+    "040": Rule(" ", " ", repeatable=False),
+    "041": Rule(" 01", " 7"),
+    "050": Rule(" 01", "04"),
+    "082": Rule("017", " 04"),
+    "100": Rule("013", " ", repeatable=False, subfields="a"),
+    "110": Rule("012", " ", repeatable=False, subfields="a"),
+    "111": Rule("012", " ", repeatable=False, subfields="a"),
+    "130": Rule(_DIGITS, " ", repeatable=False, subfields="a"),
+    "240": Rule("01", _DIGITS, repeatable=False),
+    "245": Rule("01", _DIGITS, repeatable=False, subfields="a"),
+    "246": Rule("0123", " 012345678"),
+    "250": Rule(" ", " "),
+    "260": Rule(" 23", " "),
+    "264": Rule(" 23", "01234"),
+    "300": Rule(" ", " "),
+    "490": Rule("01", " "),
+    "500": Rule(" ", " ", subfields="a"),
+    "504": Rule(" ", " "),
+    "505": Rule("0128", " 0"),
+    "520": Rule(" 012348", " "),
+    "600": Rule("013", "01234567"),
+    "610": Rule("012", "01234567"),
+    "650": Rule(" 012", "01234567"),
+    "651": Rule(" ", "01234567"),
+    "700": Rule("013", " 2"),
+    "710": Rule("012", " 2"),
+    "830": Rule(" ", _DIGITS),
+    "856": Rule(" 012347", " 0128"),
+}
+REQUIRED_TAGS = ("001", "245")
+
+# the codes allowed at each position of the leader, see
+# https://www.loc.gov/marc/bibliographic/bdleader.html (position 17 also allows the OCLC
+# encoding levels I, J, K, L and M)
+LEADER_CODES = {
+    5: ("status", "acdnp"),
+    6: ("type", "acdefgijkmoprt"),
+    7: ("bibliographic level", "abcdims"),
+    8: ("type of control", " a"),
+    9: ("character coding", " a"),
+    17: ("encoding level", " 12345678uzIJKLM"),
+    18: ("cataloguing form", " acinu"),
+    19: ("multipart level", " abc"),
+}
+_LEADER = re.compile(
+    rb"\d{5}"
+    + b"".join(
+        b"[" + re.escape(LEADER_CODES[i][1].encode()) + b"]" for i in range(5, 10)
+    )
+    + rb"22\d{5}"
+    + b"".join(
+        b"[" + re.escape(LEADER_CODES[i][1].encode()) + b"]" for i in range(17, 20)
+    )
+    + rb"4500"
+)
+_DIRECTORY = re.compile(rb"(?:[0-9A-Za-z]{3}\d{9})*")
+_ENTRY = re.compile(rb"([0-9A-Za-z]{3})(\d{4})(\d{5})")
+
+# a problem found in a record: byte offset, 001, tag (LDR for the leader and the record
+# as a whole), a short code to count problems by, and the details
+Issue = Tuple[int, str, str, str, str]
+
+
+def compile_rules(
+    rules: Mapping[str, Rule] = RULES,
+) -> dict[bytes, Tuple[bytes, bytes, bool, Tuple[bytes, ...]]]:
+    """
+    The rules as a table keyed by the tag's bytes, with the allowed indicators as bytes
+    and the required subfields as the bytes that start them.
+    """
+    return {
+        tag.encode(): (
+            (rule.ind1 or ANY_INDICATOR).encode(),
+            (rule.ind2 or ANY_INDICATOR).encode(),
+            rule.repeatable,
+            tuple(b"\x1f" + code.encode() for code in rule.subfields),
+        )
+        for tag, rule in rules.items()
+    }
+
+
+# bytes allowed in a tag, and digits, as lookup tables for Validator.screen
+_ALNUM = np.zeros(256, bool)
+_ALNUM[
+    np.frombuffer(
+        b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz", np.uint8
+    )
+] = True
+_DIGIT = np.zeros(256, bool)
+_DIGIT[48:58] = True
+
+
+def _numbers(digits: np.ndarray) -> np.ndarray:
+    "the decimal numbers in the rows of a matrix of ascii digits"
+    return (digits.astype(np.int64) - 48) @ 10 ** np.arange(digits.shape[1] - 1, -1, -1)
+
+
+def _tag_keys(tags: np.ndarray) -> np.ndarray:
+    "3-byte tags as integers"
+    tags = tags.astype(np.int64)
+    return tags[:, 0] << 16 | tags[:, 1] << 8 | tags[:, 2]
+
+
+class Validator:
+    """
+    Checks marc records against `rules` (see RULES) and the tags they must have. check()
+    returns the problems with one record. Batches of records are screened with numpy
+    first (see screen()), and only the records that fail are gone through with check(),
+    which keeps validation cheap enough to leave on: calling the validator with a record
+    and its offset queues it, and `issues` checks what is queued. scan() checks a run of
+    records back to back, e.g. a batch written by to_marc. Validators can be pickled, so
+    workers can scan the records they build and hand back the problems.
+    """
+
+    def __init__(
+        self,
+        rules: Mapping[str, Rule] = RULES,
+        required: Sequence[str] = REQUIRED_TAGS,
+        batch_size: int = 500,
+    ):
+        self.table = compile_rules(rules)
+        self.required = frozenset(tag.encode() for tag in required)
+        self.default = compile_rules({"": Rule()})[b""]
+        self.unique = frozenset(tag for tag, rule in self.table.items() if not rule[2])
+        self.batch_size = batch_size
+        self.records = 0
+        self._issues: list[Issue] = []
+        self._queue: list[Tuple[bytes, int]] = []
+        self._leaders: dict[bytes, list] = {}
+        # the table again as arrays for screen(): the rules' tags as integers, in order,
+        # whether each rule (and the default rule, last) allows an indicator byte, is
+        # non-repeatable, and needs each of the subfield codes that any rule needs
+        tags = sorted(self.table)
+        rules = [self.table[tag] for tag in tags] + [self.default]
+        self._keys = _tag_keys(np.frombuffer(b"".join(tags), np.uint8).reshape(-1, 3))
+        self._ind1 = np.zeros((len(rules), 256), bool)
+        self._ind2 = np.zeros((len(rules), 256), bool)
+        for i, (ind1, ind2, _, _) in enumerate(rules):
+            self._ind1[i, np.frombuffer(ind1, np.uint8)] = True
+            self._ind2[i, np.frombuffer(ind2, np.uint8)] = True
+        self._unique = np.array([not rule[2] for rule in rules])
+        self._codes = sorted({code for rule in rules for code in rule[3]})
+        self._needs = np.array(
+            [[code in rule[3] for code in self._codes] for rule in rules]
+        ).reshape(len(rules), len(self._codes))
+        self._required = _tag_keys(
+            np.frombuffer(b"".join(sorted(self.required)), np.uint8).reshape(-1, 3)
+        )
+        self._leader = np.ones((24, 256), bool)
+        for position, (_, codes) in LEADER_CODES.items():
+            self._leader[position] = False
+            self._leader[position, np.frombuffer(codes.encode(), np.uint8)] = True
+        for position, code in zip((10, 11, 20, 21, 22, 23), b"224500"):
+            self._leader[position] = False
+            self._leader[position, code] = True
+
+    def check(self, record: Union[bytes, memoryview]) -> list[Tuple[str, str, str]]:
+        "The problems with a marc record, as (tag, code, detail)."
+        record = bytes(record)
+        problems = []
+        size = len(record)
+        leader = record[:24]
+        if size < 25:
+            return [("LDR", "length", f"record is only {size} bytes")]
+        if not _LEADER.fullmatch(leader):
+            problems += _leader_problems(leader)
+        if leader[:5].isdigit() and int(leader[:5]) != size:
+            problems.append(
+                (
+                    "LDR",
+                    "length",
+                    f"leader says {int(leader[:5])} bytes, record has {size}",
+                )
+            )
+        if record[-1] != 0x1D:
+            problems.append(
+                ("LDR", "terminator", "record doesn't end with a record terminator")
+            )
+        end = record.find(b"\x1e", 24)
+        if end < 0 or (end - 24) % 12 or not _DIRECTORY.fullmatch(record, 24, end):
+            problems.append(
+                (
+                    "LDR",
+                    "directory",
+                    "directory isn't 12-byte entries of a tag and 9 digits",
+                )
+            )
+            return problems
+        if leader[12:17].isdigit() and int(leader[12:17]) != end + 1:
+            problems.append(
+                (
+                    "LDR",
+                    "base",
+                    f"base address is {int(leader[12:17])}, "
+                    f"directory ends at {end + 1}",
+                )
+            )
+        entries = _ENTRY.findall(record, 24, end)
+        if not entries:
+            problems.append(("LDR", "directory", "record has no fields"))
+            return problems
+        tags, lengths, starts = zip(*entries)
+        lengths = list(map(int, lengths))
+        starts = list(map(int, starts))
+        data = record[end + 1 : -1]
+        fields = data.split(b"\x1e")
+        if (
+            starts != [0, *accumulate(lengths[:-1])]
+            or len(fields) != len(lengths) + 1
+            or list(map(len, fields[:-1])) != [length - 1 for length in lengths]
+        ):
+            problems += _directory_problems(tags, lengths, starts, data)
+            fields = [
+                data[start : start + length - 1]
+                for start, length in zip(starts, lengths)
+            ]
+        for tag, field in zip(tags, fields):
+            if tag < b"010" and tag.isdigit():
+                continue
+            ind1, ind2, _, subfields = self.table.get(tag, self.default)
+            if len(field) < 3 or field[2] != 0x1F:
+                problems.append(
+                    (
+                        tag.decode(),
+                        "indicators",
+                        f"field starts with {field[:3]!r}, "
+                        "not indicators and a subfield",
+                    )
+                )
+                continue
+            if field[0:1] not in ind1 or field[1:2] not in ind2:
+                problems.append(
+                    (
+                        tag.decode(),
+                        "indicators",
+                        f"indicators {field[:2].decode('latin1')!r}",
+                    )
+                )
+            for code in subfields:
+                if code not in field:
+                    problems.append((tag.decode(), "subfield", f"no ${chr(code[1])}"))
+        if len(set(tags)) < len(tags):
+            repeated = {tag for i, tag in enumerate(tags) if tag in tags[:i]}
+            for tag in sorted(repeated & self.unique):
+                problems.append((tag.decode(), "repeated", "field isn't repeatable"))
+        for tag in sorted(self.required.difference(tags)):
+            problems.append((tag.decode(), "required", "record has no such field"))
+        problems += _encoding_problems(record)
+        return problems
+
+    def screen(self, records: Sequence[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        A vectorized first look at a batch of records, doing the checks of check() bar
+        the encoding for all of them at once. Returns whether each record has a leader
+        code that's wrong, and whether anything else is wrong with it (a length, its
+        directory, indicators, subfields, repeated or missing tags); records that are
+        fine on both counts don't need check().
+        """
+        n = len(records)
+        sizes = np.fromiter(map(len, records), np.int64, n)
+        buf = np.frombuffer(b"".join(records), np.uint8)
+        if not len(buf):
+            return np.zeros(n, bool), np.ones(n, bool)
+        ends = np.cumsum(sizes)
+        starts = ends - sizes
+        last = max(len(buf) - 1, 0)
+        bad = (sizes < 25) | (buf[np.maximum(ends - 1, 0)] != 0x1D)
+        leaders = buf[np.minimum(starts[:, None] + np.arange(24), last)]
+        leader_bad = ~self._leader[np.arange(24), leaders].all(1)
+        bad |= ~_DIGIT[leaders[:, :5]].all(1) | (_numbers(leaders[:, :5]) != sizes)
+        bad |= ~_DIGIT[leaders[:, 12:17]].all(1)
+        base = _numbers(leaders[:, 12:17])
+        bad |= (base < 37) | (base >= sizes) | ((base - 25) % 12 != 0)
+        bad |= buf[np.minimum(starts + np.where(bad, 0, base) - 1, last)] != 0x1E
+        # the directory entries of the records whose directory is the right shape
+        counts = np.where(bad, 0, (base - 25) // 12)
+        if not counts.any():
+            return leader_bad, bad
+        record = np.repeat(np.arange(n), counts)
+        first = np.cumsum(counts) - counts
+        entry = np.repeat(starts + 24 - 12 * first, counts) + 12 * np.arange(
+            len(record)
+        )
+        entries = buf[entry[:, None] + np.arange(12)]
+        entry_bad = ~_ALNUM[entries[:, :3]].all(1) | ~_DIGIT[entries[:, 3:]].all(1)
+        lengths = _numbers(entries[:, 3:7])
+        offsets = _numbers(entries[:, 7:])
+        # each field has to start where the last one ended, and
+        # end in a field terminator, and the fields have to
+        # fill the record, which has no other field terminators
+        after = np.cumsum(lengths) - lengths
+        entry_bad |= offsets != after - np.repeat(
+            after[np.minimum(first, len(after) - 1)], counts
+        )
+        field = np.repeat(starts + base, counts) + offsets
+        field_end = field + lengths - 1
+        entry_bad |= (lengths < 1) | (field_end >= np.repeat(ends, counts) - 1)
+        entry_bad |= buf[np.clip(field_end, 0, last)] != 0x1E
+        total = np.bincount(record, lengths, minlength=n)
+        terminators = np.bincount(
+            np.searchsorted(ends, np.flatnonzero(buf == 0x1E), "right"), minlength=n + 1
+        )[:n]
+        bad |= (counts > 0) & (
+            (total != sizes - base - 1) | (terminators != counts + 1)
+        )
+        # indicators, by the rule for each tag, or the default rule (the last one)
+        tags = _tag_keys(entries[:, :3])
+        rule = np.full(len(tags), len(self._ind1) - 1)
+        if len(self._keys):
+            i = np.minimum(np.searchsorted(self._keys, tags), len(self._keys) - 1)
+            rule = np.where(self._keys[i] == tags, i, rule)
+        control = (entries[:, 0] == 48) & (entries[:, 1] == 48) & _DIGIT[entries[:, 2]]
+        data = ~control & ~entry_bad
+        heads = buf[np.clip(field[:, None] + np.arange(3), 0, last)]
+        entry_bad |= data & (
+            (lengths < 4)
+            | (heads[:, 2] != 0x1F)
+            | ~self._ind1[rule, heads[:, 0]]
+            | ~self._ind2[rule, heads[:, 1]]
+        )
+        # subfield codes that rules need: which fields have a subfield delimiter
+        # followed by the code
+        if self._codes:
+            order = np.argsort(field, kind="stable")
+            delimiters = np.flatnonzero(buf[:-1] == 0x1F)
+            for j, code in enumerate(self._codes):
+                found = delimiters[buf[delimiters + 1] == code[1]]
+                owner = order[
+                    np.maximum(np.searchsorted(field[order], found, "right") - 1, 0)
+                ]
+                inside = (found >= field[owner]) & (found < field_end[owner])
+                has = np.zeros(len(field), bool)
+                has[owner[inside]] = True
+                entry_bad |= data & self._needs[rule, j] & ~has
+        bad |= np.bincount(record[entry_bad], minlength=n).astype(bool)
+        # non-repeatable tags that repeat, and required tags that are missing
+        key = record * (1 << 24) + tags
+        order = np.argsort(key, kind="stable")
+        repeated = order[1:][key[order][1:] == key[order][:-1]]
+        bad[record[repeated[self._unique[rule[repeated]]]]] = True
+        for required in self._required:
+            has = np.zeros(n, bool)
+            has[record[tags == required]] = True
+            bad |= ~has & (counts > 0)
+        return leader_bad, bad
+
+    @instrumentation.timed("validate")
+    def scan_batch(
+        self, records: Sequence[bytes], offsets: Sequence[int]
+    ) -> list[Issue]:
+        """
+        The problems with a batch of records at the
+        given offsets in their file, screened first.
+        """
+        if not records:
+            return []
+        leader_bad, bad = self.screen(records)
+        issues = []
+        for record, offset, leader, other in zip(records, offsets, leader_bad, bad):
+            if other:
+                problems = self.check(record)
+            elif leader:
+                # what is wrong with a leader only depends
+                # on its codes, which most records share
+                codes = record[5:12] + record[17:24]
+                if codes not in self._leaders:
+                    if len(self._leaders) > 10000:
+                        self._leaders.clear()
+                    self._leaders[codes] = _leader_problems(record[:24])
+                problems = self._leaders[codes] + _encoding_problems(record)
+            elif record.isascii():
+                continue
+            else:
+                problems = _encoding_problems(record)
+            if problems:
+                control = _control_number(record).decode("utf8", "replace")
+                issues += [(offset, control, *problem) for problem in problems]
+        return issues
+
+    def scan(self, records: bytes, offset: int = 0) -> list[Issue]:
+        """
+        The problems with each of a run of marc records back to back, e.g. a batch
+        written by to_marc, going by the record lengths in their leaders. `offset` is
+        where the run starts in its file. Like scan_batch, this doesn't add the issues
+        to the validator's, see add().
+        """
+        issues, batch, offsets = [], [], []
+        start = 0
+        while start < len(records):
+            if len(batch) == self.batch_size:
+                issues += self.scan_batch(batch, offsets)
+                batch, offsets = [], []
+            head = records[start : start + 5]
+            length = int(head) if head.isdigit() and int(head) >= 24 else 0
+            end = records.find(b"\x1d", start) + 1 if not length else start + length
+            if end <= start:
+                end = len(records)
+            batch.append(records[start:end])
+            offsets.append(offset + start)
+            start = end
+        return issues + self.scan_batch(batch, offsets)
+
+    def __call__(self, record: Union[bytes, memoryview], offset: int) -> None:
+        """
+        queues a record at `offset` in its file to be checked with the rest of its batch
+        """
+        self._queue.append((bytes(record), offset))
+        self.records += 1
+        if len(self._queue) >= self.batch_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._queue:
+            records, offsets = zip(*self._queue)
+            self._queue = []
+            self._issues += self.scan_batch(records, offsets)
+
+    @property
+    def issues(self) -> list[Issue]:
+        """
+        the problems found so far, as (offset, 001, tag, code, detail), after checking
+        what is queued
+        """
+        self._flush()
+        return self._issues
+
+    def add(self, issues: Iterable[Issue], records: int = 0) -> None:
+        """
+        adds issues found elsewhere, e.g. by scan() in a worker, and the number of
+        records checked there
+        """
+        self._issues += issues
+        self.records += records
+
+    def summary(self) -> Counter:
+        "the number of problems by tag and code"
+        return Counter((tag, code) for _, _, tag, code, _ in self.issues)
+
+    def write_report(self, dest: Union[Path, str, TextIO]) -> None:
+        """
+        writes the issues as tab-separated offset,
+        001, tag, code and detail, in file order
+        """
+        with (
+            nullcontext(dest)
+            if hasattr(dest, "write")
+            else open(dest, "w", newline="") as f
+        ):
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+            writer.writerow(["offset", "001", "tag", "code", "detail"])
+            writer.writerows(sorted(self.issues))
+
+
+def _leader_problems(leader: bytes) -> list[Tuple[str, str, str]]:
+    "what is wrong with a leader that doesn't match _LEADER"
+    if len(leader) < 24:
+        return [("LDR", "leader", f"leader is only {len(leader)} bytes")]
+    problems = []
+    if not leader[:5].isdigit():
+        problems.append(
+            ("LDR", "length", f"record length {leader[:5]!r} isn't a number")
+        )
+    for position, (name, codes) in LEADER_CODES.items():
+        code = leader[position : position + 1].decode("latin1")
+        if code not in codes:
+            problems.append(("LDR", f"leader/{position:02d}", f"{name} {code!r}"))
+    if leader[10:12] != b"22" or leader[20:24] != b"4500":
+        problems.append(
+            ("LDR", "leader", "leader/10-11 isn't 22 or leader/20-23 isn't 4500")
+        )
+    if not leader[12:17].isdigit():
+        problems.append(
+            ("LDR", "base", f"base address {leader[12:17]!r} isn't a number")
+        )
+    return problems
+
+
+def _directory_problems(
+    tags: Sequence[bytes], lengths: list[int], starts: list[int], data: bytes
+) -> list[Tuple[str, str, str]]:
+    "where the directory and the fields it points to don't agree"
+    problems = []
+    position = 0
+    for tag, length, start in zip(tags, lengths, starts):
+        tag = tag.decode()
+        if start != position:
+            problems.append(
+                (
+                    tag,
+                    "directory",
+                    f"field starts at {start}, after the last one at {position}",
+                )
+            )
+        if (
+            start + length > len(data) + 1
+            or data[start + length - 1 : start + length] != b"\x1e"
+        ):
+            problems.append(
+                (tag, "directory", f"no field terminator at {start + length - 1}")
+            )
+        position = start + length
+    if position != len(data):
+        problems.append(
+            (
+                "LDR",
+                "directory",
+                f"directory covers {position} bytes of data, record has {len(data)}",
+            )
+        )
+    return problems
+
+
+def _encoding_problems(record: bytes) -> list[Tuple[str, str, str]]:
+    "whether leader/09 agrees with the encoding: a for utf8, blank for MARC-8"
+    if record.isascii():
+        return []
+    try:
+        record.decode("utf8")
+    except UnicodeDecodeError as e:
+        if record[9] == ord("a"):
+            return [
+                (
+                    "LDR",
+                    "utf8",
+                    f"leader/09 is a, but the record isn't utf8 (byte {e.start})",
+                )
+            ]
+        return []
+    if record[9] == ord(" "):
+        return [("LDR", "utf8", "leader/09 says MARC-8, but the record is utf8")]
+    return []
+
+
+def validate_file(
+    filename: Union[Path, str], validator: Optional[Validator] = None
+) -> Validator:
+    """
+    Checks every record of a marc file, which can have base64 records (those are checked
+    decoded, at the offset of their base64); returns the validator with the issues.
+    """
+    validator = validator or Validator()
+    for chunk in iter_marc_records(filename):
+        validator(record_bytes(chunk), chunk.offset)
+    return validator
+
+
+def print_summary(validator: Validator, file: TextIO = sys.stderr) -> None:
+    "prints the number of records checked, and the problems by tag and code"
+    issues = validator.issues
+    print(
+        f"checked {validator.records} records, found {len(issues)} problems", file=file
+    )
+    for (tag, code), count in validator.summary().most_common():
+        print(f"{count:8d}  {tag} {code}", file=file)
+
+
+def _parse_args(args: Optional[Iterable[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Check the records of a marc file before uploading it."
+    )
+    parser.add_argument("filename")
+    parser.add_argument(
+        "--report",
+        help="where to write the problems as tab-separated values, or - for stdout",
+    )
+    parser.add_argument(
+        "--required",
+        nargs="*",
+        default=list(REQUIRED_TAGS),
+        help="tags every record has to have",
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    found = validate_file(args.filename, Validator(required=args.required))
+    if args.report:
+        found.write_report(sys.stdout if args.report == "-" else args.report)
+    print_summary(found)
+    sys.exit(1 if found.issues else 0)
@@ -0,0 +1,90 @@
+from itertools import accumulate
+from pathlib import Path
+
+from pymarc import Field, Indicators, Leader, Record, Subfield
+
+from csv_converter import to_csv, to_marc
+from testing import run_tests
+from utils import _control_number
+from validation import Validator, validate_file
+
+HERE = Path(__file__).parent
+
+
+def test_validation(tmp_path):
+    def build(
+        tag="245",
+        indicators=("1", "0"),
+        title="Title",
+        leader="00000nam a2200000 a 4500",
+    ):
+        record = Record(leader=Leader(leader), force_utf8=True)
+        record.add_field(Field(tag="001", data="r1"))
+        record.add_field(
+            Field(
+                tag=tag,
+                indicators=Indicators(*indicators),
+                subfields=[Subfield("a", title)],
+            )
+        )
+        return record.as_marc()
+
+    good = build(title="Café")
+    records = [
+        good,
+        build(indicators=("x", "0")),
+        build(tag="246"),
+        build(leader="00000xam a2200000 a 4500"),
+        # latin1, which leader/09 says isn't, and the same length
+        good.replace("é".encode(), "é!".encode("latin1")),
+        good[:30] + b"9" + good[31:],
+    ]
+    expected = [
+        [],
+        [("245", "indicators")],
+        [("245", "required")],
+        [("LDR", "leader/05")],
+        [("LDR", "utf8")],
+        [("001", "directory"), ("245", "directory")],
+    ]
+    source = tmp_path / "records.mrc"
+    source.write_bytes(b"".join(records))
+    validator = Validator()
+    assert [
+        [problem[:2] for problem in validator.check(record)] for record in records
+    ] == expected
+    found = validate_file(source)
+    offsets = [0, *accumulate(map(len, records))][:-1]
+    assert found.records == len(records)
+    assert [(offset, tag, code) for offset, _, tag, code, _ in found.issues] == [
+        (offset, *problem)
+        for offset, problems in zip(offsets, expected)
+        for problem in problems
+    ]
+    # the batch screening finds what checking each record does
+    assert validator.scan_batch(records, offsets) == [
+        (offset, _control_number(record).decode(), *problem)
+        for offset, record in zip(offsets, records)
+        for problem in validator.check(record)
+    ]
+    # and conversions find the same, checking records as they go
+    converted = Validator()
+    to_csv(
+        HERE / "librarything_UMClassics.marc", tmp_path / "lt.csv", validator=converted
+    )
+    assert (
+        converted.issues == validate_file(HERE / "librarything_UMClassics.marc").issues
+    )
+    written = Validator()
+    to_marc(tmp_path / "lt.csv", tmp_path / "lt.mrc", validator=written)
+    assert written.issues == validate_file(tmp_path / "lt.mrc").issues
+    assert written.records == converted.records > 0
+    # workers check the records of their shards, and hand the problems back
+    sharded = Validator()
+    to_marc(tmp_path / "lt.csv", tmp_path / "sharded.mrc", workers=3, validator=sharded)
+    assert (tmp_path / "sharded.mrc").read_bytes() == (tmp_path / "lt.mrc").read_bytes()
+    assert sharded.issues == written.issues and sharded.records == written.records
+
+
+if __name__ == "__main__":
+    run_tests(globals())